@@ -1,35 +1,127 @@
 import os
-import requests
-import base64
+import threading
 import streamlit as st
-from PIL import Image
-from io import BytesIO
 from dotenv import load_dotenv
-from streamlit_cropper import st_cropper
-from utils.model_wrappers.multimodal_models import SambastudioMultimodal
-import openai
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from utils.model_wrappers.instrumentation import RegistryHook, get_registry
+from utils.model_wrappers.prompt_templates import normalize_whitespace
+from utils.model_wrappers.rate_limiter import get_scheduler
+from utils.ui.metrics_panel import render_metrics_panel
 
 
 load_dotenv()
 
+# token budget of the Assistant messages, system prompt and previous turns included
+ASSISTANT_CONTEXT_TOKENS = 3072
 
-lvlm = SambastudioMultimodal(
-    model="Llama-3.2-11B-Vision-Instruct",
-    temperature=0.01,
-    max_tokens_to_generate=1024,
-    api_key=st.secrets["SAMBANOVA_API_KEY"],
-    base_url="https://api.sambanova.ai/v1/chat/completions",
+# built once, the identical first message of every Assistant call lets the provider reuse its cached prefix
+ASSISTANT_SYSTEM_PROMPT = normalize_whitespace(
+    "You are an expert assistant specializing in all aspects of material science. "
+    "Your role is to provide clear and accurate explanations about material properties, structures, "
+    "processing techniques, failure mechanisms, and their applications in real-world scenarios. "
+    "You are capable of analyzing complex material science problems, explaining fundamental concepts, "
+    "and offering insights on advanced topics such as crystallography, thermodynamics, "
+    "and material characterization methods."
 )
 
- 
-openai_client = openai.OpenAI(
-    api_key=os.environ.get("SAMBANOVA_API_KEY"),
-    base_url="https://api.sambanova.ai/v1",
-)
+# process wide limits shared by every session, both clients use the same API key
+scheduler = get_scheduler("sambanova", requests_per_second=2, tokens_per_minute=100_000)
+
+# latency, payload and token metrics of both clients, shown in the sidebar debug panel
+metrics_registry = get_registry()
+metrics_hook = RegistryHook(metrics_registry)
+
+
+# the stores and clients below are built once per server process and shared by every session and rerun, so
+# their connection pools stay warm; the heavy modules they need are only imported by the pages using them
+
+
+@st.cache_resource(show_spinner=False)
+def get_upload_store():
+    # uploads are stored once per content digest, bounded in size and age
+    from utils.storage.upload_store import UploadStore
+
+    return UploadStore(".cache/uploads", max_bytes=512 * 1024 * 1024, max_age=7 * 24 * 3600)
+
+
+@st.cache_resource(show_spinner=False)
+def get_history_store():
+    # last turns of each session in memory, the whole conversations in SQLite
+    from utils.storage.history_store import HistoryStore
+
+    return HistoryStore(".cache/history.sqlite", window=20)
+
+
+@st.cache_resource(show_spinner=False)
+def get_microstructure_analyzer():
+    # grain, phase and porosity measurements of the analyzed images, computed once per image
+    from utils.analysis.microstructure import MicrostructureAnalyzer
+    from utils.model_wrappers.response_cache import SQLiteResponseCache
+
+    return MicrostructureAnalyzer(cache=SQLiteResponseCache(".cache/analysis.sqlite"))
+
+
+@st.cache_resource(show_spinner=False)
+def get_lvlm():
+    from utils.model_wrappers.image_fetcher import ImageFetcher
+    from utils.model_wrappers.image_preprocessing import ImagePreprocessor
+    from utils.model_wrappers.multimodal_models import SambastudioMultimodal
+    from utils.model_wrappers.response_cache import SQLiteResponseCache
+
+    lvlm = SambastudioMultimodal(
+        model="Llama-3.2-11B-Vision-Instruct",
+        temperature=0.01,
+        max_tokens_to_generate=1024,
+        api_key=st.secrets["SAMBANOVA_API_KEY"],
+        base_url="https://api.sambanova.ai/v1/chat/completions",
+        cache=SQLiteResponseCache(".cache/responses.sqlite"),
+        preprocessor=ImagePreprocessor(max_side=1536, image_format="JPEG", quality=85),
+        scheduler=scheduler,
+        hooks=[metrics_hook],
+    )
+    # the cached fetcher shares the connection pool and resilience settings of the model client
+    lvlm.fetcher = ImageFetcher(
+        max_bytes=20 * 1024 * 1024,
+        cache_dir=".cache/images",
+        session=lvlm.http_session,
+        resilience=lvlm.resilience,
+    )
+    return lvlm
+
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client():
+    import httpx
+    import openai
+
+    return openai.OpenAI(
+        api_key=os.environ.get("SAMBANOVA_API_KEY"),
+        base_url="https://api.sambanova.ai/v1",
+        timeout=httpx.Timeout(120.0, connect=10.0),
+        max_retries=3,
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def prewarm_connections():
+    # Streamlit has no startup hook, the first script run of the process builds both clients and opens their
+    # connections (DNS lookup, TLS handshake) in the background, after the page is rendered
+    def prewarm():
+        get_lvlm().warmup()
+        try:
+            get_openai_client().with_options(max_retries=0, timeout=5.0).models.list()
+        except Exception:
+            pass
+
+    thread = threading.Thread(target=prewarm, name="prewarm-connections", daemon=True)
+    thread.start()
+    return thread
+
 
  
 st.sidebar.title("MatriExpert")
 section = st.sidebar.radio("Go to:", ["MatriXpert", "ImageAnalyzer", "Assitant"])
+render_metrics_panel(metrics_registry)
 
  
 if section == "MatriXpert":
@@ -50,136 +142,363 @@ if section == "MatriXpert":
 
  
 elif section == "ImageAnalyzer":
+    from utils.analysis.microstructure import answer_quantitative, format_analyses
+    from utils.model_wrappers.image_fetcher import ImageFetchError
+    from utils.model_wrappers.image_inputs import ImageBytes
+    from utils.model_wrappers.prompt_templates import MICROSTRUCTURE_CONTEXT_TEMPLATE, PDF_CONTEXT_TEMPLATE
+    from utils.model_wrappers.rate_limiter import scheduling_context
+    from utils.model_wrappers.sse import coalesce
+    from utils.model_wrappers.stream_metrics import StreamMetrics
+    from utils.model_wrappers.tiling import ImageTiler
+    from utils.ui.history_view import render_history
+    from utils.ui.image_cache import crop_selector, load_image_bytes, load_uploaded_image
+    from utils.ui.pdf_view import open_uploaded_pdf, pdf_page_picker, render_pdf_pages
+
+    lvlm = get_lvlm()
+    upload_store = get_upload_store()
+    history_store = get_history_store()
+    microstructure_analyzer = get_microstructure_analyzer()
+    # native resolution tiles of the tiled analysis mode, under the preprocessor max_side so they are not downscaled
+    tiler = ImageTiler(tile_size=1024, overlap=128)
+
     st.title("Enhanced Image Upload and Query Processing")
     st.write("""
-        - Upload multiple images or provide a URL.
+        - Upload multiple images or PDF documents, or provide a URL.
         - Optionally crop or edit the images before processing.
         - Ask a query related to the image and get the answer.
     """)
 
      
-    os.makedirs("uploaded_images", exist_ok=True)
-
-     
-    uploaded_files = st.file_uploader("Upload multiple images", type=["jpg", "jpeg", "png"], accept_multiple_files=True)
+    uploaded_files = st.file_uploader(
+        "Upload multiple images or PDFs", type=["jpg", "jpeg", "png", "pdf"], accept_multiple_files=True
+    )
 
      
     image_url = st.text_input("Or provide an image URL")
 
     images = []
     cropped_images = []
+    pdf_contexts = []
 
      
     if uploaded_files:
         st.write("Uploaded Images:")
         for uploaded_file in uploaded_files:
-            
-            local_path = os.path.join("uploaded_images", uploaded_file.name)
-            with open(local_path, "wb") as f:
-                f.write(uploaded_file.getbuffer())
+            if uploaded_file.type == "application/pdf":
+                # only the picked pages are rasterized, the text layer of the pages is sent as context
+                try:
+                    document = open_uploaded_pdf(uploaded_file, upload_store)
+                    pages, dpi = pdf_page_picker(document, uploaded_file.name)
+                    images.extend(render_pdf_pages(document, pages, dpi, uploaded_file.name))
+                    context = document.context(pages)
+                    if context:
+                        pdf_contexts.append(f"{uploaded_file.name}\n{context}")
+                except Exception as e:
+                    st.error(f"Failed to read {uploaded_file.name}: {e}")
+                continue
+
+            cached_image = load_uploaded_image(uploaded_file)
+            try:
+                upload_store.put(
+                    uploaded_file.getbuffer(),
+                    name=uploaded_file.name,
+                    mime_type=uploaded_file.type,
+                    digest=cached_image.digest,
+                )
+            except ValueError as e:
+                # the image is still analyzed, it is only not kept
+                st.warning(f"{uploaded_file.name} is not stored: {e}")
 
             
-            image = Image.open(uploaded_file)
-            images.append(image)
-            st.image(image, caption=uploaded_file.name, use_column_width=True)
+            images.append(cached_image)
+            st.image(cached_image.preview_bytes, caption=uploaded_file.name, use_column_width=True)
 
      
     if image_url:
         try:
-            response = requests.get(image_url)
-            if response.status_code == 200:
-                content_type = response.headers.get("Content-Type")
-                if "image" in content_type:
-                    image = Image.open(BytesIO(response.content))
-                    images.append(image)
-                    st.image(image, caption="Image from URL", use_column_width=True)
-                else:
-                    st.error("The URL does not link to a valid image file.")
-            else:
-                st.error("Failed to fetch the image. Please check the URL.")
+            # revalidated images are memory mapped from the image cache, unmapped once copied
+            with lvlm.fetcher.fetch(image_url) as fetched:
+                cached_image = load_image_bytes(bytes(fetched.data), image_url, digest=fetched.digest)
+            images.append(cached_image)
+            st.image(cached_image.preview_bytes, caption="Image from URL", use_column_width=True)
+        except ImageFetchError as e:
+            st.error(f"Failed to fetch the image: {e}")
         except Exception as e:
             st.error(f"An error occurred: {e}")
 
      
     if images:
         st.write("### Crop Images")
-        for idx, image in enumerate(images):
+        for idx, cached_image in enumerate(images):
             st.write(f"Crop Image {idx + 1}")
-            cropped_img = st_cropper(image, realtime_update=True, box_color='blue', aspect_ratio=None)
+            cropped_img, cropped_preview = crop_selector(cached_image, box_color='blue')
             cropped_images.append(cropped_img)
 
            
-            st.image(cropped_img, caption=f"Cropped Image {idx + 1}", use_column_width=True)
+            st.image(cropped_preview, caption=f"Cropped Image {idx + 1}", use_column_width=True)
 
      
-    if 'history' not in st.session_state:
-        st.session_state['history'] = []
-
      
     user_query = st.text_input("Ask a query related to the microstructure:")
 
      
+    query_mode = "First image"
+    if len(images) > 1:
+        query_mode = st.radio(
+            "Query mode",
+            ["First image", "All images in one request", "Each image in parallel"],
+            horizontal=True,
+            help="Send every crop in a single multi-image request, or ask the same question about each crop "
+                 "concurrently.",
+        )
+
+    tiled = st.checkbox(
+        "Tiled full resolution analysis",
+        help="Split large images into overlapping native resolution tiles queried in parallel, uniform tiles "
+             "are skipped and the answers are merged into one report with the tile coordinates.",
+    )
+
+    local_analysis = st.checkbox(
+        "Measure grains, phases and porosity locally",
+        value=True,
+        help="The measurements are added to the prompt, questions only asking for them are answered locally.",
+    )
+    pixel_size = 0.0
+    if local_analysis:
+        pixel_size = st.number_input(
+            "Pixel size (µm per pixel, 0 if unknown)", min_value=0.0, value=0.0, format="%.4f"
+        )
+
+     
     if user_query:
         st.write(f"Processing your query: {user_query}")
+        prompt = user_query
+        if pdf_contexts:
+            prompt = PDF_CONTEXT_TEMPLATE.format(context="\n\n".join(pdf_contexts), prompt=user_query)
 
          
-        image_to_process = cropped_images[0] if cropped_images else images[0]
+        if query_mode == "First image":
+            images_to_process = [cropped_images[0] if cropped_images else images[0].image]
+        else:
+            images_to_process = cropped_images or [cached_image.image for cached_image in images]
 
          
-        buffered = BytesIO()
-        image_to_process.save(buffered, format="PNG")
-        image_b64 = base64.b64encode(buffered.getvalue()).decode()
+        images_bytes = []
+        # micrometers per pixel of the sent images, which the preprocessor may have downscaled
+        pixel_sizes = []
+        bytes_before = bytes_after = encode_seconds = 0
+        for image_to_process in images_to_process:
+            # the report is returned per call, the preprocessor is shared by every session
+            processed, report = lvlm.preprocessor.process_image(image_to_process)
+            images_bytes.append(ImageBytes(processed, mime_type=lvlm.preprocessor.mime_type))
+            pixel_sizes.append(pixel_size * max(report['size_before']) / max(report['size_after']))
+            bytes_before += report['bytes_before']
+            bytes_after += report['bytes_after']
+            encode_seconds += report['encode_seconds']
+        st.caption(
+            f"Image payload: {len(images_bytes)} image(s), {bytes_before / 1e6:.2f} MB raw -> "
+            f"{bytes_after / 1e6:.2f} MB {report['format']} in {encode_seconds * 1000:.0f} ms"
+        )
+
+        analyses = []
+        if local_analysis:
+            try:
+                analyses = [
+                    microstructure_analyzer.analyze(image_bytes, image_pixel_size)
+                    for image_bytes, image_pixel_size in zip(images_bytes, pixel_sizes)
+                ]
+                with st.expander("Local measurements"):
+                    st.markdown(format_analyses(analyses))
+            except Exception as e:
+                st.warning(f"The local analysis failed: {e}")
+        direct_answer = answer_quantitative(user_query, analyses)
+
+        # tiles are asked the question alone, the measurements describe the whole image
+        tile_prompt = prompt
+
+        # the parallel mode asks about each image with its own measurements
+        image_prompts = [prompt] * len(images_bytes)
+        if analyses:
+            image_prompts = [
+                MICROSTRUCTURE_CONTEXT_TEMPLATE.format(measurements=format_analyses([analysis]), prompt=prompt)
+                for analysis in analyses
+            ]
+            prompt = MICROSTRUCTURE_CONTEXT_TEMPLATE.format(measurements=format_analyses(analyses), prompt=prompt)
 
         try:
              
-            response = lvlm.invoke(
-                images=image_b64,   
-                prompt=user_query  
-            )
+            st.write("### Response")
+            session_id = get_script_run_ctx().session_id
+            if direct_answer is not None:
+                st.markdown(direct_answer)
+                st.caption("Answered from the local measurements, the model was not called")
+                response = direct_answer
+                metrics = None
+            elif tiled:
+                reports = []
+                for idx, image_to_process in enumerate(images_to_process):
+                    progress = st.progress(0.0, text=f"Image {idx + 1}: splitting into tiles...")
+
+                    def show_progress(completed, total, index, result):
+                        progress.progress(completed / total, text=f"Image {idx + 1}: {completed}/{total} tiles")
+
+                    with scheduling_context(session_id=session_id):
+                        tiled_result = lvlm.invoke_tiled(
+                            tile_prompt,
+                            image_to_process,
+                            tiler=tiler,
+                            max_concurrency=8,
+                            on_progress=show_progress,
+                            priority="interactive",
+                        )
+                    progress.empty()
+                    st.markdown(tiled_result["report"])
+                    reports.append(tiled_result["report"])
+                response = "\n\n".join(reports)
+                metrics = None
+            elif query_mode == "Each image in parallel":
+                placeholders = []
+                for idx in range(len(images_bytes)):
+                    st.write(f"**Image {idx + 1}**")
+                    placeholders.append(st.empty())
+                    placeholders[idx].info("Waiting for the model...")
+
+                def show_result(completed, total, index, result):
+                    if isinstance(result, Exception):
+                        placeholders[index].error(f"An error occurred: {result}")
+                    else:
+                        placeholders[index].markdown(result)
+
+                with scheduling_context(session_id=session_id):
+                    results = lvlm.batch(
+                        [
+                            {"prompt": image_prompt, "images": image_bytes}
+                            for image_prompt, image_bytes in zip(image_prompts, images_bytes)
+                        ],
+                        max_concurrency=4,
+                        return_exceptions=True,
+                        on_progress=show_result,
+                        priority="interactive",
+                    )
+                response = "\n\n".join(
+                    f"**Image {idx + 1}:** {result}" for idx, result in enumerate(results)
+                )
+                metrics = None
+            else:
+                with scheduling_context(session_id=session_id, priority="interactive"):
+                    metrics = StreamMetrics(lvlm.stream(
+                        images=images_bytes,   
+                        prompt=prompt
+                    ))
+                    response = st.write_stream(coalesce(metrics))
+                st.caption(metrics.caption())
+            queue_delay = scheduler.stats()["interactive"]["mean_queue_delay"]
+            if queue_delay > 0.5:
+                st.caption(f"Requests are queued to stay under the API rate limits (mean wait {queue_delay:.1f} s)")
 
              
-            st.session_state['history'].append({
-                "query": user_query,
-                "response": response
-            })
+            render_history(history_store, session_id, conversation="analyzer")
 
-            
-            st.write("### Previous Queries and Responses")
-            for idx, history_item in enumerate(st.session_state['history']):
-                st.write(f"**Query {idx + 1}:** {history_item['query']}")
-                st.write(f"**Response {idx + 1}:** {history_item['response']}")
+            # reruns triggered by other widgets replay the same query, it is only recorded once
+            last_turns = history_store.recent(session_id, conversation="analyzer")[-1:]
+            if not last_turns or (last_turns[0]["query"], last_turns[0]["response"]) != (user_query, response):
+                history_store.append(
+                    session_id,
+                    user_query,
+                    response,
+                    metrics=metrics.summary() if metrics is not None else None,
+                    conversation="analyzer",
+                )
 
         except Exception as e:
             st.error(f"An error occurred: {e}")
 
  
 elif section == "Assitant":
+    import json
+    from utils.model_wrappers.instrumentation import CallTrace, trace_chat_stream
+    from utils.model_wrappers.prompt_templates import count_prompt_tokens
+    from utils.model_wrappers.sse import coalesce
+    from utils.model_wrappers.stream_metrics import StreamMetrics
+    from utils.ui.history_view import render_history
+
+    openai_client = get_openai_client()
+    history_store = get_history_store()
+
     st.title("Material Science Chatbot")
     st.write("Ask the chatbot any questions related to Material Science and get instant answers!")
 
-    user_input = st.text_input("Enter your question here:")
-    if user_input:
+    session_id = get_script_run_ctx().session_id
+    # only a submission asks the model, reruns from the other widgets keep the answers in the history below
+    with st.form("assistant_question"):
+        user_input = st.text_input("Enter your question here:")
+        submitted = st.form_submit_button("Ask")
+    render_history(
+        history_store,
+        session_id,
+        conversation="assistant",
+        title="Conversation",
+        query_label="Question",
+        response_label="Answer",
+    )
+    if submitted and user_input:
+        trace = CallTrace("assistant", "stream", "openai", hooks=[metrics_hook])
+        ticket = metrics = None
         try:
             
-            response = openai_client.chat.completions.create(
+            messages = history_store.build_messages(
+                session_id,
+                user_input,
+                system_prompt=ASSISTANT_SYSTEM_PROMPT,
+                max_tokens=ASSISTANT_CONTEXT_TOKENS,
+                conversation="assistant",
+                align=4,
+            )
+            estimated_prompt_tokens = count_prompt_tokens(messages)
+            with trace.span("queue"):
+                ticket = scheduler.acquire(
+                    estimated_prompt_tokens + 1024, session_id=session_id, priority="interactive"
+                )
+            trace.set("payload_bytes", len(json.dumps(messages).encode()))
+            stream = openai_client.chat.completions.create(
                 model='Meta-Llama-3.1-8B-Instruct',
-                messages=[
-    {
-        "role": "system",
-        "content": (
-            "You are an expert assistant specializing in all aspects of material science. "
-            "Your role is to provide clear and accurate explanations about material properties, structures, processing techniques, "
-            "failure mechanisms, and their applications in real-world scenarios. You are capable of analyzing complex material science problems, "
-            "explaining fundamental concepts, and offering insights on advanced topics such as crystallography, thermodynamics, and material characterization methods."
-        )
-    },
-    {"role": "user", "content": user_input}
-],
+                messages=messages,
                 temperature=0.1,
-                top_p=0.1
+                top_p=0.1,
+                stream=True,
+                stream_options={"include_usage": True},
             )
+            trace.mark("ttfb")
              
             st.write("**Assistant:**")
-            st.write(response.choices[0].message.content)
+            metrics = StreamMetrics(trace_chat_stream(stream, trace))
+            answer = st.write_stream(coalesce(metrics))
+            usage = trace.values
+            prompt_tokens = int(usage["prompt_tokens"]) if "prompt_tokens" in usage else f"~{estimated_prompt_tokens}"
+            cached_tokens = usage.get("cached_tokens")
+            st.caption(
+                f"{metrics.caption()} · prompt {prompt_tokens} tokens"
+                + (f" ({cached_tokens} cached)" if cached_tokens else "")
+                + f" · {(len(messages) - 2) // 2} previous turn(s) in context"
+            )
+            queue_delay = scheduler.stats()["interactive"]["mean_queue_delay"]
+            if queue_delay > 0.5:
+                st.caption(f"Requests are queued to stay under the API rate limits (mean wait {queue_delay:.1f} s)")
+            history_store.append(
+                session_id, user_input, answer, metrics=metrics.summary(), conversation="assistant"
+            )
         except Exception as e:
+            trace.finish(e)
             st.error(f"An error occurred: {e}")
+        finally:
+            # like the wrapper: the reported usage, else the estimated prompt and the streamed characters / 4
+            if ticket is not None:
+                usage = trace.values
+                if usage.get("prompt_tokens") is not None:
+                    tokens = usage["prompt_tokens"] + (usage.get("completion_tokens") or 0)
+                else:
+                    tokens = estimated_prompt_tokens + len(metrics.text if metrics is not None else "") // 4
+                scheduler.settle(ticket, tokens)
+
+
+prewarm_connections()
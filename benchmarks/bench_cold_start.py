@@ -0,0 +1,236 @@
+"""
+Cold start benchmark of the Streamlit app and of the first model call.
+
+Measures, each in a fresh interpreter so nothing is already imported:
+  - the import time of the modules the app pages use, with the slowest imports reported by python -X importtime
+  - the first run of each app page (the landing page, then a switch to each other page) through the Streamlit
+    testing harness, a proxy of the time to first paint without a browser
+  - the latency of the first call of a new SambastudioMultimodal client against the local mock server, with and
+    without a prior warmup(); with --remote-url, the cost of the first connection to a real host (DNS lookup and
+    TLS handshake), which warmup() moves off the first query, is measured as well
+
+usage: python -m benchmarks.bench_cold_start [--repeat N] [--top N] [--remote-url URL] [--output FILE]
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+from benchmarks.bench_load import git_commit, percentiles
+from benchmarks.mock_server import MockConfig, MockServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = (
+    'streamlit',
+    'openai',
+    'utils.model_wrappers.multimodal_models',
+    'utils.analysis.microstructure',
+    'utils.ui.image_cache',
+    'utils.ui.pdf_view',
+    'utils.ui.metrics_panel',
+)
+
+PAGES = ('MatriXpert', 'ImageAnalyzer', 'Assitant')
+
+# run in a fresh interpreter, prints the seconds of the first run of the landing page and of the switch to a page
+PAGE_SCRIPT = '''
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+app = AppTest.from_file('app.py', default_timeout=120)
+app.secrets['SAMBANOVA_API_KEY'] = 'benchmark'
+start = time.perf_counter()
+app.run()
+landing = time.perf_counter() - start
+switch = None
+if sys.argv[1] != 'MatriXpert':
+    start = time.perf_counter()
+    app.sidebar.radio[0].set_value(sys.argv[1]).run()
+    switch = time.perf_counter() - start
+print(json.dumps({'landing': landing, 'switch': switch, 'errors': len(app.exception)}))
+'''
+
+
+def parse_importtime(stderr: str) -> List[Dict[str, Any]]:
+    """Parses the python -X importtime report, times in seconds."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:') :].split('|')
+        imports.append({
+            'module': name.strip(),
+            'depth': (len(name) - len(name.lstrip()) - 1) // 2,
+            'self': int(self_us) / 1e6,
+            'cumulative': int(cumulative_us) / 1e6,
+        })
+    return imports
+
+
+def profile_import(module: str) -> Dict[str, Any]:
+    """Imports a module in a fresh interpreter, returns its cumulative import time and the imports it triggered."""
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imports = parse_importtime(completed.stderr)
+    top_level = [entry for entry in imports if entry['module'] == module]
+    return {'seconds': top_level[-1]['cumulative'] if top_level else None, 'imports': imports}
+
+
+def profile_imports(modules: Sequence[str], repeat: int, top: int) -> Dict[str, Any]:
+    """Import times of the modules and the slowest imports triggered by any of them."""
+    results: Dict[str, Any] = {'modules': {}, 'slowest': []}
+    slowest: Dict[str, Dict[str, Any]] = {}
+    for module in modules:
+        samples = []
+        for _ in range(repeat):
+            profile = profile_import(module)
+            samples.append(profile['seconds'])
+            for entry in profile['imports']:
+                # the top level packages of third party libraries, the submodules are part of their time
+                if entry['module'].split('.')[0] in ('utils', module) or entry['module'].count('.'):
+                    continue
+                known = slowest.get(entry['module'])
+                if known is None or entry['cumulative'] > known['cumulative']:
+                    slowest[entry['module']] = entry
+        results['modules'][module] = percentiles([sample for sample in samples if sample is not None])
+    results['slowest'] = sorted(slowest.values(), key=lambda entry: entry['cumulative'], reverse=True)[:top]
+    return results
+
+
+def profile_pages(pages: Sequence[str], repeat: int) -> Dict[str, Any]:
+    """First run times of the app pages, each measured in a fresh interpreter."""
+    results = {}
+    for page in pages:
+        samples: Dict[str, List[float]] = {'landing': [], 'switch': []}
+        for _ in range(repeat):
+            completed = subprocess.run(
+                [sys.executable, '-c', PAGE_SCRIPT, page],
+                cwd=REPO_ROOT,
+                capture_output=True,
+                text=True,
+                check=True,
+                env={**os.environ, 'SAMBANOVA_API_KEY': 'benchmark'},
+            )
+            run = json.loads(completed.stdout.strip().splitlines()[-1])
+            if run['errors']:
+                raise RuntimeError(f'The {page} page raised an exception')
+            samples['landing'].append(run['landing'])
+            if run['switch'] is not None:
+                samples['switch'].append(run['switch'])
+        results[page] = {name: percentiles(values) for name, values in samples.items()}
+    return results
+
+
+def profile_first_call(repeat: int, latency: float) -> Dict[str, Any]:
+    """Latency of the first call of new clients, with and without warmup, against the mock server."""
+    from utils.model_wrappers.multimodal_models import SambastudioMultimodal
+
+    samples: Dict[str, List[float]] = {'cold': [], 'warm': [], 'second': [], 'warmup': []}
+    with MockServer(MockConfig(latency=latency, jitter=0.0, token_rate=0.0)) as server:
+        for index in range(repeat):
+            for warm in (False, True):
+                lvlm = SambastudioMultimodal(base_url=server.openai_url, api_key='mock', model='mock-model')
+                if warm:
+                    start = time.perf_counter()
+                    lvlm.warmup()
+                    samples['warmup'].append(time.perf_counter() - start)
+                start = time.perf_counter()
+                lvlm.invoke(f'Describe sample {index} {warm}.')
+                samples['warm' if warm else 'cold'].append(time.perf_counter() - start)
+                if not warm:
+                    start = time.perf_counter()
+                    lvlm.invoke(f'Describe sample {index} again.')
+                    samples['second'].append(time.perf_counter() - start)
+                lvlm.http_session.close()
+    return {name: percentiles(values) for name, values in samples.items()}
+
+
+def profile_remote_connection(url: str, repeat: int) -> Dict[str, Any]:
+    """Time of the first request to a host on a new client (DNS, TCP, TLS) and of a request on the pooled one."""
+    from utils.model_wrappers.multimodal_models import SambastudioMultimodal
+
+    samples: Dict[str, List[float]] = {'first': [], 'pooled': []}
+    for _ in range(repeat):
+        lvlm = SambastudioMultimodal(base_url=url, api_key='benchmark')
+        for name in ('first', 'pooled'):
+            start = time.perf_counter()
+            if not lvlm.warmup(timeout=10.0):
+                raise RuntimeError(f'{url} did not answer')
+            samples[name].append(time.perf_counter() - start)
+        lvlm.http_session.close()
+    return {name: percentiles(values) for name, values in samples.items()}
+
+
+def _ms(value: Optional[float]) -> str:
+    return f'{value * 1000:>8.0f}' if value is not None else f'{"-":>8}'
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modules', nargs='+', default=list(MODULES), help='modules whose import is timed')
+    parser.add_argument('--pages', nargs='+', default=list(PAGES), choices=PAGES, help='app pages to run')
+    parser.add_argument('--repeat', type=int, default=3, help='fresh interpreters per measurement')
+    parser.add_argument('--top', type=int, default=10, help='slowest third party imports listed')
+    parser.add_argument('--latency', type=float, default=0.05, help='mock seconds before the answer')
+    parser.add_argument('--remote-url', default=None, help='API URL whose connection setup time is measured')
+    parser.add_argument('--output', default='benchmarks/results/bench_cold_start.json', help='JSON results file')
+    args = parser.parse_args()
+
+    results: Dict[str, Any] = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': vars(args),
+        }
+    }
+
+    results['imports'] = profile_imports(args.modules, args.repeat, args.top)
+    print(f"{'module import':<44} {'p50 ms':>8} {'p99 ms':>8}")
+    for module, times in results['imports']['modules'].items():
+        print(f'{module:<44} {_ms(times["p50"])} {_ms(times["p99"])}')
+    print(f"\n{'slowest third party import':<44} {'cum ms':>8} {'self ms':>8}")
+    for entry in results['imports']['slowest']:
+        print(f'{entry["module"]:<44} {_ms(entry["cumulative"])} {_ms(entry["self"])}')
+
+    results['pages'] = profile_pages(args.pages, args.repeat)
+    print(f"\n{'page first run':<44} {'p50 ms':>8} {'p99 ms':>8}")
+    for page, times in results['pages'].items():
+        print(f'{"landing (" + page + " run)":<44} {_ms(times["landing"]["p50"])} {_ms(times["landing"]["p99"])}')
+        if times['switch']['p50'] is not None:
+            print(f'{"switch to " + page:<44} {_ms(times["switch"]["p50"])} {_ms(times["switch"]["p99"])}')
+
+    results['first_call'] = profile_first_call(args.repeat, args.latency)
+    print(f"\n{'first call (mock server)':<44} {'p50 ms':>8} {'p99 ms':>8}")
+    labels = {'cold': 'new client', 'warm': 'new client after warmup()', 'second': 'second call', 'warmup': 'warmup()'}
+    for name, times in results['first_call'].items():
+        print(f'{labels[name]:<44} {_ms(times["p50"])} {_ms(times["p99"])}')
+
+    if args.remote_url:
+        results['remote_connection'] = profile_remote_connection(args.remote_url, args.repeat)
+        print(f"\n{'connection to ' + args.remote_url:<44} {'p50 ms':>8} {'p99 ms':>8}")
+        for name, times in results['remote_connection'].items():
+            print(f'{name + " request":<44} {_ms(times["p50"])} {_ms(times["p99"])}')
+
+    directory = os.path.dirname(args.output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(f'\nresults written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
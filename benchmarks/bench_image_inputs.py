@@ -0,0 +1,55 @@
+"""
+Micro-benchmark of image source classification cost as the image size grows.
+
+Compares the previous full decode classification with detect_image_input, which only decodes
+the leading base64 characters.
+
+usage: python -m benchmarks.bench_image_inputs [--repeat N]
+"""
+
+import argparse
+import base64
+import binascii
+import os
+import timeit
+from pathlib import Path
+
+from utils.model_wrappers.image_inputs import detect_image_input
+
+SIZES_MB = (0.1, 1, 5, 20)
+JPEG_HEADER = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01'
+
+
+def full_decode_classification(image: str) -> bool:
+    """Previous classification, decodes the whole string then stats it as a path."""
+    image = image.strip()
+    try:
+        is_b64 = len(image) % 4 == 0 and base64.b64decode(image, validate=True).startswith(b'\xff\xd8\xff')
+    except (binascii.Error, ValueError):
+        is_b64 = False
+    if not is_b64:
+        try:
+            Path(image).exists()
+        except OSError:
+            pass
+    return is_b64
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=20, help='number of classifications per size')
+    args = parser.parse_args()
+
+    print(f"{'size MB':>8} {'full decode ms':>15} {'sniff ms':>10} {'speedup':>8}")
+    for size_mb in SIZES_MB:
+        raw = JPEG_HEADER + os.urandom(int(size_mb * 1024 * 1024))
+        image_b64 = base64.b64encode(raw).decode()
+        full = min(timeit.repeat(lambda: full_decode_classification(image_b64), number=args.repeat, repeat=3))
+        sniff = min(timeit.repeat(lambda: detect_image_input(image_b64), number=args.repeat, repeat=3))
+        full_ms = full / args.repeat * 1000
+        sniff_ms = sniff / args.repeat * 1000
+        print(f'{size_mb:>8} {full_ms:>15.3f} {sniff_ms:>10.4f} {full_ms / sniff_ms:>7.0f}x')
+
+
+if __name__ == '__main__':
+    main()
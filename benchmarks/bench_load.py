@@ -0,0 +1,305 @@
+"""
+Offline load test of SambastudioMultimodal against the local mock server.
+
+Runs every combination of endpoint, call mode, image size and concurrency level, and measures the throughput,
+the p50 / p95 / p99 latency, the time to first token of streamed calls, the image loading time, the request
+payload bytes and the peak RSS. Results are printed as a table and written as JSON; with --compare, a previous
+results file is used as the baseline and the scenarios whose throughput or p95 latency regressed by more than
+the threshold make the command exit with status 1.
+
+usage: python -m benchmarks.bench_load [--sides PX ...] [--concurrency N ...] [--output FILE] [--compare FILE]
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+from PIL import Image
+
+from benchmarks.mock_server import MockConfig, MockServer
+from utils.model_wrappers.image_inputs import ImageBytes
+from utils.model_wrappers.image_preprocessing import ImagePreprocessor
+from utils.model_wrappers.instrumentation import CallTrace, InstrumentationHook
+from utils.model_wrappers.multimodal_models import SambastudioMultimodal
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentiles(values: Sequence[float]) -> Dict[str, Optional[float]]:
+    """Linear interpolated percentiles and mean, None values for an empty sample."""
+    result: Dict[str, Optional[float]] = {f'p{p}': None for p in PERCENTILES}
+    result['mean'] = None
+    if not values:
+        return result
+    ordered = sorted(values)
+    for p in PERCENTILES:
+        position = (len(ordered) - 1) * p / 100
+        low = int(position)
+        high = min(low + 1, len(ordered) - 1)
+        result[f'p{p}'] = ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+    result['mean'] = sum(ordered) / len(ordered)
+    return result
+
+
+def current_rss() -> int:
+    """Resident set size of the process in bytes, from /proc when available."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # peak RSS in kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class RSSSampler:
+    """
+    Samples the RSS of the process from a background thread and keeps the peak.
+    """
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self.interval = interval
+        self.start_rss = self.peak_rss = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, current_rss())
+
+    def __enter__(self) -> 'RSSSampler':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, current_rss())
+
+
+class TraceCollector(InstrumentationHook):
+    """
+    Keeps the traces of the finished calls.
+    """
+
+    def __init__(self) -> None:
+        self.traces: List[CallTrace] = []
+        self._lock = threading.Lock()
+
+    def on_call_end(self, trace: CallTrace) -> None:
+        with self._lock:
+            self.traces.append(trace)
+
+
+def make_image(side: int) -> ImageBytes:
+    """Builds a noisy PNG micrograph stand in, noise keeps the encoded size realistic for its resolution."""
+    image = Image.effect_noise((side, side), 64).convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return ImageBytes(buffer.getvalue(), mime_type='image/png')
+
+
+def run_scenario(
+    server: MockServer, endpoint: str, mode: str, image: ImageBytes, concurrency: int, requests: int
+) -> Dict[str, Any]:
+    """Runs the requests of a scenario with a fresh client and summarizes the traces."""
+    collector = TraceCollector()
+    lvlm = SambastudioMultimodal(
+        base_url=server.openai_url if endpoint == 'openai' else server.generic_url,
+        api_key='mock',
+        model='mock-model',
+        max_concurrency=concurrency,
+        preprocessor=ImagePreprocessor(max_side=1536, image_format='JPEG', quality=85),
+        hooks=[collector],
+    )
+    # distinct prompts, a response cache would not apply anyway
+    prompts = [f'Describe the microstructure of sample {index}.' for index in range(requests)]
+    server.stats.reset()
+    errors = 0
+    with RSSSampler() as rss:
+        start = time.perf_counter()
+        if mode == 'invoke':
+            results = lvlm.batch(
+                [(prompt, image) for prompt in prompts], max_concurrency=concurrency, return_exceptions=True
+            )
+            errors = sum(isinstance(result, Exception) for result in results)
+        else:
+
+            async def stream_all() -> int:
+                semaphore = asyncio.Semaphore(concurrency)
+
+                async def consume(prompt: str) -> bool:
+                    async with semaphore:
+                        try:
+                            async for _ in lvlm.astream(prompt, image):
+                                pass
+                        except Exception:
+                            return False
+                        return True
+
+                try:
+                    return sum(not ok for ok in await asyncio.gather(*(consume(prompt) for prompt in prompts)))
+                finally:
+                    await lvlm.aclose()
+
+            errors = asyncio.run(stream_all())
+        seconds = time.perf_counter() - start
+    traces = collector.traces
+    payloads = [trace.values['payload_bytes'] for trace in traces if 'payload_bytes' in trace.values]
+    return {
+        'endpoint': endpoint,
+        'mode': mode,
+        'image_side': image_side(image),
+        'image_bytes': len(image),
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': errors,
+        'seconds': seconds,
+        'throughput': (requests - errors) / seconds,
+        'latency': percentiles([trace.spans['total'] for trace in traces if trace.error is None]),
+        'ttft': percentiles([trace.spans['ttft'] for trace in traces if 'ttft' in trace.spans]),
+        'load': percentiles([trace.spans['load'] for trace in traces if 'load' in trace.spans]),
+        'payload_bytes': sum(payloads) / len(payloads) if payloads else None,
+        'server': server.stats.snapshot(),
+        'rss_peak_mb': rss.peak_rss / 1e6,
+        'rss_delta_mb': (rss.peak_rss - rss.start_rss) / 1e6,
+    }
+
+
+def image_side(image: ImageBytes) -> int:
+    return Image.open(io.BytesIO(image.data)).width
+
+
+def scenario_key(scenario: Dict[str, Any]) -> str:
+    return f"{scenario['endpoint']}/{scenario['mode']}/{scenario['image_side']}px/c{scenario['concurrency']}"
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _ms(value: Optional[float]) -> str:
+    return f'{value * 1000:>8.0f}' if value is not None else f'{"-":>8}'
+
+
+def print_scenario(scenario: Dict[str, Any]) -> None:
+    payload = scenario['payload_bytes']
+    print(
+        f'{scenario_key(scenario):<28} {scenario["throughput"]:>8.1f} {_ms(scenario["latency"]["p50"])} '
+        f'{_ms(scenario["latency"]["p95"])} {_ms(scenario["latency"]["p99"])} {_ms(scenario["ttft"]["p50"])} '
+        f'{_ms(scenario["load"]["p50"])} {(payload or 0) / 1e3:>9.0f} {scenario["rss_peak_mb"]:>8.0f} '
+        f'{scenario["errors"]:>6}',
+        flush=True,
+    )
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Returns the regressions of the results against a baseline, printing the deltas."""
+    previous = {scenario_key(scenario): scenario for scenario in baseline['scenarios']}
+    regressions = []
+    print(f'\ncompared with {baseline["meta"].get("commit")} ({baseline["meta"].get("timestamp")})')
+    for scenario in results['scenarios']:
+        key = scenario_key(scenario)
+        before = previous.get(key)
+        if before is None:
+            continue
+        throughput = scenario['throughput'] / before['throughput'] - 1
+        line = f'{key:<28} throughput {throughput:+7.1%}'
+        if scenario['latency']['p95'] and before['latency']['p95']:
+            p95 = scenario['latency']['p95'] / before['latency']['p95'] - 1
+            line += f'  p95 {p95:+7.1%}'
+            if p95 > threshold:
+                regressions.append(f'{key} p95 latency {p95:+.1%}')
+        if throughput < -threshold:
+            regressions.append(f'{key} throughput {throughput:+.1%}')
+        print(line)
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--endpoints', nargs='+', default=['openai'], choices=['openai', 'generic'])
+    parser.add_argument('--modes', nargs='+', default=['invoke', 'stream'], choices=['invoke', 'stream'])
+    parser.add_argument('--sides', type=int, nargs='+', default=[512, 2048], help='image sides in pixels')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32], help='concurrency levels')
+    parser.add_argument('--requests', type=int, default=64, help='requests per scenario')
+    parser.add_argument('--latency', type=float, default=0.2, help='mock seconds before the first token')
+    parser.add_argument('--tokens', type=int, default=64, help='mock tokens per response')
+    parser.add_argument('--token-rate', type=float, default=400.0, help='mock generated tokens per second')
+    parser.add_argument('--chunk-tokens', type=int, default=1, help='mock tokens per streamed event')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='mock probability of an error status')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmarks/results/bench_load.json', help='JSON results file')
+    parser.add_argument('--compare', default=None, help='previous JSON results file used as the baseline')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative regression failing --compare')
+    args = parser.parse_args()
+
+    # read first, the baseline may be the file the results are written to
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    config = MockConfig(
+        latency=args.latency,
+        completion_tokens=args.tokens,
+        token_rate=args.token_rate,
+        chunk_tokens=args.chunk_tokens,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    images = {side: make_image(side) for side in args.sides}
+    results: Dict[str, Any] = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': vars(args),
+        },
+        'scenarios': [],
+    }
+    print(
+        f"{'scenario':<28} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'ttft ms':>8} "
+        f"{'load ms':>8} {'body kB':>9} {'rss MB':>8} {'errors':>6}"
+    )
+    with MockServer(config) as server:
+        for endpoint in args.endpoints:
+            for mode in args.modes:
+                for side in args.sides:
+                    for concurrency in args.concurrency:
+                        scenario = run_scenario(server, endpoint, mode, images[side], concurrency, args.requests)
+                        results['scenarios'].append(scenario)
+                        print_scenario(scenario)
+
+    directory = os.path.dirname(args.output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(f'results written to {args.output}')
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('regressions:\n  ' + '\n  '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
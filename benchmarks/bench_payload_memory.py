@@ -0,0 +1,80 @@
+"""
+Memory benchmark of the multimodal request body encoding with tracemalloc.
+
+Compares the previous payload encoding, data URIs inside a dict dumped with json.dumps, with
+StreamingJSONBody consumed chunk by chunk as the socket would. Peaks are measured above the memory
+already holding the raw images.
+
+usage: python -m benchmarks.bench_payload_memory [--images N] [--size-mb MB]
+"""
+
+import argparse
+import json
+import os
+import time
+import tracemalloc
+from typing import Any, Callable, List, Tuple
+
+from utils.model_wrappers.image_inputs import ImageBytes
+from utils.model_wrappers.payload_encoder import Base64Field, StreamingJSONBody
+
+JPEG_HEADER = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01'
+
+
+def build_payload(images: List[ImageBytes], embed: Callable[[ImageBytes], Any]) -> dict:
+    """Builds an openai compatible payload with the images embedded by the embed function."""
+    content: List[dict] = [{'type': 'text', 'text': 'Describe the microstructure of these samples.'}]
+    content += [{'type': 'image_url', 'image_url': {'url': embed(image)}} for image in images]
+    return {'messages': [{'role': 'user', 'content': content}], 'model': 'bench', 'stream': False}
+
+
+def json_dumps_body(images: List[ImageBytes]) -> int:
+    """Previous encoding, every image exists as base64, as a data URI and inside the JSON string and bytes."""
+    body = json.dumps(build_payload(images, lambda image: f'data:{image.mime_type};base64,{image.b64}')).encode()
+    return len(body)
+
+
+def streaming_body(images: List[ImageBytes]) -> int:
+    """Streaming encoding, the body is only ever held one chunk at a time."""
+    sent = 0
+    for chunk in StreamingJSONBody(build_payload(images, Base64Field)):
+        sent += len(chunk)
+    return sent
+
+
+def measure(encode: Callable[[List[ImageBytes]], int], images: List[ImageBytes]) -> Tuple[int, int, float]:
+    """Returns the body size, the peak traced memory above the starting point and the encoding seconds."""
+    tracemalloc.reset_peak()
+    start_memory = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    size = encode(images)
+    seconds = time.perf_counter() - start
+    return size, tracemalloc.get_traced_memory()[1] - start_memory, seconds
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, nargs='+', default=[1, 4], help='numbers of images per request')
+    parser.add_argument('--size-mb', type=float, default=20, help='size of each image')
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    print(f"{'images':>6} {'raw MB':>8} {'encoder':>10} {'body MB':>8} {'peak MB':>8} {'peak/raw':>9} {'ms':>7}")
+    for count in args.images:
+        # fresh images per encoder, so the base64 cached by ImageBytes.b64 does not leak between runs
+        for name, encode in (('json.dumps', json_dumps_body), ('streaming', streaming_body)):
+            images = [
+                ImageBytes(JPEG_HEADER + os.urandom(int(args.size_mb * 1024 * 1024))) for _ in range(count)
+            ]
+            raw = sum(len(image) for image in images)
+            size, peak, seconds = measure(encode, images)
+            print(
+                f'{count:>6} {raw / 1e6:>8.1f} {name:>10} {size / 1e6:>8.1f} {peak / 1e6:>8.1f} '
+                f'{peak / raw:>9.2f} {seconds * 1000:>7.0f}'
+            )
+            del images
+    tracemalloc.stop()
+
+
+if __name__ == '__main__':
+    main()
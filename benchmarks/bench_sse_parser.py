@@ -0,0 +1,89 @@
+"""
+Benchmark of the openai compatible SSE stream parsing cost per token.
+
+Replays a recorded-style stream of 10k token events split in network sized chunks through
+iter_openai_stream, with the standard library and orjson JSON backends, and through the previous
+sseclient based parser when sseclient-py is installed.
+
+usage: python -m benchmarks.bench_sse_parser [--tokens N] [--chunk-size BYTES]
+"""
+
+import argparse
+import json
+import time
+from typing import Callable, Iterable, Iterator, List
+
+from utils.model_wrappers import sse
+
+
+def build_stream(tokens: int) -> bytes:
+    """Builds an openai compatible SSE stream with one token per event."""
+    events = []
+    for index in range(tokens):
+        payload = {
+            'id': 'chatcmpl-bench',
+            'object': 'chat.completion.chunk',
+            'model': 'Llama-3.2-11B-Vision-Instruct',
+            'choices': [{'index': 0, 'delta': {'content': f' tok{index % 100}'}, 'finish_reason': None}],
+        }
+        events.append(b'data: ' + json.dumps(payload).encode() + b'\n\n')
+    events.append(b'data: [DONE]\n\n')
+    return b''.join(events)
+
+
+def split(stream: bytes, chunk_size: int) -> List[bytes]:
+    return [stream[i : i + chunk_size] for i in range(0, len(stream), chunk_size)]
+
+
+def sseclient_parser(chunks: Iterable[bytes]) -> Iterator[str]:
+    """Previous parser, one dict per event and json.loads inside a broad try / except."""
+    import sseclient
+
+    for event in sseclient.SSEClient(iter(chunks)).events():
+        chunk = {'event': event.event, 'data': event.data, 'status_code': 200}
+        try:
+            if chunk['data'] != '[DONE]':
+                data = json.loads(chunk['data'])
+                if len(data['choices']) > 0:
+                    yield data['choices'][0]['delta'].get('content', '')
+        except Exception:
+            raise Exception(f'Error getting content chunk raw streamed response: {chunk}')
+
+
+def measure(name: str, parser: Callable[[Iterable[bytes]], Iterator[str]], chunks: List[bytes], tokens: int) -> None:
+    best = float('inf')
+    for _ in range(5):
+        start = time.perf_counter()
+        count = sum(1 for _ in parser(chunks))
+        best = min(best, time.perf_counter() - start)
+    assert count == tokens, f'{name} parsed {count} tokens instead of {tokens}'
+    print(f'{name:<24} {best * 1000:>9.2f} ms {best / tokens * 1e6:>9.3f} us/token')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tokens', type=int, default=10_000, help='number of token events in the stream')
+    parser.add_argument('--chunk-size', type=int, default=1024, help='size of the replayed network chunks')
+    args = parser.parse_args()
+
+    chunks = split(build_stream(args.tokens), args.chunk_size)
+    print(f'{args.tokens} tokens in {len(chunks)} chunks of {args.chunk_size} bytes')
+    try:
+        import sseclient  # noqa: F401
+
+        measure('sseclient (previous)', sseclient_parser, chunks, args.tokens)
+    except ImportError:
+        print('sseclient-py not installed, skipping the previous parser')
+
+    loads = sse.json_loads
+    sse.json_loads = json.loads
+    try:
+        measure('SSEDecoder + json', sse.iter_openai_stream, chunks, args.tokens)
+    finally:
+        sse.json_loads = loads
+    if loads is not json.loads:
+        measure('SSEDecoder + orjson', sse.iter_openai_stream, chunks, args.tokens)
+
+
+if __name__ == '__main__':
+    main()
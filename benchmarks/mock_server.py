@@ -0,0 +1,347 @@
+"""
+Local mock of the Sambanova openai compatible and generic endpoints, for benchmarks and offline runs.
+
+Serves /v1/chat/completions (plain and SSE streamed) and the generic /api/predict/generic/... endpoints
+(plain and streamed as JSON lines) with a configurable time to first token, token rate, tokens per streamed
+event and injection of error statuses and mid stream disconnects. Request bodies are read and parsed like
+a real server would, and their sizes are counted.
+
+usage: python -m benchmarks.mock_server [--port PORT] [--latency S] [--token-rate TOKENS/S] [--error-rate P]
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, Optional, Sequence
+
+WORDS = ('grain', ' boundary', ' ferrite', ' pearlite', ' phase', ' with', ' the', ' microstructure', '.')
+
+
+class MockConfig:
+    """
+    Behaviour of the mock endpoints.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.2,
+        jitter: float = 0.2,
+        completion_tokens: int = 64,
+        token_rate: float = 200.0,
+        chunk_tokens: int = 1,
+        error_rate: float = 0.0,
+        error_statuses: Sequence[int] = (429, 500, 503),
+        disconnect_rate: float = 0.0,
+        seed: Optional[int] = None,
+        words: Sequence[str] = WORDS,
+    ) -> None:
+        """
+        Initialize the MockConfig.
+
+        :param float latency: mean seconds before the first token
+        :param float jitter: relative spread of the latency, drawn uniformly in latency * (1 +- jitter)
+        :param int completion_tokens: tokens generated per response
+        :param float token_rate: generated tokens per second after the first one
+        :param int chunk_tokens: tokens per streamed event
+        :param float error_rate: probability of answering with one of error_statuses
+        :param list error_statuses: injected HTTP error statuses
+        :param float disconnect_rate: probability of closing a streamed response half way
+        :param int seed: seed of the injected latencies and errors
+        :param list words: tokens cycled to build the responses
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.completion_tokens = completion_tokens
+        self.token_rate = token_rate
+        self.chunk_tokens = max(1, chunk_tokens)
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.disconnect_rate = disconnect_rate
+        self.words = tuple(words)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def draw(self) -> Dict[str, Any]:
+        """Draws the latency and injected failures of a request."""
+        with self.lock:
+            return {
+                'latency': max(0.0, self.latency * (1 + self.random.uniform(-self.jitter, self.jitter))),
+                'status': self.random.choice(self.error_statuses) if self.random.random() < self.error_rate else 200,
+                'disconnect': self.random.random() < self.disconnect_rate,
+            }
+
+
+class MockStats:
+    """
+    Thread safe counters of the requests served.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """Sets every counter to zero."""
+        with self.lock:
+            self.requests = 0
+            self.request_bytes = 0
+            self.max_request_bytes = 0
+            self.errors = 0
+            self.disconnects = 0
+            self.connections = 0
+            self.active = 0
+            self.max_active = 0
+
+    def connected(self) -> None:
+        """Counts an accepted connection."""
+        with self.lock:
+            self.connections += 1
+
+    def started(self) -> None:
+        """Counts a request being served."""
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+
+    def finished(self) -> None:
+        """Counts a request served."""
+        with self.lock:
+            self.active -= 1
+
+    def record(self, request_bytes: int, status: int, disconnect: bool) -> None:
+        with self.lock:
+            self.requests += 1
+            self.request_bytes += request_bytes
+            self.max_request_bytes = max(self.max_request_bytes, request_bytes)
+            self.errors += status != 200
+            self.disconnects += disconnect
+
+    def snapshot(self) -> Dict[str, int]:
+        """Returns the counters."""
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'request_bytes': self.request_bytes,
+                'max_request_bytes': self.max_request_bytes,
+                'errors': self.errors,
+                'disconnects': self.disconnects,
+                'connections': self.connections,
+                'max_active': self.max_active,
+            }
+
+
+def _tokens(words: Sequence[str], count: int) -> Iterator[str]:
+    for index in range(count):
+        yield words[index % len(words)]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of the mock endpoints, configured through the server.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body are separate writes, Nagle's algorithm would delay keep-alive responses by 40 ms
+    disable_nagle_algorithm = True
+    server: 'MockServer'
+
+    def setup(self) -> None:
+        super().setup()
+        self.server.stats.connected()
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _send_json(self, status: int, payload: Dict[str, Any]) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def _stream(self, events: Iterator[bytes], disconnect: bool, content_type: str) -> None:
+        """Sends the events as a chunked response, paced at the token rate."""
+        config = self.server.config
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        interval = config.chunk_tokens / config.token_rate if config.token_rate else 0.0
+        events = list(events)
+        for index, event in enumerate(events):
+            if disconnect and index >= len(events) // 2:
+                self.close_connection = True
+                return
+            if index and interval and index < len(events) - 1:
+                time.sleep(interval)
+            self._write_chunk(event)
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _openai_events(self, prompt_tokens: int) -> Iterator[bytes]:
+        config = self.server.config
+        tokens = list(_tokens(config.words, config.completion_tokens))
+        for start in range(0, len(tokens), config.chunk_tokens):
+            content = ''.join(tokens[start : start + config.chunk_tokens])
+            chunk = {'object': 'chat.completion.chunk', 'choices': [{'index': 0, 'delta': {'content': content}}]}
+            # raw UTF-8 like the real endpoints, not \u escapes
+            yield b'data: ' + json.dumps(chunk, ensure_ascii=False).encode() + b'\n\n'
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': config.completion_tokens}
+        yield b'data: ' + json.dumps({'choices': [], 'usage': usage}).encode() + b'\n\ndata: [DONE]\n\n'
+
+    def _generic_events(self) -> Iterator[bytes]:
+        config = self.server.config
+        tokens = list(_tokens(config.words, config.completion_tokens))
+        for start in range(0, len(tokens), config.chunk_tokens):
+            last = start + config.chunk_tokens >= len(tokens)
+            response = {'stream_token': ''.join(tokens[start : start + config.chunk_tokens]), 'is_last_response': last}
+            yield json.dumps({'result': {'responses': [response]}}, ensure_ascii=False).encode() + b'\n'
+
+    def do_POST(self) -> None:
+        self.server.stats.started()
+        try:
+            self._serve_post()
+        finally:
+            self.server.stats.finished()
+
+    def _serve_post(self) -> None:
+        config = self.server.config
+        length = int(self.headers.get('Content-Length', 0))
+        raw = self.rfile.read(length)
+        draw = config.draw()
+        generic = '/generic/' in self.path
+        if not generic and not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {'error': f'unknown endpoint {self.path}'})
+            return
+        try:
+            body = json.loads(raw or b'{}')
+        except ValueError:
+            self._send_json(400, {'error': 'invalid JSON body'})
+            return
+        stream = '/generic/stream/' in self.path if generic else bool(body.get('stream'))
+        self.server.stats.record(len(raw), draw['status'], draw['disconnect'] and stream)
+        time.sleep(draw['latency'])
+        if draw['status'] != 200:
+            self._send_json(draw['status'], {'error': {'message': 'injected error', 'code': draw['status']}})
+            return
+        # prompt tokens estimated as the rate limiter does, the images dominate the request size
+        prompt_tokens = length // 4 + 1
+        if stream:
+            if generic:
+                self._stream(self._generic_events(), draw['disconnect'], 'application/x-ndjson')
+            else:
+                self._stream(self._openai_events(prompt_tokens), draw['disconnect'], 'text/event-stream')
+            return
+        if config.token_rate:
+            time.sleep(config.completion_tokens / config.token_rate)
+        text = ''.join(_tokens(config.words, config.completion_tokens))
+        if generic:
+            self._send_json(200, {'predictions': [{'completion': text}]})
+        else:
+            usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': config.completion_tokens}
+            self._send_json(200, {'choices': [{'index': 0, 'message': {'content': text}}], 'usage': usage})
+
+
+class MockServer(ThreadingHTTPServer):
+    """
+    Threaded mock server, one thread per connection, served from a background thread once started.
+    """
+
+    daemon_threads = True
+    # the default listen backlog of 5 drops connections under load tests
+    request_queue_size = 1024
+
+    def __init__(self, config: Optional[MockConfig] = None, host: str = '127.0.0.1', port: int = 0) -> None:
+        """
+        Initialize the MockServer.
+
+        :param MockConfig config: endpoints behaviour, defaults to MockConfig()
+        :param str host: listen address
+        :param int port: listen port, 0 for a free port
+        """
+        super().__init__((host, port), MockHandler)
+        self.config = config if config is not None else MockConfig()
+        self.stats = MockStats()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        """Root URL of the server."""
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def openai_url(self) -> str:
+        """URL of the openai compatible chat completions endpoint."""
+        return f'{self.url}/v1/chat/completions'
+
+    @property
+    def generic_url(self) -> str:
+        """URL of the generic endpoint, the streaming URL is derived by the client."""
+        return f'{self.url}/api/predict/generic/mock-project/mock-endpoint'
+
+    def start(self) -> 'MockServer':
+        """Serves requests from a background thread."""
+        # short poll interval, stop() waits for the serving loop to notice the shutdown
+        self._thread = threading.Thread(
+            target=self.serve_forever, kwargs={'poll_interval': 0.05}, name='mock-sambanova', daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stops serving and closes the socket."""
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self) -> 'MockServer':
+        return self.start()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8008)
+    parser.add_argument('--latency', type=float, default=0.2, help='mean seconds before the first token')
+    parser.add_argument('--jitter', type=float, default=0.2, help='relative spread of the latency')
+    parser.add_argument('--tokens', type=int, default=64, help='tokens generated per response')
+    parser.add_argument('--token-rate', type=float, default=200.0, help='generated tokens per second')
+    parser.add_argument('--chunk-tokens', type=int, default=1, help='tokens per streamed event')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of an injected error status')
+    parser.add_argument('--disconnect-rate', type=float, default=0.0, help='probability of a mid stream disconnect')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    config = MockConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        completion_tokens=args.tokens,
+        token_rate=args.token_rate,
+        chunk_tokens=args.chunk_tokens,
+        error_rate=args.error_rate,
+        disconnect_rate=args.disconnect_rate,
+        seed=args.seed,
+    )
+    server = MockServer(config, args.host, args.port)
+    print(f'openai compatible endpoint: {server.openai_url}')
+    print(f'generic endpoint: {server.generic_url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(server.stats.snapshot()))
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+import io
+
+import pytest
+from PIL import Image
+
+from benchmarks.mock_server import MockConfig, MockServer
+from utils.model_wrappers.image_inputs import ImageBytes
+
+
+@pytest.fixture
+def mock_server():
+    """Local mock of the Sambanova endpoints answering immediately."""
+    with MockServer(MockConfig(latency=0.0, jitter=0.0, completion_tokens=8, token_rate=0.0, seed=0)) as server:
+        yield server
+
+
+def make_png(width: int = 32, height: int = 32, color=(120, 60, 30)) -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def png_image() -> ImageBytes:
+    return ImageBytes(make_png(), mime_type='image/png')
@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+
+from benchmarks.mock_server import WORDS, MockConfig, MockServer
+from utils.model_wrappers.multimodal_models import SambastudioMultimodal
+
+ANSWER = ''.join(WORDS[index % len(WORDS)] for index in range(8))
+
+
+@pytest.fixture
+def slow_server():
+    """Mock server answering after 100 ms, long enough for concurrent requests to overlap."""
+    with MockServer(MockConfig(latency=0.1, jitter=0.0, completion_tokens=8, token_rate=0.0, seed=0)) as server:
+        yield server
+
+
+def make_lvlm(server, **kwargs) -> SambastudioMultimodal:
+    return SambastudioMultimodal(base_url=server.openai_url, api_key='k', model='m', **kwargs)
+
+
+def test_async_calls_reuse_pooled_connections(mock_server, png_image):
+    lvlm = make_lvlm(mock_server)
+
+    async def run():
+        try:
+            answers = [await lvlm.ainvoke(f'question {index}', png_image) for index in range(5)]
+            answers.append(''.join([chunk async for chunk in lvlm.astream('question 5', png_image)]))
+            return answers
+        finally:
+            await lvlm.aclose()
+
+    assert asyncio.run(run()) == [ANSWER] * 6
+    stats = mock_server.stats.snapshot()
+    assert stats['requests'] == 6
+    assert stats['connections'] == 1
+
+
+def test_max_concurrency_caps_in_flight_requests(slow_server):
+    lvlm = make_lvlm(slow_server, max_concurrency=2)
+
+    async def run():
+        try:
+            return await asyncio.gather(*[lvlm.ainvoke(f'question {index}') for index in range(6)])
+        finally:
+            await lvlm.aclose()
+
+    assert asyncio.run(run()) == [ANSWER] * 6
+    stats = slow_server.stats.snapshot()
+    assert stats['max_active'] == 2
+    assert stats['connections'] == 2
+
+
+def test_async_clients_are_bound_to_their_event_loop(mock_server):
+    lvlm = make_lvlm(mock_server)
+
+    async def use_pool():
+        await lvlm.ainvoke('question')
+        client, semaphore = lvlm._get_async_pool()
+        await lvlm.ainvoke('question')
+        assert lvlm._get_async_pool() == (client, semaphore)
+        return client
+
+    first = asyncio.run(use_pool())
+    second = asyncio.run(use_pool())
+    assert first is not second
+    # the pool of the first loop was dropped when the second loop created its own
+    assert len(lvlm._async_pools) == 1
+
+    async def close():
+        loop = asyncio.get_running_loop()
+        client, _ = lvlm._get_async_pool()
+        assert len(lvlm._async_pools) == 1
+        await lvlm.ainvoke('question')
+        await lvlm.aclose()
+        assert client.is_closed
+        assert loop not in lvlm._async_pools
+        # a closed pool is replaced on the next call
+        assert await lvlm.ainvoke('question') == ANSWER
+        assert lvlm._get_async_pool()[0] is not client
+        await lvlm.aclose()
+
+    asyncio.run(close())
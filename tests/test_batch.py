@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+from benchmarks.mock_server import WORDS, MockConfig, MockServer
+from utils.model_wrappers.multimodal_models import SambastudioMultimodal
+from utils.model_wrappers.resilience import ResiliencePolicy, RetryPolicy
+
+ANSWER = ''.join(WORDS[index % len(WORDS)] for index in range(8))
+INVALID_IMAGE = '/nonexistent/image.png'
+
+
+@pytest.fixture
+def jittery_server():
+    """Mock server with latencies between 10 and 90 ms, so calls finish out of input order."""
+    with MockServer(MockConfig(latency=0.05, jitter=0.8, completion_tokens=8, token_rate=0.0, seed=1)) as server:
+        yield server
+
+
+def make_lvlm(server) -> SambastudioMultimodal:
+    return SambastudioMultimodal(
+        base_url=server.openai_url,
+        api_key='k',
+        model='m',
+        resilience=ResiliencePolicy(retry=RetryPolicy(max_retries=0)),
+    )
+
+
+def run_batch(lvlm, method, inputs, **kwargs):
+    if method == 'batch':
+        return lvlm.batch(inputs, **kwargs)
+
+    async def run():
+        try:
+            return await lvlm.abatch(inputs, **kwargs)
+        finally:
+            await lvlm.aclose()
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize('method', ['batch', 'abatch'])
+def test_results_are_in_input_order(jittery_server, method):
+    completed = []
+    inputs = [{'prompt': f'question {index}', 'images': None} for index in range(12)]
+    results = run_batch(
+        make_lvlm(jittery_server),
+        method,
+        inputs,
+        max_concurrency=4,
+        on_progress=lambda done, total, index, result: completed.append((done, total, index)),
+    )
+    assert results == [ANSWER] * 12
+    assert [done for done, _, _ in completed] == list(range(1, 13))
+    assert {total for _, total, _ in completed} == {12}
+    assert sorted(index for _, _, index in completed) == list(range(12))
+    assert jittery_server.stats.snapshot()['requests'] == 12
+
+
+@pytest.mark.parametrize('method', ['batch', 'abatch'])
+def test_failures_are_returned_or_raised(mock_server, method):
+    inputs = [('question 0', None), ('question 1', INVALID_IMAGE), ('question 2', None)]
+    results = run_batch(make_lvlm(mock_server), method, inputs, max_concurrency=2, return_exceptions=True)
+    assert results[0] == results[2] == ANSWER
+    assert isinstance(results[1], ValueError)
+    with pytest.raises(ValueError, match='images should be provided'):
+        run_batch(make_lvlm(mock_server), method, inputs, max_concurrency=2)
+
+
+@pytest.mark.parametrize('method, window', [('batch', 2), ('abatch', 1)])
+def test_inputs_are_pulled_lazily(jittery_server, method, window):
+    max_concurrency = 3
+    pulled = []
+    outstanding = []
+
+    def inputs():
+        for index in range(20):
+            pulled.append(index)
+            yield f'question {index}', None
+
+    def on_progress(done, total, index, result):
+        assert total is None
+        outstanding.append(len(pulled) - done)
+
+    results = run_batch(
+        make_lvlm(jittery_server), method, inputs(), max_concurrency=max_concurrency, on_progress=on_progress
+    )
+    assert results == [ANSWER] * 20
+    # batch queues up to 2 * max_concurrency calls, abatch pulls an input only when a worker is free
+    assert max(outstanding) <= window * max_concurrency
+    assert jittery_server.stats.snapshot()['max_active'] <= max_concurrency
+
+
+def test_failing_progress_callback_cancels_queued_calls(jittery_server):
+    # the first input fails at once, the callback raises while the other calls are still running or queued
+    inputs = [('question 0', INVALID_IMAGE)] + [(f'question {index}', None) for index in range(1, 20)]
+
+    def on_progress(done, total, index, result):
+        raise RuntimeError('progress display failed')
+
+    with pytest.raises(RuntimeError, match='progress display failed'):
+        make_lvlm(jittery_server).batch(inputs, max_concurrency=2, return_exceptions=True, on_progress=on_progress)
+    # the call running on the other worker and at most one started right after the failure, the rest is cancelled
+    assert jittery_server.stats.snapshot()['requests'] <= 2
+
+
+def test_invalid_max_concurrency(mock_server):
+    lvlm = make_lvlm(mock_server)
+    with pytest.raises(ValueError):
+        lvlm.batch([], max_concurrency=0)
+    with pytest.raises(ValueError):
+        asyncio.run(lvlm.abatch([], max_concurrency=0))
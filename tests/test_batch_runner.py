@@ -0,0 +1,134 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from benchmarks.mock_server import WORDS
+from tests.conftest import make_png
+from utils.batch.runner import BatchRunner, ResultWriter, iter_manifest
+from utils.model_wrappers.multimodal_models import SambastudioMultimodal
+from utils.model_wrappers.resilience import ResiliencePolicy, RetryPolicy
+
+ANSWER = ''.join(WORDS[index % len(WORDS)] for index in range(8))
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    """Manifest of three tasks, the images are written next to it."""
+    (tmp_path / 'images').mkdir()
+    for name in ('a', 'b', 'c'):
+        (tmp_path / 'images' / f'{name}.png').write_bytes(make_png())
+    path = tmp_path / 'manifest.jsonl'
+    path.write_text(
+        ''.join(
+            json.dumps({'id': name, 'prompt': f'Describe {name}', 'image': f'images/{name}.png'}) + '\n'
+            for name in ('a', 'b', 'c')
+        )
+    )
+    return path
+
+
+def run(server, output, tasks, **kwargs):
+    lvlm = SambastudioMultimodal(
+        base_url=server.openai_url,
+        api_key='k',
+        model='m',
+        resilience=ResiliencePolicy(retry=RetryPolicy(max_retries=0)),
+    )
+    writer = ResultWriter(str(output))
+    try:
+        with ThreadPoolExecutor(2) as executor:
+            runner = BatchRunner(lvlm, writer, executor=executor, max_concurrency=2, encode_workers=2, max_side=16)
+            return runner.run(tasks, **kwargs)
+    finally:
+        writer.close()
+
+
+def read_records(output):
+    return [json.loads(line) for line in output.read_text().splitlines()]
+
+
+def record_line(task_id, status='ok'):
+    return json.dumps({'id': task_id, 'prompt': '', 'images': [], 'status': status}) + '\n'
+
+
+def test_manifest_paths_are_relative_to_the_manifest(manifest, tmp_path):
+    manifest.write_text(manifest.read_text() + '\n{"prompt": "p", "images": ["https://example.com/x.png", "d.png"]}\n')
+    tasks = list(iter_manifest(str(manifest)))
+    assert tasks[0] == ('a', 'Describe a', [str(tmp_path / 'images' / 'a.png')])
+    assert tasks[3] == ('line-5', 'p', ['https://example.com/x.png', str(tmp_path / 'd.png')])
+
+
+def test_run_records_every_task(mock_server, manifest, tmp_path):
+    output = tmp_path / 'out' / 'results.jsonl'
+    summary = run(mock_server, output, iter_manifest(str(manifest)))
+    assert (summary['ok'], summary['error'], summary['skipped']) == (3, 0, 0)
+    records = read_records(output)
+    assert sorted(record['id'] for record in records) == ['a', 'b', 'c']
+    assert all(record['status'] == 'ok' and record['response'] == ANSWER for record in records)
+
+
+@pytest.mark.parametrize('torn', ['{"id": "c", "status": "o', '{"id": "c", "prompt": "' + 'x' * 100_000])
+def test_torn_last_line_is_truncated_and_its_task_rerun(mock_server, manifest, tmp_path, torn):
+    output = tmp_path / 'results.jsonl'
+    output.write_text(record_line('a') + record_line('b') + torn)
+    summary = run(mock_server, output, iter_manifest(str(manifest)))
+    assert (summary['ok'], summary['skipped']) == (1, 2)
+    assert mock_server.stats.snapshot()['requests'] == 1
+    assert [record['id'] for record in read_records(output)] == ['a', 'b', 'c']
+
+
+def test_torn_only_line_empties_the_results(tmp_path):
+    output = tmp_path / 'results.jsonl'
+    output.write_text('{"id": "a", "sta')
+    writer = ResultWriter(str(output))
+    writer.close()
+    assert output.read_bytes() == b''
+
+
+def test_rerun_skips_the_recorded_tasks(mock_server, manifest, tmp_path):
+    output = tmp_path / 'results.jsonl'
+    run(mock_server, output, iter_manifest(str(manifest)))
+    summary = run(mock_server, output, iter_manifest(str(manifest)))
+    assert (summary['ok'], summary['error'], summary['skipped']) == (0, 0, 3)
+    assert mock_server.stats.snapshot()['requests'] == 3
+    assert len(read_records(output)) == 3
+
+
+@pytest.mark.parametrize('retry_failed', [True, False])
+def test_failed_tasks_are_rerun_unless_disabled(mock_server, manifest, tmp_path, retry_failed):
+    output = tmp_path / 'results.jsonl'
+    (tmp_path / 'images' / 'b.png').rename(tmp_path / 'b.png')
+    first = run(mock_server, output, iter_manifest(str(manifest)))
+    assert (first['ok'], first['error']) == (2, 1)
+    failed = next(record for record in read_records(output) if record['id'] == 'b')
+    assert failed['status'] == 'error' and failed['error'].startswith('FileNotFoundError')
+
+    (tmp_path / 'b.png').rename(tmp_path / 'images' / 'b.png')
+    second = run(mock_server, output, iter_manifest(str(manifest)), retry_failed=retry_failed)
+    if retry_failed:
+        assert (second['ok'], second['skipped']) == (1, 2)
+        assert [record['status'] for record in read_records(output) if record['id'] == 'b'] == ['error', 'ok']
+    else:
+        assert (second['ok'], second['skipped']) == (0, 3)
+    assert mock_server.stats.snapshot()['requests'] == 2 + retry_failed
+
+
+def test_duplicate_ids_run_once(mock_server, manifest, tmp_path):
+    manifest.write_text(manifest.read_text() * 2)
+    output = tmp_path / 'results.jsonl'
+    summary = run(mock_server, output, iter_manifest(str(manifest)))
+    assert (summary['ok'], summary['skipped']) == (3, 3)
+    assert mock_server.stats.snapshot()['requests'] == 3
+    assert sorted(record['id'] for record in read_records(output)) == ['a', 'b', 'c']
+
+
+def test_completed_keeps_the_latest_status(tmp_path):
+    output = tmp_path / 'results.jsonl'
+    output.write_text(record_line('a', 'error') + record_line('a') + record_line('b', 'error'))
+    writer = ResultWriter(str(output))
+    try:
+        assert writer.completed() == {'a'}
+        assert writer.completed(retry_failed=False) == {'a', 'b'}
+    finally:
+        writer.close()
@@ -0,0 +1,144 @@
+import sqlite3
+import time
+
+import pytest
+
+from utils.storage.history_store import HistoryStore
+from utils.ui.history_view import page_bounds, page_count
+
+
+@pytest.fixture
+def store(tmp_path):
+    return HistoryStore(str(tmp_path / 'history.sqlite'), window=4, max_sessions=2)
+
+
+def fill(store, turns, session_id='s', conversation='default'):
+    for index in range(turns):
+        store.append(session_id, f'q{index}', f'r{index}', conversation=conversation)
+
+
+def turns_of(messages):
+    """Queries of the previous turns included in messages, the new query excluded."""
+    return [message['content'] for message in messages[:-1] if message['role'] == 'user']
+
+
+def test_append_count_recent_and_page(store):
+    fill(store, 10)
+    assert store.count('s') == 10
+    assert [turn['turn'] for turn in store.recent('s')] == [6, 7, 8, 9]
+    assert [turn['query'] for turn in store.page('s', 2, 5)] == ['q2', 'q3', 'q4']
+    assert store.page('s', 10, 20) == []
+    assert store.count('other') == 0
+    assert store.count('s', conversation='assistant') == 0
+
+
+def test_metrics_round_trip(store):
+    store.append('s', 'q', 'r', metrics={'tokens': 3})
+    assert store.recent('s')[0]['metrics'] == {'tokens': 3}
+    assert store.page('s', 0, 1)[0]['metrics'] == {'tokens': 3}
+
+
+def test_windows_are_reloaded_from_sqlite(store, tmp_path):
+    fill(store, 6, session_id='a')
+    fill(store, 1, session_id='b')
+    fill(store, 1, session_id='c')
+    # only the 2 most recently used conversations stay in memory
+    assert store.stats() == {'conversations': 2, 'turns_in_memory': 2}
+    assert [turn['query'] for turn in store.recent('a')] == ['q2', 'q3', 'q4', 'q5']
+    assert store.append('a', 'q6', 'r6') == 6
+    reopened = HistoryStore(str(tmp_path / 'history.sqlite'), window=4)
+    assert reopened.count('a') == 7
+    assert [turn['query'] for turn in reopened.recent('a')] == ['q3', 'q4', 'q5', 'q6']
+
+
+def test_expired_turns_do_not_reuse_turn_numbers(tmp_path):
+    path = str(tmp_path / 'history.sqlite')
+    fill(HistoryStore(path), 4)
+    connection = sqlite3.connect(path)
+    connection.execute('UPDATE turns SET created_at = ? WHERE turn < 2', (time.time() - 3600,))
+    connection.commit()
+    connection.close()
+    store = HistoryStore(path, max_age=60)
+    assert [turn['turn'] for turn in store.recent('s')] == [2, 3]
+    assert store.append('s', 'q4', 'r4') == 4
+
+
+def test_clear(store):
+    fill(store, 3)
+    store.clear('s')
+    assert store.count('s') == 0
+    assert store.page('s', 0, 10) == []
+
+
+def test_build_messages_fits_the_budget(store):
+    fill(store, 4)
+    # each turn costs 4 characters, the query 5 and the system prompt 6
+    messages = store.build_messages('s', 'query', system_prompt='system', max_tokens=5 + 6 + 8, estimate=len)
+    assert messages[0] == {'role': 'system', 'content': 'system'}
+    assert messages[-1] == {'role': 'user', 'content': 'query'}
+    assert turns_of(messages) == ['q2', 'q3']
+    assert messages[1:-1] == [
+        {'role': 'user', 'content': 'q2'},
+        {'role': 'assistant', 'content': 'r2'},
+        {'role': 'user', 'content': 'q3'},
+        {'role': 'assistant', 'content': 'r3'},
+    ]
+
+
+def test_build_messages_always_includes_the_query(store):
+    fill(store, 2)
+    messages = store.build_messages('s', 'a long query', max_tokens=1, estimate=len)
+    assert messages == [{'role': 'user', 'content': 'a long query'}]
+
+
+def test_build_messages_stops_at_the_first_turn_over_budget(store):
+    store.append('s', 'q0', 'r0')
+    store.append('s', 'a much longer question', 'r1')
+    store.append('s', 'q2', 'r2')
+    messages = store.build_messages('s', 'q', max_tokens=1 + 8 + 4 + 8, estimate=len)
+    # q0 would fit but is older than the turn over budget, the included turns stay contiguous
+    assert turns_of(messages) == ['q2']
+
+
+@pytest.mark.parametrize(
+    'turns, included',
+    [
+        # 3 turns fit, the first included turn is rounded up to a multiple of 2
+        (6, ['q4', 'q5']),
+        (7, ['q4', 'q5', 'q6']),
+        (8, ['q6', 'q7']),
+    ],
+)
+def test_build_messages_align_keeps_the_prefix_stable(tmp_path, turns, included):
+    store = HistoryStore(str(tmp_path / 'history.sqlite'), window=10)
+    fill(store, turns)
+    messages = store.build_messages('s', 'q', max_tokens=1 + 3 * 4, estimate=len, align=2)
+    assert turns_of(messages) == included
+
+
+def test_consecutive_aligned_calls_share_their_prefix(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.sqlite'), window=20)
+    fill(store, 9)
+    # every text costs 1 token, there is room for 4 turns
+    previous = store.build_messages('s', 'q', max_tokens=1 + 4 * 2, estimate=lambda text: 1, align=4)
+    # the messages of the 9th to 12th turns all start at turn 8 and only append to the previous ones
+    for index in range(9, 12):
+        store.append('s', f'q{index}', f'r{index}')
+        messages = store.build_messages('s', 'q', max_tokens=1 + 4 * 2, estimate=lambda text: 1, align=4)
+        assert turns_of(messages)[0] == 'q8'
+        assert messages[: len(previous) - 1] == previous[:-1]
+        previous = messages
+
+
+@pytest.mark.parametrize(
+    'older, page_size, pages, bounds',
+    [
+        (0, 5, 0, []),
+        (3, 5, 1, [(0, 3)]),
+        (5, 5, 1, [(0, 5)]),
+        (12, 5, 3, [(0, 2), (2, 7), (7, 12)]),
+    ],
+)
+def test_history_pages(older, page_size, pages, bounds):
+    assert page_count(older, page_size) == pages
+    assert [page_bounds(older, page_size, page) for page in range(1, pages + 1)] == bounds
@@ -0,0 +1,45 @@
+import io
+
+from PIL import Image
+
+from utils.ui.image_cache import DecodedImageCache, _crop, content_digest, image_nbytes
+
+from tests.conftest import make_png
+
+
+def test_decoded_images_are_shared_per_digest():
+    cache = DecodedImageCache()
+    data = make_png(16, 16)
+    image = cache.get(content_digest(data), data)
+    assert image.size == (16, 16)
+    assert cache.get(content_digest(data), data) is image
+    assert cache.nbytes == image_nbytes(image) == 16 * 16 * 3
+
+
+def test_decoded_images_are_bounded_by_bytes():
+    images = [make_png(100, 100, (index, 0, 0)) for index in range(4)]
+    cache = DecodedImageCache(max_bytes=2 * 100 * 100 * 3)
+    for data in images[:3]:
+        cache.get(content_digest(data), data)
+    assert len(cache) == 2
+    assert cache.nbytes == 2 * 100 * 100 * 3
+    # the least recently used image is evicted first
+    cache.get(content_digest(images[1]), images[1])
+    cache.get(content_digest(images[3]), images[3])
+    assert set(cache._images) == {content_digest(images[1]), content_digest(images[3])}
+
+
+def test_an_image_larger_than_the_budget_is_still_returned_and_kept_alone():
+    cache = DecodedImageCache(max_bytes=10)
+    small, large = make_png(2, 2), make_png(50, 50)
+    cache.get(content_digest(small), small)
+    assert cache.get(content_digest(large), large).size == (50, 50)
+    assert list(cache._images) == [content_digest(large)]
+
+
+def test_crop_maps_preview_boxes_to_full_resolution():
+    image = Image.new('RGB', (1400, 700))
+    preview = image.resize((700, 350))
+    cropped, preview_bytes = _crop((100, 50, 200, 100), image, preview)
+    assert cropped.size == (400, 200)
+    assert Image.open(io.BytesIO(preview_bytes)).size == (200, 100)
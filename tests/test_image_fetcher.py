@@ -0,0 +1,124 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from utils.model_wrappers.image_fetcher import ImageFetcher, ImageFetchError
+from utils.model_wrappers.multimodal_models import SambastudioMultimodal
+from utils.model_wrappers.resilience import CircuitBreaker, ResiliencePolicy, RetryPolicy
+
+from tests.conftest import make_png
+
+PNG = make_png()
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.headers.get('If-None-Match')))
+        route = server.routes.get(self.path)
+        if route is None:
+            status, headers, body = 404, {}, b''
+        else:
+            status, headers, body = route
+        if status == 200 and headers.get('ETag') and self.headers.get('If-None-Match') == headers['ETag']:
+            status, body = 304, b''
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def image_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+    server.daemon_threads = True
+    server.routes = {
+        '/image.png': (200, {'Content-Type': 'image/png', 'ETag': '"v1"'}, PNG),
+        '/page.html': (200, {'Content-Type': 'text/html'}, b'<html></html>'),
+        '/large.png': (200, {'Content-Type': 'image/png'}, b'\x89PNG\r\n\x1a\n' + b'0' * 4096),
+        '/unavailable.png': (503, {}, b''),
+    }
+    server.requests = []
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_fetcher(cache_dir=None, max_bytes=1024 * 1024) -> ImageFetcher:
+    resilience = ResiliencePolicy(
+        retry=RetryPolicy(max_retries=0), circuit_breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    )
+    return ImageFetcher(max_bytes=max_bytes, cache_dir=cache_dir, resilience=resilience)
+
+
+def test_cached_images_are_revalidated(image_server, tmp_path):
+    fetcher = make_fetcher(str(tmp_path / 'images'))
+    url = f'{image_server.url}/image.png'
+    assert bytes(fetcher.fetch(url).data) == PNG
+    image = fetcher.fetch(url)
+    assert bytes(image.data) == PNG
+    assert image.mime_type == 'image/png'
+    assert image_server.requests == [('/image.png', None), ('/image.png', '"v1"')]
+
+
+def test_evicted_cached_body_is_downloaded_again(image_server, tmp_path, monkeypatch):
+    fetcher = make_fetcher(str(tmp_path / 'images'))
+    url = f'{image_server.url}/image.png'
+    fetcher.fetch(url)
+    cached = fetcher._cached(url)
+    # the body is evicted after the cache lookup, before the 304 answer
+    monkeypatch.setattr(fetcher, '_cached', lambda url: cached)
+    os.remove(fetcher.store.path(cached['digest']))
+    assert bytes(fetcher.fetch(url).data) == PNG
+    assert image_server.requests[-2:] == [('/image.png', '"v1"'), ('/image.png', None)]
+
+
+def test_errors_are_image_fetch_errors(image_server):
+    fetcher = make_fetcher(max_bytes=1024)
+    with pytest.raises(ImageFetchError, match='does not link to an image'):
+        fetcher.fetch(f'{image_server.url}/page.html')
+    with pytest.raises(ImageFetchError, match='larger than'):
+        fetcher.fetch(f'{image_server.url}/large.png')
+    with pytest.raises(ImageFetchError, match='status code 404'):
+        fetcher.fetch(f'{image_server.url}/missing.png')
+    with pytest.raises(ImageFetchError):
+        fetcher.fetch('http://127.0.0.1:1/image.png')
+
+
+def test_open_circuit_is_an_image_fetch_error(image_server):
+    fetcher = make_fetcher()
+    url = f'{image_server.url}/unavailable.png'
+    for _ in range(2):
+        with pytest.raises(ImageFetchError, match='status code 503'):
+            fetcher.fetch(url)
+    with pytest.raises(ImageFetchError, match='circuit open'):
+        fetcher.fetch(url)
+    assert len(image_server.requests) == 2
+
+
+def test_failing_image_host_does_not_open_the_model_api_circuit(image_server, mock_server, png_image):
+    lvlm = SambastudioMultimodal(
+        base_url=mock_server.openai_url,
+        api_key='k',
+        model='m',
+        resilience=ResiliencePolicy(
+            retry=RetryPolicy(max_retries=0), circuit_breaker=CircuitBreaker(failure_threshold=2)
+        ),
+    )
+    for _ in range(3):
+        with pytest.raises(ImageFetchError):
+            lvlm.invoke('describe', f'{image_server.url}/unavailable.png')
+    assert lvlm.resilience.circuit_breaker.state == 'closed'
+    assert lvlm.invoke('describe', png_image.b64)
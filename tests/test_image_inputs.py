@@ -0,0 +1,55 @@
+import base64
+
+import pytest
+
+from utils.model_wrappers.image_inputs import Base64Image, ImageBytes, ImagePath, ImageURL, detect_image_input
+from utils.model_wrappers.multimodal_models import SambastudioMultimodal
+
+
+@pytest.mark.parametrize('size', [0, 1, 2, 3, 4, 5, 100])
+def test_length_of_base64_images_is_exact(size):
+    data = bytes(range(size))
+    assert len(ImageBytes(b64=base64.b64encode(data).decode())) == size
+    assert len(ImageBytes(data)) == size
+
+
+def test_detect_image_input(tmp_path, png_image):
+    path = tmp_path / 'image.png'
+    path.write_bytes(png_image.data)
+    assert isinstance(detect_image_input(str(path)), ImagePath)
+    assert isinstance(detect_image_input('https://example.com/image'), ImageURL)
+    assert isinstance(detect_image_input(png_image.b64), Base64Image)
+    with pytest.raises(ValueError):
+        detect_image_input('not an image')
+
+
+def test_image_path_mapping_is_closed(tmp_path, png_image):
+    path = tmp_path / 'image.png'
+    path.write_bytes(png_image.data)
+    with ImagePath(path).load() as image:
+        assert bytes(image.data) == png_image.data
+        assert image.mime_type == 'image/png'
+    assert image.data.closed
+
+
+def test_wrapper_closes_the_mapped_files_it_opens(tmp_path, png_image, mock_server, monkeypatch):
+    path = tmp_path / 'image.png'
+    path.write_bytes(png_image.data)
+    loaded = []
+    load = ImagePath.load
+
+    def tracked_load(self):
+        image = load(self)
+        loaded.append(image)
+        return image
+
+    monkeypatch.setattr(ImagePath, 'load', tracked_load)
+    lvlm = SambastudioMultimodal(base_url=mock_server.openai_url, api_key='k', model='m')
+    lvlm.invoke('describe', str(path))
+    assert ''.join(lvlm.stream('describe', str(path)))
+    assert len(loaded) == 2
+    assert all(image.data.closed for image in loaded)
+    # images given by the caller are left open
+    with ImagePath(path).load() as image:
+        lvlm.invoke('describe', image)
+        assert not image.data.closed
@@ -0,0 +1,96 @@
+import io
+import threading
+
+import pytest
+from PIL import Image
+
+from utils.model_wrappers.image_preprocessing import ImagePreprocessor
+
+from tests.conftest import make_png
+
+
+def make_jpeg(width: int, height: int, mode: str = 'RGB') -> bytes:
+    buffer = io.BytesIO()
+    Image.new(mode, (width, height), 128).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def opened(data: bytes) -> Image.Image:
+    return Image.open(io.BytesIO(data))
+
+
+def test_matching_images_are_returned_unchanged():
+    data = make_jpeg(64, 32)
+    processed, report = ImagePreprocessor(max_side=64).process(data)
+    assert processed is data
+    assert report['bytes_before'] == report['bytes_after'] == len(data)
+    assert report['size_before'] == report['size_after'] == (64, 32)
+
+
+def test_large_images_are_downsized_keeping_the_aspect_ratio():
+    processed, report = ImagePreprocessor(max_side=100).process(make_jpeg(400, 200))
+    assert opened(processed).size == (100, 50)
+    assert report['size_before'] == (400, 200)
+    assert report['size_after'] == (100, 50)
+    assert report['bytes_after'] == len(processed)
+    assert report['format'] == 'JPEG'
+
+
+@pytest.mark.parametrize(
+    'image_format, mime_type', [('JPEG', 'image/jpeg'), ('PNG', 'image/png'), ('WEBP', 'image/webp')]
+)
+def test_images_are_converted_to_the_target_format(image_format, mime_type):
+    preprocessor = ImagePreprocessor(max_side=None, image_format=image_format)
+    processed, _ = preprocessor.process(make_png(40, 30))
+    assert opened(processed).format == image_format
+    assert opened(processed).size == (40, 30)
+    assert preprocessor.mime_type == mime_type
+
+
+def test_transparent_png_is_flattened_for_jpeg():
+    buffer = io.BytesIO()
+    Image.new('RGBA', (16, 16), (255, 0, 0, 128)).save(buffer, format='PNG')
+    processed, _ = ImagePreprocessor().process(buffer.getvalue())
+    assert opened(processed).mode == 'RGB'
+
+
+def test_grayscale_conversion():
+    preprocessor = ImagePreprocessor(grayscale=True)
+    processed, _ = preprocessor.process(make_jpeg(32, 32))
+    assert opened(processed).mode == 'L'
+    # already single channel JPEG images are left as is
+    assert preprocessor.process(processed)[0] is processed
+
+
+def test_unsupported_format():
+    with pytest.raises(ValueError, match='Unsupported image format'):
+        ImagePreprocessor(image_format='TIFF')
+    assert ImagePreprocessor(image_format='jpg').image_format == 'JPEG'
+
+
+def test_process_image_reports_the_raw_pixel_size():
+    processed, report = ImagePreprocessor(max_side=50).process_image(Image.new('RGB', (200, 100)))
+    assert report['bytes_before'] == 200 * 100 * 3
+    assert report['bytes_after'] == len(processed)
+    assert report['size_after'] == opened(processed).size == (50, 25)
+    assert report['encode_seconds'] >= 0
+
+
+def test_concurrent_reports_are_per_call_and_totals_add_up():
+    preprocessor = ImagePreprocessor(max_side=64)
+    sizes = [(64 + index * 16, 32) for index in range(8)]
+    reports = {}
+
+    def process(size):
+        reports[size] = preprocessor.process_image(Image.new('RGB', size))[1]
+
+    threads = [threading.Thread(target=process, args=(size,)) for size in sizes]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert {size: report['size_before'] for size, report in reports.items()} == {size: size for size in sizes}
+    stats = preprocessor.stats()
+    assert stats['bytes_before'] == sum(report['bytes_before'] for report in reports.values())
+    assert stats['bytes_after'] == sum(report['bytes_after'] for report in reports.values())
+    assert stats['compression_ratio'] == stats['bytes_after'] / stats['bytes_before']
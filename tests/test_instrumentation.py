@@ -0,0 +1,196 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from utils.model_wrappers.instrumentation import (
+    NULL_TRACE,
+    CallTrace,
+    InstrumentationHook,
+    MetricsRegistry,
+    RegistryHook,
+    current_trace,
+    trace_chat_stream,
+    use_trace,
+)
+from utils.model_wrappers.multimodal_models import SambastudioMultimodal
+
+
+class RecordingHook(InstrumentationHook):
+    def __init__(self) -> None:
+        self.traces = []
+
+    def on_call_end(self, trace: CallTrace) -> None:
+        self.traces.append(trace)
+
+
+@pytest.mark.parametrize(
+    'values, quantile, expected',
+    [
+        (range(1, 11), 0.5, 5),
+        (range(1, 12), 0.5, 6),
+        ([1, 2], 0.5, 1),
+        ([1], 0.99, 1),
+        (range(1, 101), 0.95, 95),
+        (range(1, 101), 0.99, 99),
+        (range(1, 101), 0.07, 7),
+        (range(1, 21), 0.95, 19),
+        (range(1, 11), 0.99, 10),
+    ],
+)
+def test_nearest_rank_quantiles(values, quantile, expected):
+    assert MetricsRegistry._quantile(sorted(values), quantile) == expected
+
+
+def test_summaries_and_counters():
+    registry = MetricsRegistry(window=3)
+    for value in (10, 1, 2, 3):
+        registry.observe('latency', value, {'method': 'invoke'})
+    registry.increment('calls', {'status': 'ok'})
+    registry.increment('calls', {'status': 'ok'}, amount=2)
+    snapshot = registry.snapshot()
+    [summary] = snapshot['summaries']['latency']
+    # count and sum cover every observation, the quantiles only the last window ones
+    assert summary['count'] == 4
+    assert summary['sum'] == 16
+    assert summary['quantiles'] == {'0.5': 2, '0.95': 3, '0.99': 3}
+    assert snapshot['counters']['calls'] == [{'labels': {'status': 'ok'}, 'value': 3}]
+    registry.reset()
+    assert registry.snapshot() == {'summaries': {}, 'counters': {}}
+
+
+def test_prometheus_export_escapes_labels():
+    registry = MetricsRegistry()
+    registry.observe('model_total_seconds', 0.5, {'client': 'a"b\\c\nd'})
+    registry.increment('model_calls_total', {'status': 'ok'})
+    assert registry.to_prometheus().splitlines() == [
+        '# TYPE model_total_seconds summary',
+        'model_total_seconds{client="a\\"b\\\\c\\nd",quantile="0.5"} 0.5',
+        'model_total_seconds{client="a\\"b\\\\c\\nd",quantile="0.95"} 0.5',
+        'model_total_seconds{client="a\\"b\\\\c\\nd",quantile="0.99"} 0.5',
+        'model_total_seconds_sum{client="a\\"b\\\\c\\nd"} 0.5',
+        'model_total_seconds_count{client="a\\"b\\\\c\\nd"} 1',
+        '# TYPE model_calls_total counter',
+        'model_calls_total{status="ok"} 1',
+    ]
+
+
+def test_file_exports(tmp_path):
+    registry = MetricsRegistry()
+    registry.observe('metric', 1.0)
+    registry.export(str(tmp_path / 'metrics.json'), format='json')
+    assert json.loads((tmp_path / 'metrics.json').read_text()) == registry.snapshot()
+    registry.export(str(tmp_path / 'metrics.prom'))
+    assert (tmp_path / 'metrics.prom').read_text() == registry.to_prometheus()
+    with pytest.raises(ValueError):
+        registry.export(str(tmp_path / 'metrics.txt'), format='csv')
+
+
+def test_trace_is_finished_once_and_sent_to_the_hooks():
+    hook = RecordingHook()
+    trace = CallTrace('lvlm', 'invoke', 'openai', hooks=[hook])
+    with trace.span('load'):
+        pass
+    with trace.span('load'):
+        pass
+    trace.mark('ttfb')
+    first_ttfb = trace.spans['ttfb']
+    trace.mark('ttfb')
+    trace.set('payload_bytes', 10)
+    trace.set('skipped', None)
+    trace.set_usage({'prompt_tokens': 3, 'completion_tokens': 4, 'prompt_tokens_details': {'cached_tokens': 2}})
+    trace.finish(RuntimeError('failed'))
+    trace.finish()
+    assert hook.traces == [trace]
+    assert trace.spans['ttfb'] == first_ttfb
+    assert set(trace.spans) == {'load', 'ttfb', 'total'}
+    assert trace.values == {'payload_bytes': 10, 'prompt_tokens': 3, 'completion_tokens': 4, 'cached_tokens': 2}
+    assert trace.error == 'RuntimeError'
+
+
+def test_registry_hook_records_spans_values_and_status():
+    registry = MetricsRegistry()
+    trace = CallTrace('lvlm', 'invoke', 'openai', hooks=[RegistryHook(registry)])
+    trace.set('payload_bytes', 100)
+    trace.finish(ValueError())
+    snapshot = registry.snapshot()
+    assert set(snapshot['summaries']) == {'model_total_seconds', 'model_payload_bytes'}
+    labels = {'client': 'lvlm', 'method': 'invoke', 'endpoint': 'openai'}
+    assert snapshot['summaries']['model_payload_bytes'][0]['labels'] == labels
+    assert snapshot['counters']['model_calls_total'] == [
+        {'labels': {**labels, 'status': 'error', 'error': 'ValueError'}, 'value': 1}
+    ]
+
+
+def test_null_trace_ignores_writes():
+    assert current_trace() is NULL_TRACE
+    NULL_TRACE.status_code = 500
+    NULL_TRACE.set('payload_bytes', 1)
+    NULL_TRACE.mark('ttfb')
+    with NULL_TRACE.span('load'):
+        pass
+    NULL_TRACE.finish(RuntimeError())
+    assert NULL_TRACE.status_code is None
+    assert NULL_TRACE.spans == {}
+    assert NULL_TRACE.values == {}
+    assert NULL_TRACE.error is None
+
+
+def test_use_trace_restores_the_previous_trace():
+    trace = CallTrace('lvlm', 'invoke')
+    with use_trace(trace):
+        assert current_trace() is trace
+    assert current_trace() is NULL_TRACE
+
+
+def chunk(content=None, usage=None):
+    choices = [SimpleNamespace(delta=SimpleNamespace(content=content))] if content is not None else []
+    return SimpleNamespace(
+        choices=choices, usage=SimpleNamespace(model_dump=lambda: usage) if usage is not None else None
+    )
+
+
+def test_trace_chat_stream():
+    hook = RecordingHook()
+    trace = CallTrace('assistant', 'stream', 'openai', hooks=[hook])
+    stream = [chunk('a'), chunk(''), chunk('b'), chunk(usage={'prompt_tokens': 5, 'completion_tokens': 2})]
+    assert list(trace_chat_stream(stream, trace)) == ['a', 'b']
+    assert hook.traces == [trace]
+    assert 'ttft' in trace.spans
+    assert trace.values == {'prompt_tokens': 5, 'completion_tokens': 2}
+
+
+def test_trace_chat_stream_failures_and_early_close():
+    def failing():
+        yield chunk('a')
+        raise ConnectionError()
+
+    trace = CallTrace('assistant', 'stream')
+    with pytest.raises(ConnectionError):
+        list(trace_chat_stream(failing(), trace))
+    assert trace.finished and trace.error == 'ConnectionError'
+
+    trace = CallTrace('assistant', 'stream')
+    stream = trace_chat_stream([chunk('a'), chunk('b')], trace)
+    next(stream)
+    stream.close()
+    assert trace.finished and trace.error is None
+
+
+@pytest.mark.parametrize('method', ['invoke', 'stream'])
+def test_wrapper_calls_are_traced(mock_server, png_image, method):
+    hook = RecordingHook()
+    lvlm = SambastudioMultimodal(base_url=mock_server.openai_url, api_key='k', model='m', hooks=[hook])
+    if method == 'invoke':
+        lvlm.invoke('describe', png_image)
+    else:
+        ''.join(lvlm.stream('describe', png_image))
+    [trace] = hook.traces
+    assert trace.labels == {'client': 'lvlm', 'method': method, 'endpoint': 'openai'}
+    assert trace.status_code == 200
+    assert trace.error is None
+    assert {'load', 'send', 'ttfb', 'total'} <= set(trace.spans)
+    assert trace.values['payload_bytes'] == mock_server.stats.snapshot()['request_bytes']
+    assert trace.values['completion_tokens'] == 8
+    # calls outside any trace leave the shared null trace untouched
+    assert NULL_TRACE.status_code is None
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from utils.analysis.microstructure import MicrostructureAnalyzer, answer_quantitative, quantitative_topics
+
+
+@pytest.fixture(scope='module')
+def report():
+    gray = np.full((128, 128), 170, dtype=np.uint8)
+    gray[:, 64:] = 110
+    gray[20:26, 20:26] = 10
+    gray[90:95, 100:105] = 10
+    return MicrostructureAnalyzer().analyze_array(gray)
+
+
+@pytest.mark.parametrize(
+    'query, topics',
+    [
+        ('What is the porosity percentage?', ['porosity']),
+        ('How many pores are there?', ['porosity']),
+        ('What is the average grain size?', ['grains']),
+        ('Count the grains', ['grains']),
+        ('What are the phase fractions?', ['phases']),
+        ('How much porosity and what mean grain diameter?', ['porosity', 'grains']),
+        ('What is the ASTM grain size number?', ['grains']),
+        ('How big are the grains?', ['grains']),
+        ('What is the area fraction of each phase?', ['phases']),
+        ('What is the mean grain size and the porosity?', ['grains', 'porosity']),
+    ],
+)
+def test_numeric_questions_are_answered_locally(query, topics, report):
+    assert quantitative_topics(query) == topics
+    answer = answer_quantitative(query, [report])
+    assert answer.startswith('Measured locally from the image:')
+
+
+@pytest.mark.parametrize(
+    'query',
+    [
+        'Where are the pores located?',
+        'Are the pores spherical?',
+        'What shape are the grains?',
+        'Is there porosity?',
+        'How are the pores distributed?',
+        'Are the grains of uniform size?',
+        'How many pores are there and why did they form?',
+        'Tell me about the grains',
+        'porosity',
+        'Describe the microstructure',
+        # the phase count is a parameter of the analyzer, not a measurement
+        'How many phases are present?',
+        # precipitates are not measured, the grain diameters do not answer it
+        'What is the average size of the precipitates in the grains?',
+        # only the mean, median and p10-p90 of the grain diameters are reported
+        'How big is the biggest grain?',
+        'What is the maximum pore area?',
+    ],
+)
+def test_other_questions_go_to_the_model(query, report):
+    assert quantitative_topics(query) == []
+    assert answer_quantitative(query, [report]) is None
+
+
+def test_no_local_answer_without_measurements():
+    assert answer_quantitative('What is the porosity percentage?', []) is None
+
+
+def test_lengths_are_reported_in_micrometers_of_the_original_image():
+    gray = np.full((400, 400), 200, dtype=np.uint8)
+    gray[100:140, 100:140] = 0
+    full = MicrostructureAnalyzer(max_side=400).analyze_array(gray, pixel_size=1.0)
+    # a downscaled copy with the pixel size scaled by the same factor measures the same pore area in µm²
+    half = MicrostructureAnalyzer(max_side=400).analyze_array(gray[::2, ::2], pixel_size=2.0)
+    assert full['unit'] == half['unit'] == 'um'
+    assert full['porosity']['mean_area'] == pytest.approx(1600, rel=0.1)
+    assert half['porosity']['mean_area'] == pytest.approx(full['porosity']['mean_area'], rel=0.1)
+    # the analyzer's own downscale is accounted for
+    reduced = MicrostructureAnalyzer(max_side=200).analyze_array(gray, pixel_size=1.0)
+    assert reduced['porosity']['mean_area'] == pytest.approx(full['porosity']['mean_area'], rel=0.1)
@@ -0,0 +1,72 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from utils.model_wrappers.image_inputs import Base64Image, ImageBytes
+from utils.model_wrappers.payload_encoder import Base64Field, StreamingJSONBody
+
+
+def payload(field_a, field_b):
+    return {
+        'model': 'Llama-3.2-11B-Vision-Instruct',
+        'messages': [
+            {
+                'role': 'user',
+                'content': [
+                    {'type': 'text', 'text': 'Décris la microstructure: 孔隙 "quoted" \\ \n'},
+                    {'type': 'image_url', 'image_url': {'url': field_a}},
+                ],
+            }
+        ],
+        'instances': [field_b],
+        'max_tokens': 512,
+        'temperature': 0.1,
+        'stream': False,
+        'stop': None,
+        'tuple': (1, 2.5, True),
+        3: 'non string key',
+    }
+
+
+def reference(image: ImageBytes) -> bytes:
+    return json.dumps(payload(image.data_uri, image.b64)).encode()
+
+
+def images():
+    # sizes which are and are not multiples of 3 and of the chunk size
+    for size in (0, 1, 2, 3, 100, 1000, 4096 * 3 + 1):
+        yield ImageBytes(b'\x89PNG\r\n\x1a\n' + os.urandom(size), mime_type='image/png')
+    yield Base64Image(ImageBytes(os.urandom(301), mime_type='image/jpeg').b64, mime_type='image/jpeg')
+
+
+@pytest.mark.parametrize('chunk_size', [3, 48, 4096 * 3])
+@pytest.mark.parametrize('image', list(images()), ids=lambda image: str(len(image)))
+def test_body_matches_json_dumps(image, chunk_size):
+    body = StreamingJSONBody(payload(Base64Field(image), Base64Field(image, data_uri=False)), chunk_size=chunk_size)
+    expected = reference(image)
+    assert body.to_bytes() == expected
+    assert len(body) == len(expected)
+    assert body.headers() == {'Content-Length': str(len(expected))}
+    assert json.loads(body.to_bytes())['instances'] == [image.b64]
+
+
+def test_body_can_be_iterated_again_and_asynchronously(png_image):
+    sent = []
+    fields = payload(Base64Field(png_image), Base64Field(png_image, data_uri=False))
+    body = StreamingJSONBody(fields, chunk_size=48, on_sent=lambda: sent.append(1))
+
+    async def collect():
+        return b''.join([chunk async for chunk in body.aiter()])
+
+    expected = reference(png_image)
+    assert b''.join(body) == expected
+    assert b''.join(body) == expected
+    assert asyncio.run(collect()) == expected
+    assert len(sent) == 3
+
+
+def test_body_without_images_matches_json_dumps():
+    value = {'a': [1, {'b': None}], 'c': 'ünïcode', 'd': []}
+    assert StreamingJSONBody(value).to_bytes() == json.dumps(value).encode()
@@ -0,0 +1,153 @@
+import io
+import json
+from concurrent.futures import Executor, Future
+
+import pytest
+from PIL import Image
+
+from utils.model_wrappers.multimodal_models import SambastudioMultimodal
+from utils.model_wrappers.payload_encoder import StreamingJSONBody
+from utils.model_wrappers.pdf_inputs import PDFDocument, load_pdf_pages, render_pdf_page
+from utils.model_wrappers.prompt_templates import PDF_CONTEXT_TEMPLATE
+
+PAGE_TEXTS = ['Ferrite grains after annealing', '', 'Pearlite colonies ' * 20]
+
+
+def make_pdf(texts) -> bytes:
+    """Builds a PDF whose pages hold one line of Helvetica text each, an empty text gives a blank page."""
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>', None, '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    kids = []
+    for text in texts:
+        content = f'BT /F1 12 Tf 72 720 Td ({text}) Tj ET' if text else ''
+        objects.append(f'<< /Length {len(content)} >>\nstream\n{content}\nendstream')
+        objects.append(
+            f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {len(objects)} 0 R '
+            '/Resources << /Font << /F1 3 0 R >> >> >>'
+        )
+        kids.append(f'{len(objects)} 0 R')
+    objects[1] = f'<< /Type /Pages /Kids [{" ".join(kids)}] /Count {len(kids)} >>'
+    pdf = b'%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += f'{number} 0 obj\n{body}\nendobj\n'.encode()
+    xref = len(pdf)
+    pdf += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode()
+    pdf += b''.join(f'{offset:010d} 00000 n \n'.encode() for offset in offsets)
+    pdf += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode()
+    return pdf
+
+
+class FakeRenderPool(Executor):
+    """Runs the page renders inline, drawing a gray JPEG per page instead of calling poppler."""
+
+    def __init__(self) -> None:
+        self.renders = []
+
+    def submit(self, fn, *args, **kwargs):
+        assert fn is render_pdf_page
+        path, page, dpi = args
+        self.renders.append((page, dpi))
+        buffer = io.BytesIO()
+        Image.new('RGB', (dpi, dpi), (page * 40, 0, 0)).save(buffer, format='JPEG')
+        future = Future()
+        future.set_result(buffer.getvalue())
+        return future
+
+
+@pytest.fixture
+def pdf_path(tmp_path):
+    path = tmp_path / 'report.pdf'
+    path.write_bytes(make_pdf(PAGE_TEXTS))
+    return str(path)
+
+
+@pytest.fixture
+def pool():
+    return FakeRenderPool()
+
+
+def test_opening_a_document_renders_nothing(pdf_path, pool):
+    document = PDFDocument(pdf_path, executor=pool)
+    assert document.page_count == 3
+    assert document.text(1) == PAGE_TEXTS[0]
+    assert document.text(2) == ''
+    assert pool.renders == []
+
+
+def test_invalid_pages_are_rejected(pdf_path, pool):
+    document = PDFDocument(pdf_path, executor=pool)
+    for page in (0, 4):
+        with pytest.raises(ValueError, match='page should be between 1 and 3'):
+            document.page(page)
+        with pytest.raises(ValueError):
+            document.text(page)
+        with pytest.raises(ValueError):
+            list(document.iter_render([page]))
+
+
+def test_rendered_pages_are_cached_per_resolution(pdf_path, pool):
+    document = PDFDocument(pdf_path, executor=pool, max_cached_pages=2)
+    image = document.render(1, dpi=100)
+    assert image.mime_type == 'image/jpeg'
+    assert Image.open(io.BytesIO(bytes(image.data))).size == (100, 100)
+    document.render(1, dpi=100)
+    document.render(1, dpi=50)
+    assert pool.renders == [(1, 100), (1, 50)]
+    # the least recently used rendering is evicted
+    document.render(2, dpi=100)
+    document.render(1, dpi=50)
+    document.render(1, dpi=100)
+    assert pool.renders == [(1, 100), (1, 50), (2, 100), (1, 100)]
+
+
+def test_iter_render_yields_cached_pages_first_and_each_page_once(pdf_path, pool):
+    document = PDFDocument(pdf_path, executor=pool)
+    document.render(3)
+    pages = [page for page, _ in document.iter_render([1, 3, 1, 2])]
+    assert pages[0] == 3
+    assert sorted(pages) == [1, 2, 3]
+    assert pool.renders == [(3, 150), (1, 150), (2, 150)]
+    assert [page for page, _ in document.iter_thumbnails([2])] == [2]
+    assert pool.renders[-1] == (2, 36)
+
+
+def test_pdf_pages_are_lazy_image_inputs(pdf_path, pool):
+    document = PDFDocument(pdf_path, executor=pool)
+    first, third = document.page(1, dpi=60), document.page(3, dpi=60)
+    assert pool.renders == []
+    assert first.text == PAGE_TEXTS[0]
+    images = load_pdf_pages([third, first, third])
+    assert [bytes(image.data) for image in images[::2]] == [bytes(images[0].data)] * 2
+    assert sorted(pool.renders) == [(1, 60), (3, 60)]
+
+
+def test_page_context_skips_blank_pages_and_truncates(pdf_path, pool):
+    document = PDFDocument(pdf_path, executor=pool)
+    context = document.context([1, 2, 3], max_chars=20)
+    assert context == f'[page 1]\n{PAGE_TEXTS[0][:20]}\n\n[page 3]\n{PAGE_TEXTS[2].strip()[:20]}'
+    prompt = PDF_CONTEXT_TEMPLATE.format(context=context, prompt='Which phases are described?')
+    assert prompt == f'Text extracted from the document pages:\n{context}\n\nWhich phases are described?'
+
+
+def test_wrapper_sends_the_rendered_pages_with_their_context(mock_server, pdf_path, pool, monkeypatch):
+    document = PDFDocument(pdf_path, executor=pool)
+    lvlm = SambastudioMultimodal(base_url=mock_server.openai_url, api_key='k', model='m')
+    payloads = []
+    build = lvlm._build_openai_payload
+
+    def record(*args, **kwargs):
+        payloads.append(build(*args, **kwargs))
+        return payloads[-1]
+
+    monkeypatch.setattr(lvlm, '_build_openai_payload', record)
+    prompt = PDF_CONTEXT_TEMPLATE.format(context=document.context([1]), prompt='Describe the page')
+    assert lvlm.invoke(prompt, [document.page(1, dpi=40), document.page(3, dpi=40)])
+    assert sorted(pool.renders) == [(1, 40), (3, 40)]
+    assert mock_server.stats.snapshot()['requests'] == 1
+    content = json.loads(StreamingJSONBody(payloads[0]).to_bytes())['messages'][0]['content']
+    assert content[0] == {'type': 'text', 'text': prompt}
+    assert PAGE_TEXTS[0] in content[0]['text']
+    urls = [part['image_url']['url'] for part in content[1:]]
+    assert len(urls) == 2
+    assert all(url.startswith('data:image/jpeg;base64,') for url in urls)
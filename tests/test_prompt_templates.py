@@ -0,0 +1,85 @@
+import pytest
+
+from utils.model_wrappers.prompt_templates import (
+    GENERIC_CHAT_TEMPLATE,
+    PromptTemplate,
+    count_prompt_tokens,
+    estimate_tokens,
+    normalize_whitespace,
+)
+
+
+def test_normalize_whitespace():
+    text = '''
+        First   line\twith  spaces
+          second line
+
+
+
+        after blank lines
+    '''
+    assert normalize_whitespace(text) == 'First line with spaces\nsecond line\n\nafter blank lines'
+    assert normalize_whitespace('already normal') == 'already normal'
+
+
+def test_format_matches_str_format_of_the_normalized_template():
+    template = PromptTemplate(
+        '''
+        Context:
+            {context}
+
+        Question: {prompt}
+        '''
+    )
+    assert template.template == 'Context:\n{context}\n\nQuestion: {prompt}'
+    values = {'context': 'a  b\n  c', 'prompt': 'why?'}
+    # values are inserted as given, only the template is normalized
+    assert template.format(**values) == template.template.format(**values)
+    assert template.fields == {'context', 'prompt'}
+    assert template.prefix == 'Context:\n'
+
+
+def test_repeated_fields_and_none_values():
+    template = PromptTemplate('{a} and {a} then {b}')
+    assert template.format(a='x', b=None) == 'x and x then '
+
+
+def test_templates_without_normalization_are_kept_verbatim():
+    template = PromptTemplate('  {prompt}  \n\n\n', normalize=False)
+    assert template.format(prompt='p') == '  p  \n\n\n'
+
+
+def test_template_without_fields():
+    template = PromptTemplate('no fields')
+    assert template.format() == 'no fields'
+    assert template.fields == set()
+
+
+def test_missing_fields_are_rejected():
+    with pytest.raises(ValueError, match="missing prompt template fields: \\['b'\\]"):
+        PromptTemplate('{a} {b}').format(a='x')
+
+
+@pytest.mark.parametrize('template', ['{}', '{0}x', '{a.b}', '{a[0]}', '{a!r}', '{a:>10}'])
+def test_unsupported_fields_are_rejected(template):
+    with pytest.raises(ValueError):
+        PromptTemplate(template)
+
+
+def test_token_count_matches_the_formatted_prompt_estimate():
+    template = PromptTemplate('Question: {prompt}\nAnswer briefly.')
+    prompt = 'x' * 400
+    assert template.token_count(prompt=prompt) == estimate_tokens(template.format(prompt=prompt))
+    assert template.token_count() == template.static_tokens
+
+
+def test_generic_chat_template():
+    prompt = GENERIC_CHAT_TEMPLATE.format(prompt='Describe the image')
+    assert prompt.startswith('A chat between a curious human')
+    assert prompt.endswith('USER: <image>\nDescribe the image\nASSISTANT:')
+    assert '  ' not in prompt
+
+
+def test_count_prompt_tokens():
+    messages = [{'role': 'system', 'content': 'x' * 40}, {'role': 'user', 'content': 'y' * 8}]
+    assert count_prompt_tokens(messages) == (10 + 1 + 4) + (2 + 1 + 4)
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+from benchmarks.mock_server import MockConfig, MockServer
+from utils.model_wrappers.multimodal_models import IMAGE_TOKENS_ESTIMATE, SambastudioMultimodal
+from utils.model_wrappers.rate_limiter import RequestScheduler, scheduling_context
+from utils.model_wrappers.resilience import ResiliencePolicy, RetryPolicy
+
+PROMPT = 'Describe the microstructure.'
+MAX_TOKENS = 512
+
+
+class RecordingScheduler(RequestScheduler):
+    def __init__(self) -> None:
+        super().__init__(requests_per_second=1000, tokens_per_minute=10**9)
+        self.settled = []
+
+    def settle(self, ticket, actual_tokens):
+        self.settled.append((ticket.tokens, actual_tokens))
+        super().settle(ticket, actual_tokens)
+
+
+def make_lvlm(server, endpoint: str, scheduler: RequestScheduler) -> SambastudioMultimodal:
+    return SambastudioMultimodal(
+        base_url=server.openai_url if endpoint == 'openai' else server.generic_url,
+        api_key='k',
+        model='m',
+        max_tokens_to_generate=MAX_TOKENS,
+        scheduler=scheduler,
+        resilience=ResiliencePolicy(retry=RetryPolicy(max_retries=0)),
+    )
+
+
+def estimated_prompt_tokens() -> int:
+    return len(PROMPT) // 4 + IMAGE_TOKENS_ESTIMATE
+
+
+def call(lvlm: SambastudioMultimodal, method: str, image) -> str:
+    if method == 'invoke':
+        return lvlm.invoke(PROMPT, image)
+    if method == 'stream':
+        return ''.join(lvlm.stream(PROMPT, image))
+
+    async def collect():
+        try:
+            return ''.join([chunk async for chunk in lvlm.astream(PROMPT, image)])
+        finally:
+            await lvlm.aclose()
+
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize('method', ['invoke', 'stream', 'astream'])
+def test_openai_calls_are_settled_with_the_reported_usage(mock_server, png_image, method):
+    scheduler = RecordingScheduler()
+    call(make_lvlm(mock_server, 'openai', scheduler), method, png_image)
+    [(estimate, actual)] = scheduler.settled
+    assert estimate == estimated_prompt_tokens() + MAX_TOKENS
+    # the mock reports request bytes / 4 + 1 prompt tokens and 8 completion tokens
+    assert actual > 8 and actual != estimate
+
+
+@pytest.mark.parametrize('method', ['invoke', 'stream', 'astream'])
+def test_generic_calls_are_settled_with_the_generated_length(mock_server, png_image, method):
+    scheduler = RecordingScheduler()
+    generation = call(make_lvlm(mock_server, 'generic', scheduler), method, png_image)
+    assert scheduler.settled == [
+        (estimated_prompt_tokens() + MAX_TOKENS, estimated_prompt_tokens() + len(generation) // 4)
+    ]
+
+
+def test_interrupted_stream_is_settled(mock_server, png_image):
+    scheduler = RecordingScheduler()
+    chunks = make_lvlm(mock_server, 'generic', scheduler).stream(PROMPT, png_image)
+    first = next(chunks)
+    chunks.close()
+    assert scheduler.settled == [(estimated_prompt_tokens() + MAX_TOKENS, estimated_prompt_tokens() + len(first) // 4)]
+
+
+def test_failed_call_is_settled_with_the_prompt_estimate(png_image):
+    scheduler = RecordingScheduler()
+    with MockServer(MockConfig(latency=0.0, error_rate=1.0, error_statuses=(500,))) as server:
+        with pytest.raises(RuntimeError):
+            make_lvlm(server, 'openai', scheduler).invoke(PROMPT, png_image)
+    assert scheduler.settled == [(estimated_prompt_tokens() + MAX_TOKENS, estimated_prompt_tokens())]
+
+
+def test_scheduling_context_lane_is_used(mock_server, png_image):
+    scheduler = RecordingScheduler()
+    with scheduling_context(session_id='s', priority='interactive'):
+        make_lvlm(mock_server, 'openai', scheduler).invoke(PROMPT, png_image)
+    assert scheduler.stats()['interactive']['granted'] == 1
+    assert scheduler.stats()['batch']['granted'] == 0
+
+
+def test_generic_endpoint_rejects_several_images(mock_server, png_image):
+    lvlm = make_lvlm(mock_server, 'generic', RecordingScheduler())
+    with pytest.raises(ValueError):
+        list(lvlm.stream(PROMPT, [png_image, png_image]))
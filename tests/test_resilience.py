@@ -0,0 +1,178 @@
+import asyncio
+
+import pytest
+import requests
+
+from utils.model_wrappers import resilience as resilience_module
+from utils.model_wrappers.resilience import CircuitBreaker, CircuitOpenError, ResiliencePolicy, RetryPolicy
+
+
+class FakeResponse:
+    def __init__(self, status_code: int = 200, headers=None) -> None:
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def close(self) -> None:
+        self.closed = True
+
+    async def aclose(self) -> None:
+        self.closed = True
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(resilience_module.time, 'monotonic', clock.monotonic)
+    return clock
+
+
+def make_policy(max_retries: int = 0, failure_threshold: int = 2) -> ResiliencePolicy:
+    return ResiliencePolicy(
+        retry=RetryPolicy(max_retries=max_retries, backoff_base=0.0),
+        circuit_breaker=CircuitBreaker(failure_threshold=failure_threshold, reset_timeout=30.0),
+    )
+
+
+def failing_send():
+    raise requests.ConnectionError('connection refused')
+
+
+def open_circuit(policy: ResiliencePolicy) -> None:
+    for _ in range(policy.circuit_breaker.failure_threshold):
+        with pytest.raises(requests.ConnectionError):
+            policy.call(failing_send)
+
+
+def test_retries_transport_errors_and_retryable_statuses():
+    policy = make_policy(max_retries=3, failure_threshold=10)
+    outcomes = [requests.ConnectionError('reset'), FakeResponse(503), FakeResponse(200)]
+
+    def send():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    assert policy.call(send).status_code == 200
+    assert policy.circuit_breaker.state == 'closed'
+    assert policy.circuit_breaker.failures == 0
+
+
+def test_last_retryable_response_is_returned():
+    policy = make_policy(max_retries=2, failure_threshold=10)
+    responses = [FakeResponse(429), FakeResponse(429), FakeResponse(429)]
+    last = responses[-1]
+    assert policy.call(lambda: responses.pop(0), hedge=False) is last
+    assert not last.closed
+
+
+def test_retry_after_is_honored_and_capped():
+    retry = RetryPolicy(backoff_base=0.0, max_retry_after=5.0)
+    assert retry.delay(0, '2') == 2.0
+    assert retry.delay(0, '120') == 5.0
+    assert retry.delay(0, 'Wed, 21 Oct 2015 07:28:00 GMT') == 0.0
+    assert retry.delay(0, 'soon') == 0.0
+
+
+def test_circuit_opens_then_recovers_after_a_successful_trial(clock):
+    policy = make_policy()
+    open_circuit(policy)
+    assert policy.circuit_breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        policy.call(lambda: FakeResponse())
+    clock.now += 30
+    assert policy.circuit_breaker.state == 'half-open'
+    assert policy.call(lambda: FakeResponse()).status_code == 200
+    assert policy.circuit_breaker.state == 'closed'
+
+
+def test_failed_trial_reopens_the_circuit(clock):
+    policy = make_policy()
+    open_circuit(policy)
+    clock.now += 30
+    with pytest.raises(requests.ConnectionError):
+        policy.call(failing_send)
+    assert policy.circuit_breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        policy.call(lambda: FakeResponse())
+
+
+def test_only_one_trial_at_a_time(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30.0)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.before_call() is True
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.before_call() is False
+
+
+@pytest.mark.parametrize(
+    'error', [requests.exceptions.ChunkedEncodingError('truncated'), requests.HTTPError('500'), KeyboardInterrupt()]
+)
+def test_trial_ending_with_an_other_error_frees_the_trial(clock, error):
+    policy = make_policy()
+    open_circuit(policy)
+    clock.now += 30
+
+    def send():
+        raise error
+
+    with pytest.raises(type(error)):
+        policy.call(send)
+    assert policy.circuit_breaker.state == 'half-open'
+    assert policy.call(lambda: FakeResponse()).status_code == 200
+    assert policy.circuit_breaker.state == 'closed'
+
+
+def test_cancelled_async_trial_frees_the_trial(clock):
+    policy = make_policy()
+    open_circuit(policy)
+    clock.now += 30
+
+    async def scenario():
+        started = asyncio.Event()
+
+        async def slow_send():
+            started.set()
+            await asyncio.sleep(60)
+
+        task = asyncio.ensure_future(policy.acall(slow_send))
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        async def send():
+            return FakeResponse()
+
+        return await policy.acall(send)
+
+    assert asyncio.run(scenario()).status_code == 200
+    assert policy.circuit_breaker.state == 'closed'
+
+
+def test_async_calls_open_the_circuit():
+    policy = make_policy()
+
+    async def send():
+        raise requests.ConnectionError('connection refused')
+
+    async def scenario():
+        for _ in range(2):
+            with pytest.raises(requests.ConnectionError):
+                await policy.acall(send)
+        with pytest.raises(CircuitOpenError):
+            await policy.acall(send)
+
+    asyncio.run(scenario())
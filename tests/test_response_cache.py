@@ -0,0 +1,63 @@
+import pytest
+
+from utils.model_wrappers.multimodal_models import SambastudioMultimodal
+from utils.model_wrappers.response_cache import InMemoryLRUCache, SQLiteResponseCache, make_cache_key
+
+
+def test_cache_key_depends_on_images_prompt_and_params():
+    key = make_cache_key(['a'], 'prompt', {'model': 'm', 'temperature': 0.0})
+    assert key == make_cache_key(['a'], 'prompt', {'temperature': 0.0, 'model': 'm'})
+    assert key != make_cache_key(['b'], 'prompt', {'model': 'm', 'temperature': 0.0})
+    assert key != make_cache_key(['a'], 'other prompt', {'model': 'm', 'temperature': 0.0})
+    assert key != make_cache_key(['a'], 'prompt', {'model': 'm', 'temperature': 0.5})
+    assert key != make_cache_key(['a', 'a'], 'prompt', {'model': 'm', 'temperature': 0.0})
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def cache(request, tmp_path):
+    if request.param == 'memory':
+        yield InMemoryLRUCache(max_size=2)
+    else:
+        cache = SQLiteResponseCache(str(tmp_path / 'responses.sqlite'), max_size=2)
+        yield cache
+        cache.close()
+
+
+def test_hits_misses_and_eviction(cache):
+    assert cache.get('a') is None
+    cache.set('a', 'A')
+    cache.set('b', 'B')
+    assert cache.get('a') == 'A'
+    cache.set('c', 'C')
+    # b is the least recently used entry
+    assert cache.get('b') is None
+    assert cache.get('a') == 'A'
+    assert cache.get('c') == 'C'
+    assert cache.stats() == {'hits': 3, 'misses': 2, 'hit_rate': 0.6}
+
+
+def test_ttl_expiry():
+    cache = InMemoryLRUCache(ttl=-1)
+    cache.set('a', 'A')
+    assert cache.get('a') is None
+
+
+def test_invoke_is_served_from_the_cache(mock_server, png_image):
+    cache = InMemoryLRUCache()
+    lvlm = SambastudioMultimodal(base_url=mock_server.openai_url, api_key='k', model='m', cache=cache)
+    first = lvlm.invoke('describe', png_image)
+    assert lvlm.invoke('describe', png_image) == first
+    assert mock_server.stats.snapshot()['requests'] == 1
+    lvlm.invoke('describe again', png_image)
+    lvlm.invoke('describe', png_image, bypass_cache=True)
+    assert mock_server.stats.snapshot()['requests'] == 3
+    assert cache.stats()['hits'] == 1
+
+
+def test_sampled_responses_are_not_cached(mock_server, png_image):
+    cache = InMemoryLRUCache()
+    lvlm = SambastudioMultimodal(base_url=mock_server.openai_url, api_key='k', model='m', cache=cache, do_sample=True)
+    lvlm.invoke('describe', png_image)
+    lvlm.invoke('describe', png_image)
+    assert mock_server.stats.snapshot()['requests'] == 2
+    assert len(cache) == 0
@@ -0,0 +1,126 @@
+import asyncio
+import io
+import json
+
+import pytest
+import requests
+
+from benchmarks.mock_server import MockConfig, MockServer
+from utils.model_wrappers.multimodal_models import SambastudioMultimodal
+from utils.model_wrappers.sse import (
+    SSEDecoder,
+    StreamDecodeError,
+    StreamEventError,
+    aiter_openai_stream,
+    coalesce,
+    iter_openai_stream,
+)
+
+WORDS = ('Grains of 5 µm', ' in the α', ' phase', ' — 粒界', '.')
+
+
+def openai_event(content: str) -> bytes:
+    chunk = {'choices': [{'index': 0, 'delta': {'content': content}}]}
+    return b'data: ' + json.dumps(chunk, ensure_ascii=False).encode() + b'\n\n'
+
+
+def split_bytes(data: bytes, size: int):
+    return [data[start : start + size] for start in range(0, len(data), size)]
+
+
+def test_decoder_fields_comments_and_multiline_data():
+    decoder = SSEDecoder()
+    events = decoder.feed(b': keep-alive\r\nevent: error_event\r\ndata: a\r\ndata: b\r\n\r\ndata:c\n\n')
+    assert events == [(b'error_event', b'a\nb'), (None, b'c')]
+    assert decoder.feed(b'data: pending') == []
+    assert decoder.flush() == [(None, b'pending')]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 4096])
+def test_utf8_content_split_across_chunks(size):
+    body = b''.join(openai_event(word) for word in WORDS) + b'data: [DONE]\n\n'
+    assert ''.join(iter_openai_stream(split_bytes(body, size))) == ''.join(WORDS)
+
+
+def test_usage_done_and_events_after_done():
+    usage = {'prompt_tokens': 10, 'completion_tokens': 2}
+    body = (
+        openai_event('a')
+        + b'data: ' + json.dumps({'choices': [], 'usage': usage}).encode() + b'\n\n'
+        + b'data: [DONE]\n\n'
+        + openai_event('ignored')
+    )
+    received = []
+    assert list(iter_openai_stream([body], on_usage=received.append)) == ['a']
+    assert received == [usage]
+
+
+def test_stream_without_trailing_blank_line_is_flushed():
+    assert list(iter_openai_stream([openai_event('a') + openai_event('b')[:-2]])) == ['a', 'b']
+
+
+@pytest.mark.parametrize('data', [b'null', b'"text"', b'[1, 2]', b'42'])
+def test_non_object_payloads_raise_decode_errors(data):
+    with pytest.raises(StreamDecodeError):
+        list(iter_openai_stream([b'data: ' + data + b'\n\n']))
+
+
+def test_invalid_json_and_error_events():
+    with pytest.raises(StreamDecodeError):
+        list(iter_openai_stream([b'data: {not json\n\n']))
+    with pytest.raises(StreamEventError):
+        list(iter_openai_stream([b'event: error_event\ndata: {"error": "overloaded"}\n\n']))
+    with pytest.raises(StreamEventError):
+        list(iter_openai_stream([b'data: {"error": {"message": "overloaded"}}\n\n']))
+
+
+def test_async_stream_matches_sync_stream():
+    body = b''.join(openai_event(word) for word in WORDS) + b'data: [DONE]\n\n'
+
+    async def chunks():
+        for chunk in split_bytes(body, 5):
+            yield chunk
+
+    async def collect():
+        return [content async for content in aiter_openai_stream(chunks())]
+
+    assert ''.join(asyncio.run(collect())) == ''.join(WORDS)
+
+
+def test_coalesce_keeps_every_token():
+    tokens = [str(index) for index in range(100)]
+    assert ''.join(coalesce(tokens, flush_interval=10.0)) == ''.join(tokens)
+
+
+@pytest.fixture
+def utf8_server():
+    config = MockConfig(latency=0.0, jitter=0.0, completion_tokens=len(WORDS), token_rate=0.0, words=WORDS)
+    with MockServer(config) as server:
+        yield server
+
+
+@pytest.mark.parametrize('endpoint', ['openai', 'generic'])
+def test_sync_and_async_streams_decode_utf8(utf8_server, png_image, endpoint):
+    base_url = utf8_server.openai_url if endpoint == 'openai' else utf8_server.generic_url
+    lvlm = SambastudioMultimodal(base_url=base_url, api_key='k', model='m')
+    assert ''.join(lvlm.stream('describe', png_image)) == ''.join(WORDS)
+
+    async def collect():
+        try:
+            return ''.join([chunk async for chunk in lvlm.astream('describe', png_image)])
+        finally:
+            await lvlm.aclose()
+
+    assert asyncio.run(collect()) == ''.join(WORDS)
+
+
+@pytest.mark.parametrize('content_type', ['application/x-ndjson', 'text/event-stream', 'application/json'])
+def test_generic_stream_ignores_the_declared_charset(content_type):
+    lines = [json.dumps({'result': {'responses': [{'stream_token': word}]}}, ensure_ascii=False) for word in WORDS]
+    prefix = 'data: ' if content_type == 'text/event-stream' else ''
+    response = requests.Response()
+    response.status_code = 200
+    response.headers['Content-Type'] = content_type
+    response.raw = io.BytesIO(''.join(f'{prefix}{line}\n\n' for line in lines).encode())
+    lvlm = SambastudioMultimodal(base_url='http://localhost/api/predict/generic/p/e', api_key='k')
+    assert ''.join(lvlm._process_generic_api_response_stream(response)) == ''.join(WORDS)
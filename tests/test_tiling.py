@@ -0,0 +1,117 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from utils.model_wrappers.multimodal_models import SambastudioMultimodal
+from utils.model_wrappers.tiling import CONTRAST_STEP, ImageTile, ImageTiler, merge_tile_answers
+
+
+def noisy_image(width: int, height: int, seed: int = 0) -> Image.Image:
+    pixels = np.random.default_rng(seed).integers(0, 256, (height, width), dtype=np.uint8)
+    return Image.fromarray(pixels, mode='L').convert('RGB')
+
+
+@pytest.mark.parametrize('width, height', [(1024, 1024), (1500, 900), (3000, 2000), (200, 5000), (50, 60)])
+def test_grid_covers_the_image_with_the_requested_overlap(width, height):
+    tiler = ImageTiler(tile_size=1024, overlap=128)
+    grid = tiler.grid(width, height)
+    covered = np.zeros((height, width), dtype=bool)
+    for _, _, (left, top, right, bottom) in grid:
+        assert 0 <= left < right <= width and 0 <= top < bottom <= height
+        assert right - left == min(1024, width) and bottom - top == min(1024, height)
+        covered[top:bottom, left:right] = True
+    assert covered.all()
+    columns = sorted({box[0] for _, _, box in grid})
+    # neighbouring tiles share at least the overlap, the last one is aligned with the image end
+    assert all(1024 - (right - left) >= 128 for left, right in zip(columns, columns[1:]))
+    rows = max(row for row, _, _ in grid)
+    assert [(row, column) for row, column, _ in grid] == [
+        (row, column) for row in range(1, rows + 1) for column in range(1, len(columns) + 1)
+    ]
+
+
+def test_grid_of_exact_multiples():
+    assert [box for _, _, box in ImageTiler(tile_size=100, overlap=0).grid(300, 100)] == [
+        (0, 0, 100, 100),
+        (100, 0, 200, 100),
+        (200, 0, 300, 100),
+    ]
+
+
+def test_invalid_tiler_parameters():
+    with pytest.raises(ValueError):
+        ImageTiler(tile_size=100, overlap=100)
+    with pytest.raises(ValueError):
+        ImageTiler(overlap=-1)
+    with pytest.raises(ValueError, match='Unsupported tile format'):
+        ImageTiler(image_format='WEBP')
+
+
+def test_contrasts_match_the_subsampled_standard_deviation():
+    image = noisy_image(400, 300)
+    boxes = [(0, 0, 400, 300), (10, 20, 110, 220), (396, 296, 400, 300)]
+    gray = np.asarray(image.convert('L'), dtype=np.float64)[::CONTRAST_STEP, ::CONTRAST_STEP]
+    step = CONTRAST_STEP
+    expected = [
+        gray[top // step : -(-bottom // step), left // step : -(-right // step)].std()
+        for left, top, right, bottom in boxes
+    ]
+    assert ImageTiler().contrasts(image, boxes) == pytest.approx(expected, abs=1e-6)
+
+
+def test_uniform_tiles_are_skipped():
+    image = Image.new('RGB', (300, 100), (200, 200, 200))
+    image.paste(noisy_image(100, 100), (100, 0))
+    kept, skipped = ImageTiler(tile_size=100, overlap=0).split(image)
+    assert [tile.box for tile in kept] == [(100, 0, 200, 100)]
+    assert [tile.box for tile in skipped] == [(0, 0, 100, 100), (200, 0, 300, 100)]
+
+
+@pytest.mark.parametrize('image_format, mime_type', [('JPEG', 'image/jpeg'), ('PNG', 'image/png')])
+def test_tiles_are_cropped_at_native_resolution(image_format, mime_type):
+    image = noisy_image(300, 200).convert('RGBA')
+    tile = ImageTile(image, (50, 40, 250, 140), row=1, column=2, image_format=image_format)
+    loaded = tile.load()
+    assert loaded.mime_type == mime_type
+    decoded = Image.open(io.BytesIO(bytes(loaded.data)))
+    assert decoded.size == (200, 100)
+    assert decoded.mode == 'RGB'
+    if image_format == 'PNG':
+        assert np.array_equal(np.asarray(decoded), np.asarray(image.convert('RGB').crop((50, 40, 250, 140))))
+    assert tile.label == 'r1c2 (x 50-250, y 40-140)'
+
+
+def test_merge_groups_identical_answers_and_reports_failures():
+    image = Image.new('RGB', (300, 100))
+    tiles = [ImageTile(image, (index * 100, 0, index * 100 + 100, 100), 1, index + 1) for index in range(3)]
+    report = merge_tile_answers(
+        tiles,
+        ['Nothing relevant. ', 'Cracks along the boundary.', 'Nothing relevant.'],
+        (300, 100),
+        skipped=2,
+        tiler=ImageTiler(tile_size=100, overlap=0),
+    )
+    assert report.split('\n\n') == [
+        'Tiled analysis of a 300x100 image: 3 tile(s) analyzed (100 px, 0 px overlap), 2 uniform tile(s) skipped',
+        '**Tile r1c1 (x 0-100, y 0-100), r1c3 (x 200-300, y 0-100):** Nothing relevant.',
+        '**Tile r1c2 (x 100-200, y 0-100):** Cracks along the boundary.',
+    ]
+    failed = merge_tile_answers(tiles[:1], [RuntimeError('timeout')], (300, 100))
+    assert failed.split('\n\n') == [
+        'Tiled analysis of a 300x100 image: 1 tile(s) analyzed',
+        '**Tile r1c1 (x 0-100, y 0-100):** failed: timeout',
+    ]
+
+
+def test_invoke_tiled_queries_only_the_non_uniform_tiles(mock_server):
+    image = Image.new('RGB', (300, 100), (200, 200, 200))
+    image.paste(noisy_image(200, 100), (0, 0))
+    lvlm = SambastudioMultimodal(base_url=mock_server.openai_url, api_key='k', model='m')
+    result = lvlm.invoke_tiled('Any cracks?', image, tiler=ImageTiler(tile_size=100, overlap=0))
+    assert [tile.label for tile in result['tiles']] == ['r1c1 (x 0-100, y 0-100)', 'r1c2 (x 100-200, y 0-100)']
+    assert len(result['skipped']) == 1
+    assert mock_server.stats.snapshot()['requests'] == 2
+    assert result['report'].startswith('Tiled analysis of a 300x100 image: 2 tile(s) analyzed')
+    assert '**Tile r1c1 (x 0-100, y 0-100), r1c2 (x 100-200, y 0-100):**' in result['report']
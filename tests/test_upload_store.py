@@ -0,0 +1,43 @@
+import pytest
+
+from utils.storage.upload_store import UploadStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return UploadStore(str(tmp_path / 'uploads'), max_bytes=100, max_age=None)
+
+
+def test_content_is_stored_once(store):
+    digest = store.put(b'a' * 10, name='a.png')
+    assert store.put(b'a' * 10, name='copy.png') == digest
+    assert store.path(digest).endswith('.png')
+    assert bytes(store.open(digest)) == b'a' * 10
+    assert store.stats() == {'files': 1, 'bytes': 10}
+
+
+def test_least_recently_used_files_are_evicted(store):
+    first = store.put(b'1' * 40)
+    second = store.put(b'2' * 40)
+    store.path(first)
+    third = store.put(b'3' * 40)
+    assert store.open(second) is None
+    assert store.open(first) is not None
+    assert store.open(third) is not None
+
+
+def test_the_stored_file_is_never_evicted(store):
+    older = store.put(b'1' * 60)
+    # the least recently used file is the one being stored, the older file makes room instead
+    store._connection.execute('UPDATE blobs SET accessed_at = accessed_at + 1000 WHERE digest = ?', (older,))
+    digest = store.put(b'2' * 60)
+    assert store.open(digest) is not None
+    assert store.open(older) is None
+
+
+def test_content_larger_than_the_store_is_rejected(store):
+    kept = store.put(b'1' * 60)
+    with pytest.raises(ValueError):
+        store.put(b'2' * 101)
+    assert store.open(kept) is not None
+    assert store.stats() == {'files': 1, 'bytes': 60}
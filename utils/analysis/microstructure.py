@@ -0,0 +1,358 @@
+"""Local quantitative microstructure analysis with vectorized OpenCV / NumPy, cached per image digest."""
+
+import json
+import math
+import re
+import time
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+import cv2
+import numpy as np
+
+from utils.model_wrappers.image_inputs import BytesLike, ImageBytes
+from utils.model_wrappers.response_cache import BaseResponseCache, InMemoryLRUCache, make_cache_key
+
+# bumped when the measurements change, part of the cache keys
+ANALYSIS_VERSION = 1
+
+# quantities the analyzer reports, per topic: a question is answered locally only if it asks for one of them
+MEASURED_QUANTITY_REGEXES = {
+    'grains': re.compile(
+        r'\b(grain[\s-]*(sizes?|diameters?)|(sizes?|diameters?) of (the )?grains|(average|mean|median) grains?|'
+        r'(how many|number of|count( of)?( the)?) grains|how (big|large) are (the )?grains|astm)\b',
+        re.IGNORECASE,
+    ),
+    'phases': re.compile(
+        r'\b(phase[\s-]*(area[\s-]*)?(fractions?|percent(ages?)?|proportions?)|'
+        r'(area|volume)[\s-]*(fractions?|percent(age)?)|'
+        r'(fractions?|percent(ages?)?|proportions?) of (each|the|every) phases?)\b',
+        re.IGNORECASE,
+    ),
+    'porosity': re.compile(
+        r'\b(porosity|(how many|number of|count( of)?( the)?) pores|(average|mean) pore[\s-]*(areas?|sizes?)|'
+        r'pore[\s-]*(areas?|counts?|fractions?))\b',
+        re.IGNORECASE,
+    ),
+}
+# quantities the analyzer does not report: extremes, and the phase count which is a parameter, not a measurement
+UNMEASURED_REGEX = re.compile(
+    r'\b(biggest|largest|smallest|tiniest|max(imum)?|min(imum)?|longest|shortest|widest|thickest|thinnest|'
+    r'(how many|number of|count( of)?( the)?) (different |distinct )?phases)\b',
+    re.IGNORECASE,
+)
+# explicit asks for a measured number
+NUMERIC_REGEX = re.compile(
+    r'\b(how\s+(much|many|large|big)|number\s+of|count|percent(age)?|fractions?|average|mean|median|'
+    r'sizes?|diameters?|astm)\b',
+    re.IGNORECASE,
+)
+# questions the measurements alone do not answer: explanations, locations, shapes, yes / no questions
+QUALITATIVE_REGEX = re.compile(
+    r'\b(why|explain|describe|identify|interpret|(which|what) (kind|type|material|alloy)|'
+    r'mechanism|caused?|origin|process(ed|ing)?|heat[\s-]*treat\w*|compare|recommend|suggest|improve|'
+    r'where|locat\w*|distribut\w*|shape[sd]?|spherical|round(ed)?|elongated|irregular|morpholog\w*|orient\w*|'
+    r'cluster\w*|connect\w*|uniform\w*|homogene\w*)\b|^\s*(is|are|do|does|did|can|could|should|has|have)\b',
+    re.IGNORECASE,
+)
+
+
+def _multi_otsu_thresholds(histogram: np.ndarray) -> List[int]:
+    """
+    Returns the two thresholds splitting a 256 bins histogram into three classes of maximal between class
+    variance, every threshold pair is evaluated at once.
+    """
+    levels = np.arange(256, dtype=np.float64)
+    probabilities = histogram / histogram.sum()
+    weights = np.cumsum(probabilities)
+    moments = np.cumsum(probabilities * levels)
+    low, high = np.meshgrid(np.arange(256), np.arange(256), indexing='ij')
+    classes = (
+        (weights[low], moments[low]),
+        (weights[high] - weights[low], moments[high] - moments[low]),
+        (1 - weights[high], moments[-1] - moments[high]),
+    )
+    variance = np.zeros((256, 256))
+    valid = high > low
+    for weight, moment in classes:
+        valid &= weight > 1e-12
+        variance += np.divide(moment**2, weight, out=np.zeros_like(variance), where=weight > 1e-12)
+    variance[~valid] = -1
+    first, second = np.unravel_index(np.argmax(variance), variance.shape)
+    return [int(first), int(second)]
+
+
+def _quantiles(values: np.ndarray) -> Dict[str, Optional[float]]:
+    """Summarizes a distribution, None values for an empty one."""
+    if not len(values):
+        return {'mean': None, 'median': None, 'p10': None, 'p90': None}
+    p10, median, p90 = np.percentile(values, [10, 50, 90])
+    return {'mean': float(values.mean()), 'median': float(median), 'p10': float(p10), 'p90': float(p90)}
+
+
+class MicrostructureAnalyzer:
+    """
+    Measures grains, phases and porosity of a micrograph locally:
+
+    - grain boundaries are segmented with an adaptive threshold of the dark etched lines and the grains are the
+      connected components between them, grains touching the image border are excluded from the size statistics
+    - phases are the intensity classes of an Otsu (two phases) or multi level Otsu (three phases) threshold
+    - pores are the darkest compact regions of the contrast stretched image
+
+    Results are plain dicts, cached per image digest and analysis parameters.
+    """
+
+    def __init__(
+        self,
+        cache: Optional[BaseResponseCache] = None,
+        max_side: int = 1024,
+        phase_count: int = 2,
+        min_grain_area: int = 20,
+        pore_level: int = 30,
+        min_pore_area: int = 25,
+    ) -> None:
+        """
+        Initialize the MicrostructureAnalyzer.
+
+        :param BaseResponseCache cache: cache of the analysis results, defaults to an in memory LRU cache
+        :param int max_side: images are downscaled to this longest side before the analysis
+        :param int phase_count: number of phases, 2 or 3
+        :param int min_grain_area: smallest grain area in analysis pixels, smaller regions are noise
+        :param int pore_level: intensity (0-255) of the contrast stretched image below which pixels are pores
+        :param int min_pore_area: smallest pore area in analysis pixels
+        """
+        if phase_count not in (2, 3):
+            raise ValueError(f'phase_count should be 2 or 3, got {phase_count}')
+        self.cache = cache if cache is not None else InMemoryLRUCache(max_size=256)
+        self.max_side = max_side
+        self.phase_count = phase_count
+        self.min_grain_area = min_grain_area
+        self.pore_level = pore_level
+        self.min_pore_area = min_pore_area
+
+    def _params(self, pixel_size: Optional[float]) -> Dict[str, Any]:
+        return {
+            'analysis': ANALYSIS_VERSION,
+            'max_side': self.max_side,
+            'phase_count': self.phase_count,
+            'min_grain_area': self.min_grain_area,
+            'pore_level': self.pore_level,
+            'min_pore_area': self.min_pore_area,
+            'pixel_size': pixel_size,
+        }
+
+    def analyze(self, image: Union[ImageBytes, BytesLike], pixel_size: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Measures an image, or returns the cached measurements of the same image and parameters.
+
+        :param ImageBytes image: encoded image
+        :param float pixel_size: size of an image pixel in micrometers, lengths are in pixels if not provided
+        :return: The measurements
+        :rtype: dict
+        """
+        if not isinstance(image, ImageBytes):
+            image = ImageBytes(image)
+        pixel_size = pixel_size or None
+        key = make_cache_key([image.digest], None, self._params(pixel_size))
+        cached = self.cache.get(key)
+        if cached is not None:
+            return json.loads(cached)
+        gray = cv2.imdecode(np.frombuffer(image.data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            raise ValueError('the image could not be decoded')
+        report = self.analyze_array(gray, pixel_size)
+        report['digest'] = image.digest
+        self.cache.set(key, json.dumps(report))
+        return report
+
+    def analyze_array(self, gray: np.ndarray, pixel_size: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Measures a grayscale image, without caching.
+
+        :param ndarray gray: 8 bits grayscale image
+        :param float pixel_size: size of an image pixel in micrometers, lengths are in pixels if not provided
+        :return: The measurements
+        :rtype: dict
+        """
+        start = time.perf_counter()
+        height, width = gray.shape[:2]
+        scale = min(1.0, self.max_side / max(height, width))
+        if scale < 1:
+            gray = cv2.resize(gray, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+        # lengths of an analysis pixel in the reported unit
+        unit_length = (pixel_size or 1.0) / scale
+        report: Dict[str, Any] = {
+            'width': width,
+            'height': height,
+            'scale': scale,
+            'unit': 'um' if pixel_size else 'px',
+            'phases': self._phases(gray),
+            'porosity': self._porosity(gray, unit_length),
+        }
+        report.update(self._grains(gray, unit_length, pixel_size))
+        report['seconds'] = time.perf_counter() - start
+        return report
+
+    def _phases(self, gray: np.ndarray) -> List[Dict[str, float]]:
+        """Area fraction and mean intensity of each phase, darkest first."""
+        histogram = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+        if self.phase_count == 2:
+            threshold, _ = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+            thresholds = [int(threshold)]
+        else:
+            thresholds = _multi_otsu_thresholds(histogram)
+        levels = np.arange(256, dtype=np.float64)
+        bounds = [0, *(threshold + 1 for threshold in thresholds), 256]
+        total = histogram.sum()
+        phases = []
+        for low, high in zip(bounds[:-1], bounds[1:]):
+            count = histogram[low:high].sum()
+            mean = float((histogram[low:high] * levels[low:high]).sum() / count) if count else None
+            phases.append({'fraction': float(count / total), 'mean_intensity': mean})
+        return phases
+
+    def _porosity(self, gray: np.ndarray, unit_length: float) -> Dict[str, Any]:
+        """Area fraction, count and sizes of the pores."""
+        low, high = np.percentile(gray, [0.5, 99.5])
+        stretched = np.clip((gray.astype(np.float32) - low) * (255.0 / max(high - low, 1.0)), 0, 255)
+        mask = (stretched < self.pore_level).astype(np.uint8)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+        count, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        stats = stats[1:count]
+        areas = stats[:, cv2.CC_STAT_AREA]
+        # pores are compact blobs, the dark grain boundary network covers a small part of its bounding box
+        extent = areas / (stats[:, cv2.CC_STAT_WIDTH] * stats[:, cv2.CC_STAT_HEIGHT])
+        areas = areas[(areas >= self.min_pore_area) & (extent >= 0.3)]
+        unit_area = unit_length**2
+        return {
+            'fraction': float(areas.sum() / gray.size),
+            'count': int(len(areas)),
+            'mean_area': float(areas.mean() * unit_area) if len(areas) else None,
+            'max_area': float(areas.max() * unit_area) if len(areas) else None,
+        }
+
+    def _grains(self, gray: np.ndarray, unit_length: float, pixel_size: Optional[float]) -> Dict[str, Any]:
+        """Grain boundary fraction and grain size distribution."""
+        blurred = cv2.GaussianBlur(gray, (3, 3), 0)
+        block_size = max(15, min(gray.shape) // 40) | 1
+        boundaries = cv2.adaptiveThreshold(
+            blurred, 1, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, block_size, 5
+        )
+        boundaries = cv2.morphologyEx(boundaries, cv2.MORPH_CLOSE, np.ones((3, 3), np.uint8))
+        count, _, stats, _ = cv2.connectedComponentsWithStats(1 - boundaries, connectivity=4)
+        stats = stats[1:count]
+        stats = stats[stats[:, cv2.CC_STAT_AREA] >= self.min_grain_area]
+        left, top = stats[:, cv2.CC_STAT_LEFT], stats[:, cv2.CC_STAT_TOP]
+        right = left + stats[:, cv2.CC_STAT_WIDTH]
+        bottom = top + stats[:, cv2.CC_STAT_HEIGHT]
+        on_border = (left == 0) | (top == 0) | (right == gray.shape[1]) | (bottom == gray.shape[0])
+        areas = stats[~on_border, cv2.CC_STAT_AREA].astype(np.float64) * unit_length**2
+        # diameters of the circles of the same areas
+        diameters = 2 * np.sqrt(areas / math.pi)
+        histogram_counts, histogram_edges = np.histogram(diameters, bins=10) if len(diameters) else ([], [])
+        astm_grain_size = None
+        if pixel_size and len(areas):
+            # ASTM E112 planimetric grain size number, mean grain area in mm2
+            astm_grain_size = -3.3219 * math.log10(areas.mean() * 1e-6) - 2.954
+        return {
+            'boundary_fraction': float(boundaries.mean()),
+            'grains': {
+                'count': int(len(areas)),
+                'border_count': int(on_border.sum()),
+                'diameter': _quantiles(diameters),
+                'mean_area': float(areas.mean()) if len(areas) else None,
+                'astm_grain_size': astm_grain_size,
+                'histogram': {
+                    'counts': [int(count) for count in histogram_counts],
+                    'edges': [float(edge) for edge in histogram_edges],
+                },
+            },
+        }
+
+
+def _format_number(value: Optional[float], digits: int = 1) -> str:
+    return 'n/a' if value is None else f'{value:.{digits}f}'
+
+
+def format_analysis(report: Dict[str, Any], label: Optional[str] = None, topics: Sequence[str] = ()) -> str:
+    """
+    Formats measurements as compact text, used as prompt context and as direct answers.
+
+    :param dict report: measurements of an image
+    :param str label: name of the image, prepended to the text
+    :param list topics: subset of 'grains', 'phases' and 'porosity' to include, every topic by default
+    :rtype: str
+    """
+    unit = 'µm' if report['unit'] == 'um' else 'px'
+    topics = topics or ('grains', 'phases', 'porosity')
+    lines = [f'{label}:'] if label else []
+    if 'grains' in topics:
+        grains = report['grains']
+        diameter = grains['diameter']
+        line = (
+            f'- grains: {grains["count"]} measured ({grains["border_count"]} cut by the image border excluded), '
+            f'equivalent diameter mean {_format_number(diameter["mean"])} {unit}, '
+            f'median {_format_number(diameter["median"])} {unit}, '
+            f'p10-p90 {_format_number(diameter["p10"])}-{_format_number(diameter["p90"])} {unit}'
+        )
+        if grains['astm_grain_size'] is not None:
+            line += f', ASTM E112 grain size number {grains["astm_grain_size"]:.1f}'
+        lines.append(line)
+    if 'phases' in topics:
+        fractions = ', '.join(
+            f'{phase["fraction"] * 100:.1f} % (mean gray level {_format_number(phase["mean_intensity"], 0)})'
+            for phase in report['phases']
+        )
+        lines.append(f'- phase area fractions, darkest to brightest: {fractions}')
+    if 'porosity' in topics:
+        porosity = report['porosity']
+        lines.append(
+            f'- porosity: {porosity["fraction"] * 100:.2f} % of the area, {porosity["count"]} pores, '
+            f'mean pore area {_format_number(porosity["mean_area"])} {unit}²'
+        )
+    return '\n'.join(lines)
+
+
+def format_analyses(reports: Sequence[Dict[str, Any]], topics: Sequence[str] = ()) -> str:
+    """
+    Formats the measurements of several images, labelled by their position.
+
+    :param list reports: measurements of the images
+    :param list topics: subset of 'grains', 'phases' and 'porosity' to include, every topic by default
+    :rtype: str
+    """
+    if len(reports) == 1:
+        return format_analysis(reports[0], topics=topics)
+    return '\n'.join(format_analysis(report, f'Image {index + 1}', topics) for index, report in enumerate(reports))
+
+
+def quantitative_topics(query: str) -> List[str]:
+    """
+    Returns the topics whose reported quantities a question asks for, in the order of the question, empty if the
+    question needs the model, which then gets the measurements as context.
+
+    :param str query: user question
+    :rtype: list
+    """
+    if QUALITATIVE_REGEX.search(query) or UNMEASURED_REGEX.search(query) or not NUMERIC_REGEX.search(query):
+        return []
+    positions = {}
+    for topic, regex in MEASURED_QUANTITY_REGEXES.items():
+        match = regex.search(query)
+        if match is not None:
+            positions[topic] = match.start()
+    return sorted(positions, key=positions.get)
+
+
+def answer_quantitative(query: str, reports: Sequence[Dict[str, Any]]) -> Optional[str]:
+    """
+    Answers a purely quantitative question from the local measurements.
+
+    :param str query: user question
+    :param list reports: measurements of the images
+    :return: The answer, None if the question needs the model
+    :rtype: str
+    """
+    topics = quantitative_topics(query)
+    if not topics or not reports:
+        return None
+    return 'Measured locally from the image:\n' + format_analyses(reports, topics)
@@ -0,0 +1,424 @@
+"""
+Headless resumable batch runner of multimodal queries.
+
+Tasks come from a JSONL manifest, one {"id", "prompt", "image" or "images"} object per line with image paths
+relative to the manifest, or from a directory of images asked the same prompts. Images are decoded and
+re-encoded in a process pool, requests are sent with bounded concurrency, and each result is appended to a
+JSONL output as soon as it is received. The output is the checkpoint: a rerun with the same output skips the
+tasks already recorded, so an interrupted run resumes where it stopped.
+
+usage: python -m utils.batch.runner (--manifest FILE | --images-dir DIR --prompt TEXT) --output FILE [options]
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+from utils.model_wrappers.image_inputs import ImageBytes, is_url
+from utils.model_wrappers.image_preprocessing import ImagePreprocessor
+from utils.model_wrappers.multimodal_models import SambastudioMultimodal
+from utils.model_wrappers.rate_limiter import RequestScheduler
+from utils.model_wrappers.response_cache import SQLiteResponseCache
+
+# files picked up in directory mode
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif', '.tif', '.tiff')
+
+# a task is (task id, prompt, image paths or urls)
+Task = Tuple[str, str, List[str]]
+
+_preprocessors: Dict[Tuple[Any, ...], ImagePreprocessor] = {}
+
+
+def encode_image_file(path: str, max_side: Optional[int], image_format: str, quality: int) -> Tuple[bytes, str]:
+    """
+    Reads and preprocesses an image file, runs in the encoding pool workers.
+
+    :param str path: path of the image file
+    :param int max_side: maximum length of the longest side, None to keep the resolution
+    :param str image_format: target format
+    :param int quality: encoder quality for lossy formats
+    :return: The encoded image and its MIME type
+    :rtype: tuple
+    """
+    key = (max_side, image_format, quality)
+    preprocessor = _preprocessors.get(key)
+    if preprocessor is None:
+        preprocessor = _preprocessors[key] = ImagePreprocessor(max_side, image_format, quality)
+    with open(path, 'rb') as image_file:
+        data = image_file.read()
+    processed, _ = preprocessor.process(data)
+    mime_type = preprocessor.mime_type if processed is not data else None
+    return processed, mime_type or ImageBytes(processed).mime_type
+
+
+def iter_manifest(path: str) -> Iterator[Task]:
+    """
+    Yields the tasks of a JSONL manifest, lazily. Ids default to the line numbers.
+
+    :param str path: path of the manifest
+    :yield: The tasks
+    :rtype: tuple
+    """
+    root = Path(path).parent
+    with open(path, encoding='utf-8') as manifest:
+        for line_number, line in enumerate(manifest, start=1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f'{path}:{line_number}: invalid JSON: {e}') from e
+            images = entry.get('images', entry.get('image', []))
+            if isinstance(images, str):
+                images = [images]
+            images = [image if is_url(image) else str(root / image) for image in images]
+            yield str(entry.get('id', f'line-{line_number}')), entry.get('prompt') or '', images
+
+
+def iter_directory(directory: str, prompts: Sequence[str]) -> Iterator[Task]:
+    """
+    Yields a task per image of a directory tree and prompt, in a stable order. Ids are the relative paths,
+    suffixed with the prompt index when several prompts are asked.
+
+    :param str directory: root directory
+    :param list prompts: prompts asked about every image
+    :yield: The tasks
+    :rtype: tuple
+    """
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if not filename.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            path = os.path.join(dirpath, filename)
+            relative_path = os.path.relpath(path, directory)
+            for index, prompt in enumerate(prompts):
+                task_id = relative_path if len(prompts) == 1 else f'{relative_path}#{index}'
+                yield task_id, prompt, [path]
+
+
+class ResultWriter:
+    """
+    Append only JSONL results file. Every record is flushed when written and fsynced every sync_every records,
+    a crash loses at most the records after the last sync and never corrupts the earlier ones.
+    """
+
+    def __init__(self, path: str, sync_every: int = 32) -> None:
+        """
+        Initialize the ResultWriter, a torn last line left by a crash is removed.
+
+        :param str path: path of the results file
+        :param int sync_every: records written between two fsync
+        """
+        self.path = path
+        self.sync_every = sync_every
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._truncate_torn_line()
+        self._file = open(path, 'a', encoding='utf-8')
+        self._unsynced = 0
+
+    def _truncate_torn_line(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as results:
+            size = results.seek(0, os.SEEK_END)
+            if size == 0:
+                return
+            results.seek(size - 1)
+            if results.read(1) == b'\n':
+                return
+            # scan back to the end of the last complete record
+            position = size
+            while position > 0:
+                start = max(0, position - 65536)
+                results.seek(start)
+                newline = results.read(position - start).rfind(b'\n')
+                if newline != -1:
+                    results.truncate(start + newline + 1)
+                    return
+                position = start
+            results.truncate(0)
+
+    def completed(self, retry_failed: bool = True) -> Set[str]:
+        """
+        Returns the ids of the tasks already recorded.
+
+        :param bool retry_failed: leave out the failed tasks so they are run again
+        :rtype: set
+        """
+        self._file.flush()
+        done: Set[str] = set()
+        with open(self.path, encoding='utf-8') as results:
+            for line in results:
+                record = json.loads(line)
+                if record['status'] == 'ok' or not retry_failed:
+                    done.add(record['id'])
+                else:
+                    done.discard(record['id'])
+        return done
+
+    def write(self, record: Dict[str, Any]) -> None:
+        """
+        Appends a record.
+
+        :param dict record: JSON serializable record
+        """
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self) -> None:
+        """Forces the written records to disk."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self) -> None:
+        """Syncs and closes the file."""
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+
+class BatchRunner:
+    """
+    Pipeline of a batch run: encoding workers feed a bounded queue of ready requests
+    drained by max_concurrency request workers, results are written as they complete.
+    """
+
+    def __init__(
+        self,
+        lvlm: SambastudioMultimodal,
+        writer: ResultWriter,
+        executor: Optional[Executor] = None,
+        max_concurrency: int = 16,
+        encode_workers: Optional[int] = None,
+        max_side: Optional[int] = 1536,
+        image_format: str = 'JPEG',
+        quality: int = 85,
+        progress_every: float = 10.0,
+    ) -> None:
+        """
+        Initialize the BatchRunner.
+
+        :param SambastudioMultimodal lvlm: client of the model, images are sent as already preprocessed
+        :param ResultWriter writer: results file
+        :param Executor executor: pool encoding the images, defaults to a process pool of spawned workers
+        :param int max_concurrency: maximum number of in-flight requests
+        :param int encode_workers: number of concurrent encodings, defaults to the number of CPUs
+        :param int max_side: maximum length of the longest image side, None to keep the resolution
+        :param str image_format: format the images are re-encoded to
+        :param int quality: encoder quality for lossy formats
+        :param float progress_every: seconds between two progress lines on stderr
+        """
+        if max_concurrency < 1:
+            raise ValueError('max_concurrency should be greater than 0')
+        self.lvlm = lvlm
+        self.writer = writer
+        self.encode_workers = encode_workers or os.cpu_count() or 1
+        self.executor = executor
+        self._owns_executor = executor is None
+        self.max_concurrency = max_concurrency
+        self.encoding = (max_side, image_format, quality)
+        self.progress_every = progress_every
+        self.counts = {'ok': 0, 'error': 0, 'skipped': 0}
+        self._started_at = 0.0
+        self._last_progress = 0.0
+
+    async def _encode(self, task: Task) -> Tuple[Task, Any]:
+        """Loads the images of a task in the encoding pool, urls are left to the fetcher of the client."""
+        loop = asyncio.get_running_loop()
+        task_id, prompt, images = task
+        try:
+            encoded = await asyncio.gather(*(
+                loop.run_in_executor(self.executor, encode_image_file, image, *self.encoding)
+                for image in images
+                if not is_url(image)
+            ))
+        except Exception as e:
+            return task, e
+        loaded = iter(encoded)
+        return task, [image if is_url(image) else ImageBytes(*next(loaded)) for image in images]
+
+    def _record(self, task: Task, started_at: float, response: Optional[str], error: Optional[Exception]) -> None:
+        task_id, prompt, images = task
+        record: Dict[str, Any] = {'id': task_id, 'prompt': prompt, 'images': images}
+        if error is None:
+            record.update(status='ok', response=response)
+        else:
+            record.update(status='error', error=f'{type(error).__name__}: {error}')
+        record.update(seconds=round(time.perf_counter() - started_at, 3), finished_at=time.time())
+        self.writer.write(record)
+        self.counts[record['status']] += 1
+        self._report_progress()
+
+    def _report_progress(self, force: bool = False) -> None:
+        now = time.perf_counter()
+        if not force and now - self._last_progress < self.progress_every:
+            return
+        self._last_progress = now
+        done = self.counts['ok'] + self.counts['error']
+        elapsed = now - self._started_at
+        rate = done / elapsed if elapsed else 0.0
+        print(
+            f'{done} done ({self.counts["error"]} failed, {self.counts["skipped"]} already recorded) '
+            f'in {elapsed:.0f} s, {rate:.2f} tasks/s',
+            file=sys.stderr,
+            flush=True,
+        )
+
+    async def arun(self, tasks: Iterator[Task], retry_failed: bool = True) -> Dict[str, Any]:
+        """
+        Runs the tasks not yet recorded in the results file.
+
+        :param iterable tasks: tasks to run, consumed lazily
+        :param bool retry_failed: run again the tasks recorded as failed
+        :return: The counts of completed, failed and skipped tasks and the elapsed seconds
+        :rtype: dict
+        """
+        done = self.writer.completed(retry_failed)
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.encode_workers, mp_context=multiprocessing.get_context('spawn')
+            )
+        self._started_at = self._last_progress = time.perf_counter()
+        ready: asyncio.Queue = asyncio.Queue(maxsize=2 * self.max_concurrency)
+
+        def pending_tasks() -> Iterator[Task]:
+            for task in tasks:
+                if task[0] in done:
+                    self.counts['skipped'] += 1
+                else:
+                    # duplicated ids are only run once
+                    done.add(task[0])
+                    yield task
+
+        iterator = pending_tasks()
+
+        async def encoder() -> None:
+            for task in iterator:
+                started_at = time.perf_counter()
+                await ready.put((started_at, *await self._encode(task)))
+
+        async def sender() -> None:
+            while True:
+                item = await ready.get()
+                if item is None:
+                    return
+                started_at, task, images = item
+                if isinstance(images, Exception):
+                    self._record(task, started_at, None, images)
+                    continue
+                try:
+                    response = await self.lvlm.ainvoke(task[1], images)
+                except Exception as e:
+                    self._record(task, started_at, None, e)
+                else:
+                    self._record(task, started_at, response, None)
+
+        senders = [asyncio.ensure_future(sender()) for _ in range(self.max_concurrency)]
+        encoders = [asyncio.ensure_future(encoder()) for _ in range(self.encode_workers)]
+        try:
+            await asyncio.gather(*encoders)
+            for _ in senders:
+                await ready.put(None)
+            await asyncio.gather(*senders)
+        except BaseException:
+            for worker in encoders + senders:
+                worker.cancel()
+            raise
+        finally:
+            self.writer.sync()
+            if self._owns_executor:
+                self.executor.shutdown(cancel_futures=True)
+                self.executor = None
+            await self.lvlm.aclose()
+        self._report_progress(force=True)
+        return {**self.counts, 'seconds': time.perf_counter() - self._started_at}
+
+    def run(self, tasks: Iterator[Task], retry_failed: bool = True) -> Dict[str, Any]:
+        """
+        Runs the tasks not yet recorded in the results file, see arun.
+
+        :param iterable tasks: tasks to run, consumed lazily
+        :param bool retry_failed: run again the tasks recorded as failed
+        :rtype: dict
+        """
+        return asyncio.run(self.arun(tasks, retry_failed))
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--manifest', help='JSONL manifest of {"id", "prompt", "image" or "images"} tasks')
+    source.add_argument('--images-dir', help='directory of images, searched recursively')
+    parser.add_argument('--prompt', action='append', default=[], help='prompt asked about every image, repeatable')
+    parser.add_argument('--prompts-file', help='file of prompts asked about every image, one per line')
+    parser.add_argument('--output', required=True, help='append only JSONL results file, also the checkpoint')
+    parser.add_argument('--no-retry-failed', action='store_true', help='do not run again the failed tasks')
+    parser.add_argument('--base-url', default=None, help='endpoint URL, defaults to LVLM_BASE_URL')
+    parser.add_argument('--model', default='Llama-3.2-11B-Vision-Instruct')
+    parser.add_argument('--max-tokens', type=int, default=1024)
+    parser.add_argument('--concurrency', type=int, default=16, help='maximum number of in-flight requests')
+    parser.add_argument('--encode-workers', type=int, default=None, help='encoding processes, defaults to the CPUs')
+    parser.add_argument('--max-side', type=int, default=1536, help='longest image side sent, 0 to keep it')
+    parser.add_argument('--format', default='JPEG', help='image format sent, JPEG, PNG or WEBP')
+    parser.add_argument('--quality', type=int, default=85)
+    parser.add_argument('--requests-per-second', type=float, default=2.0)
+    parser.add_argument('--tokens-per-minute', type=float, default=100_000)
+    parser.add_argument('--cache', default=None, help='SQLite response cache path, not cached by default')
+    args = parser.parse_args(argv)
+
+    if args.manifest:
+        tasks = iter_manifest(args.manifest)
+    else:
+        prompts = list(args.prompt)
+        if args.prompts_file:
+            with open(args.prompts_file, encoding='utf-8') as prompts_file:
+                prompts += [line.strip() for line in prompts_file if line.strip()]
+        if not prompts:
+            parser.error('--images-dir requires --prompt or --prompts-file')
+        tasks = iter_directory(args.images_dir, prompts)
+
+    lvlm = SambastudioMultimodal(
+        base_url=args.base_url,
+        api_key=os.getenv('LVLM_API_KEY') or os.getenv('SAMBANOVA_API_KEY'),
+        model=args.model,
+        max_tokens_to_generate=args.max_tokens,
+        max_concurrency=args.concurrency,
+        cache=SQLiteResponseCache(args.cache) if args.cache else None,
+        scheduler=RequestScheduler(args.requests_per_second, args.tokens_per_minute),
+    )
+    writer = ResultWriter(args.output)
+    runner = BatchRunner(
+        lvlm,
+        writer,
+        max_concurrency=args.concurrency,
+        encode_workers=args.encode_workers,
+        max_side=args.max_side or None,
+        image_format=args.format.upper(),
+        quality=args.quality,
+    )
+    try:
+        summary = runner.run(tasks, retry_failed=not args.no_retry_failed)
+    except KeyboardInterrupt:
+        print('interrupted, rerun the same command to resume', file=sys.stderr)
+        sys.exit(130)
+    finally:
+        writer.close()
+    print(json.dumps(summary))
+
+
+if __name__ == '__main__':
+    main()
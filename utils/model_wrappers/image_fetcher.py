@@ -0,0 +1,217 @@
+"""Size capped, conditionally cached image downloads shared by the app and the multimodal wrapper."""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Union
+from urllib.parse import urlsplit
+
+import requests
+
+from utils.model_wrappers.image_inputs import ImageBytes
+from utils.model_wrappers.resilience import CircuitBreaker, CircuitOpenError, ResiliencePolicy
+from utils.storage.upload_store import UploadStore
+
+# hosts whose resilience policy, and circuit breaker state, is kept
+MAX_HOST_POLICIES = 256
+
+
+class ImageFetchError(ValueError):
+    """
+    Raised when an image can not be downloaded from a URL.
+    """
+
+
+class ImageFetcher:
+    """
+    Downloads images streaming the body with a size cap, rejecting non image responses before
+    reading their body. When a cache directory is set, bodies are kept in a content addressed store
+    and revalidated with ETag / Last-Modified conditional requests. Each host has its own circuit breaker,
+    so failing image hosts neither affect each other nor the model API.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 20 * 1024 * 1024,
+        cache_dir: Optional[str] = None,
+        cache_max_bytes: Optional[int] = 256 * 1024 * 1024,
+        session: Optional[requests.Session] = None,
+        resilience: Optional[ResiliencePolicy] = None,
+        chunk_size: int = 64 * 1024,
+    ) -> None:
+        """
+        Initialize the ImageFetcher.
+
+        :param int max_bytes: maximum size of a downloaded image
+        :param str cache_dir: directory of the HTTP cache, None to disable caching
+        :param int cache_max_bytes: maximum size of the cached images
+        :param requests.Session session: session used for the downloads, a new one if not provided
+        :param ResiliencePolicy resilience: timeouts, retries and circuit breaker settings applied to each host,
+            defaults to ResiliencePolicy(), its circuit breaker itself is never used
+        :param int chunk_size: size of the streamed body chunks
+        """
+        self.max_bytes = max_bytes
+        self.session = session if session is not None else requests.Session()
+        self.resilience = resilience if resilience is not None else ResiliencePolicy()
+        self.chunk_size = chunk_size
+        self.store: Optional[UploadStore] = None
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._host_policies: 'OrderedDict[str, ResiliencePolicy]' = OrderedDict()
+        if cache_dir is not None:
+            self.store = UploadStore(cache_dir, max_bytes=cache_max_bytes, max_age=None)
+            self._connection = sqlite3.connect(
+                os.path.join(cache_dir, 'urls.sqlite'), check_same_thread=False, isolation_level=None
+            )
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, digest TEXT NOT NULL, mime_type TEXT, '
+                'etag TEXT, last_modified TEXT, fetched_at REAL NOT NULL)'
+            )
+
+    def _host_policy(self, url: str) -> ResiliencePolicy:
+        """
+        Returns the resilience policy of the host of a URL, with the settings of self.resilience
+        and a circuit breaker of its own.
+        """
+        host = urlsplit(url).netloc.lower()
+        with self._lock:
+            policy = self._host_policies.get(host)
+            if policy is None:
+                breaker = self.resilience.circuit_breaker
+                policy = ResiliencePolicy(
+                    connect_timeout=self.resilience.connect_timeout,
+                    read_timeout=self.resilience.read_timeout,
+                    retry=self.resilience.retry,
+                    circuit_breaker=CircuitBreaker(
+                        breaker.failure_threshold, breaker.reset_timeout, name=f'Image host {host}'
+                    ),
+                )
+                self._host_policies[host] = policy
+                if len(self._host_policies) > MAX_HOST_POLICIES:
+                    self._host_policies.popitem(last=False)
+            else:
+                self._host_policies.move_to_end(host)
+            return policy
+
+    def _cached(self, url: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns the cache entry of a URL if its body is still stored.
+        """
+        if self._connection is None:
+            return None
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT digest, mime_type, etag, last_modified FROM urls WHERE url = ?', (url,)
+            ).fetchone()
+        if row is None or self.store.path(row[0]) is None:  # type: ignore
+            return None
+        return {'digest': row[0], 'mime_type': row[1], 'etag': row[2], 'last_modified': row[3]}
+
+    def _read_body(self, url: str, response: requests.Response) -> bytes:
+        """
+        Reads a streamed response body, aborting as soon as it exceeds max_bytes.
+        """
+        content_length = response.headers.get('Content-Length')
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            raise ImageFetchError(f'Image at {url} is {content_length} bytes, larger than {self.max_bytes} bytes')
+        body = bytearray()
+        for chunk in response.iter_content(chunk_size=self.chunk_size):
+            body += chunk
+            if len(body) > self.max_bytes:
+                raise ImageFetchError(f'Image at {url} is larger than {self.max_bytes} bytes')
+        return bytes(body)
+
+    def fetch(self, url: str) -> ImageBytes:
+        """
+        Downloads an image.
+
+        :param str url: URL of the image
+        :return: The downloaded image
+        :rtype: ImageBytes
+        :raises ImageFetchError: if the image can not be downloaded
+        """
+        image = self._fetch(url, self._cached(url))
+        if image is None:
+            # the cached body was evicted after the lookup, it is downloaded again without validators
+            image = self._fetch(url, None)
+        return image  # type: ignore
+
+    def _fetch(self, url: str, cached: Optional[Dict[str, Any]]) -> Optional[ImageBytes]:
+        """
+        Downloads an image, conditionally when a cache entry is given.
+
+        :return: The image, None if the server answered 304 but the cached body is no longer stored
+        :rtype: ImageBytes
+        """
+        headers = {}
+        if cached is not None:
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+        policy = self._host_policy(url)
+        try:
+            response = policy.call(
+                lambda: self.session.get(url, headers=headers, stream=True, timeout=policy.requests_timeout),
+                hedge=False,
+            )
+        except (requests.RequestException, CircuitOpenError) as e:
+            raise ImageFetchError(f"Can't retrieve image from URL {url}: {e}") from e
+        with response:
+            if response.status_code == 304 and cached is not None:
+                data = self.store.open(cached['digest'])  # type: ignore
+                if data is None:
+                    return None
+                return ImageBytes(data, mime_type=cached['mime_type'])
+            if response.status_code != 200:
+                raise ImageFetchError(f'Unable to retrieve image from URL status code {response.status_code}')
+            mime_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if not mime_type.startswith('image/'):
+                raise ImageFetchError(f'The URL {url} does not link to an image, Content-Type: {mime_type or None}')
+            try:
+                body = self._read_body(url, response)
+            except requests.RequestException as e:
+                raise ImageFetchError(f"Can't retrieve image from URL {url}: {e}") from e
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+        image = ImageBytes(body, mime_type=mime_type)
+        # images larger than the whole cache are not cached
+        cacheable = self.store is not None and (self.store.max_bytes is None or len(body) <= self.store.max_bytes)
+        if cacheable and (etag or last_modified):
+            digest = self.store.put(body, name=url, mime_type=mime_type, digest=image.digest)
+            with self._lock:
+                self._connection.execute(  # type: ignore
+                    'INSERT OR REPLACE INTO urls (url, digest, mime_type, etag, last_modified, fetched_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (url, digest, mime_type, etag, last_modified, time.time()),
+                )
+        return image
+
+    def fetch_many(
+        self, urls: Sequence[str], max_concurrency: int = 8, return_exceptions: bool = False
+    ) -> List[Union[ImageBytes, Exception]]:
+        """
+        Downloads several images concurrently, results are returned in input order.
+
+        :param list urls: URLs of the images
+        :param int max_concurrency: maximum number of concurrent downloads
+        :param bool return_exceptions: return the raised exceptions in place of failed downloads instead of raising
+        :return: The downloaded images
+        :rtype: list
+        """
+        if len(urls) <= 1:
+            return [self.fetch(url) for url in urls]
+        with ThreadPoolExecutor(max_workers=min(max_concurrency, len(urls))) as executor:
+            futures = [executor.submit(self.fetch, url) for url in urls]
+            results: List[Union[ImageBytes, Exception]] = []
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    results.append(e)
+        return results
@@ -0,0 +1,273 @@
+"""Typed image inputs and cheap image source detection for the Sambanova multimodal wrapper."""
+
+import base64
+import binascii
+import hashlib
+import mmap
+import os
+from pathlib import Path
+from typing import Iterator, Optional, Union
+from urllib.parse import urlsplit
+
+# magic headers of the supported image formats
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+)
+# number of leading base64 characters decoded to sniff the image header, decodes to 12 bytes
+SNIFF_B64_CHARS = 16
+# longer strings are never treated as file paths, avoids a filesystem stat on base64 payloads
+MAX_PATH_LENGTH = 4096
+
+def sniff_mime_type(header: bytes) -> Optional[str]:
+    """
+    Returns the MIME type of an image from its leading bytes.
+
+    :param bytes header: at least the first 12 bytes of the image
+    :return: The MIME type, None if the header does not match a supported format
+    :rtype: str
+    """
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return mime_type
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def sniff_base64_mime_type(image_b64: str) -> Optional[str]:
+    """
+    Returns the MIME type of a base64 encoded image decoding only its leading characters.
+
+    :param str image_b64: base64 encoded image
+    :return: The MIME type, None if the string is not a base64 encoded supported image
+    :rtype: str
+    """
+    try:
+        header = base64.b64decode(image_b64[:SNIFF_B64_CHARS], validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    return sniff_mime_type(header)
+
+
+class ImageInput:
+    """
+    Base class of the typed image inputs.
+    """
+
+
+# raw image content, memory mapped files are used as is without copying them
+BytesLike = Union[bytes, mmap.mmap]
+
+
+class ImageBytes(ImageInput):
+    """
+    Image held in memory, keeps both the raw bytes and the base64 encoding once computed
+    so an image is never decoded or encoded twice.
+    """
+
+    def __init__(
+        self, data: Optional[BytesLike] = None, mime_type: Optional[str] = None, b64: Optional[str] = None
+    ) -> None:
+        """
+        Initialize the ImageBytes, at least one of data and b64 should be provided.
+
+        :param bytes data: encoded image bytes or memory mapped image file
+        :param str mime_type: MIME type of the image, sniffed from the header if not provided
+        :param str b64: base64 encoding of the image
+        """
+        if data is None and b64 is None:
+            raise ValueError('ImageBytes requires the image bytes or their base64 encoding')
+        self._data = data
+        self._b64 = b64
+        self._mime_type = mime_type
+        self._digest: Optional[str] = None
+
+    @property
+    def data(self) -> BytesLike:
+        """Raw image bytes, decoded from base64 on first access."""
+        if self._data is None:
+            self._data = base64.b64decode(self._b64)  # type: ignore
+        return self._data
+
+    @property
+    def b64(self) -> str:
+        """Base64 encoding of the image, encoded on first access."""
+        if self._b64 is None:
+            self._b64 = base64.b64encode(self._data).decode()  # type: ignore
+        return self._b64
+
+    @property
+    def mime_type(self) -> str:
+        """MIME type of the image, image/jpeg if the format is not recognized."""
+        if self._mime_type is None:
+            if self._data is not None:
+                mime_type = sniff_mime_type(self._data[:12])
+            else:
+                mime_type = sniff_base64_mime_type(self._b64)  # type: ignore
+            self._mime_type = mime_type or 'image/jpeg'
+        return self._mime_type
+
+    @property
+    def data_uri(self) -> str:
+        """Data URI of the image."""
+        return f'data:{self.mime_type};base64,{self.b64}'
+
+    @property
+    def b64_length(self) -> int:
+        """Length of the base64 encoding of the image, computed without encoding it."""
+        if self._b64 is not None:
+            return len(self._b64)
+        return (len(self._data) + 2) // 3 * 4  # type: ignore
+
+    def iter_b64(self, chunk_size: int = 48 * 1024) -> Iterator[bytes]:
+        """
+        Yields the base64 encoding of the image as ascii chunks, encoding the raw bytes chunk by chunk
+        so the whole encoding is never held in memory unless it was already computed.
+
+        :param int chunk_size: raw bytes encoded per chunk, rounded down to a multiple of 3
+        :yield: The base64 chunks
+        :rtype: bytes
+        """
+        if self._b64 is not None:
+            for start in range(0, len(self._b64), chunk_size):
+                yield self._b64[start : start + chunk_size].encode('ascii')
+            return
+        chunk_size = max(3, chunk_size - chunk_size % 3)
+        view = memoryview(self._data)  # type: ignore
+        try:
+            for start in range(0, len(view), chunk_size):
+                yield base64.b64encode(view[start : start + chunk_size])
+        finally:
+            view.release()
+
+    @property
+    def digest(self) -> str:
+        """sha256 hex digest of the raw image bytes."""
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.data).hexdigest()
+        return self._digest
+
+    def close(self) -> None:
+        """
+        Releases the memory mapped file holding the image, if any, the image can not be read afterwards.
+        """
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+    def __enter__(self) -> 'ImageBytes':
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        """Size of the raw image bytes, computed from the base64 length and padding without decoding it."""
+        if self._data is not None:
+            return len(self._data)
+        padding = 2 if self._b64.endswith('==') else 1 if self._b64.endswith('=') else 0  # type: ignore
+        return len(self._b64) // 4 * 3 - padding  # type: ignore
+
+
+class Base64Image(ImageBytes):
+    """
+    Base64 encoded image, decoded lazily.
+    """
+
+    def __init__(self, b64: str, mime_type: Optional[str] = None) -> None:
+        """
+        Initialize the Base64Image.
+
+        :param str b64: base64 encoded image
+        :param str mime_type: MIME type of the image, sniffed from the header if not provided
+        """
+        super().__init__(b64=b64.strip(), mime_type=mime_type)
+
+
+class ImagePath(ImageInput):
+    """
+    Image stored in the local filesystem.
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        """
+        Initialize the ImagePath.
+
+        :param str path: path to the image file
+        """
+        self.path = Path(path)
+
+    def load(self) -> ImageBytes:
+        """
+        Memory maps the image file, its content is only paged in when encoded. The mapping holds a file
+        descriptor until the image is closed, use it as a context manager or call close once it is sent.
+
+        :return: The image bytes
+        :rtype: ImageBytes
+        """
+        with open(self.path, 'rb') as image_file:
+            if os.fstat(image_file.fileno()).st_size == 0:
+                return ImageBytes(b'')
+            return ImageBytes(mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+class ImageURL(ImageInput):
+    """
+    Image available at an http(s) URL.
+    """
+
+    def __init__(self, url: str) -> None:
+        """
+        Initialize the ImageURL.
+
+        :param str url: URL of the image
+        """
+        self.url = url
+
+    @property
+    def digest(self) -> str:
+        """sha256 hex digest of the URL."""
+        return hashlib.sha256(self.url.encode()).hexdigest()
+
+
+def is_url(image: str) -> bool:
+    """
+    Returns True if the string is an http(s) url, query strings and extension-less paths are accepted
+    since the downloaded Content-Type tells whether it links to an image.
+
+    :param str image: The string to check.
+    :rtype: bool
+    """
+    if any(character.isspace() for character in image):
+        return False
+    try:
+        parts = urlsplit(image)
+    except ValueError:
+        return False
+    return parts.scheme in ('http', 'https') and bool(parts.netloc)
+
+
+def detect_image_input(image: Union[str, bytes, ImageInput]) -> ImageInput:
+    """
+    Classifies an image given as an url, a path, a base64 string or raw bytes in a single cheap pass,
+    only the leading base64 characters are decoded and long strings are never looked up on disk.
+
+    :param image: image to classify
+    :return: The typed image input
+    :rtype: ImageInput
+    """
+    if isinstance(image, ImageInput):
+        return image
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return ImageBytes(bytes(image))
+    if image.startswith(('http://', 'https://')) and is_url(image):
+        return ImageURL(image)
+    stripped = image.strip()
+    if len(stripped) % 4 == 0 and sniff_base64_mime_type(stripped) is not None:
+        return Base64Image(stripped)
+    if len(image) <= MAX_PATH_LENGTH and '\n' not in image and Path(image).is_file():
+        return ImagePath(image)
+    raise ValueError('images should be provided as an url, a path or as a base64 encoded image')
@@ -0,0 +1,162 @@
+"""Image preprocessing applied before images are base64 encoded into request payloads."""
+
+import threading
+import time
+from io import BytesIO
+from typing import Any, Dict, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+FORMAT_MIME_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+    'GIF': 'image/gif',
+    'BMP': 'image/bmp',
+}
+
+
+class ImagePreprocessor:
+    """
+    Downsizes and re-encodes images so request payloads stay small.
+    """
+
+    def __init__(
+        self,
+        max_side: Optional[int] = 1536,
+        image_format: str = 'JPEG',
+        quality: int = 85,
+        grayscale: bool = False,
+    ) -> None:
+        """
+        Initialize the ImagePreprocessor.
+
+        :param int max_side: maximum length in pixels of the longest image side, None to keep the resolution
+        :param str image_format: target format, one of JPEG, PNG or WEBP
+        :param int quality: encoder quality for lossy formats
+        :param bool grayscale: convert images to single channel, useful for SEM / optical micrographs
+        """
+        image_format = image_format.upper()
+        if image_format == 'JPG':
+            image_format = 'JPEG'
+        if image_format not in ('JPEG', 'PNG', 'WEBP'):
+            raise ValueError(f'Unsupported image format: {image_format}, only JPEG, PNG and WEBP are supported')
+        self.max_side = max_side
+        self.image_format = image_format
+        self.quality = quality
+        self.grayscale = grayscale
+        self.total_bytes_before = 0
+        self.total_bytes_after = 0
+        self._lock = threading.Lock()
+
+    @property
+    def mime_type(self) -> str:
+        """MIME type of the images produced by the preprocessor."""
+        return FORMAT_MIME_TYPES[self.image_format]
+
+    def _needs_processing(self, image: Image.Image) -> bool:
+        """
+        Returns True if the image does not already match the target size, format and mode.
+        Only the image header is needed, pixels are not decoded.
+
+        :param Image image: lazily opened image
+        :rtype: bool
+        """
+        if image.format != self.image_format:
+            return True
+        if self.max_side is not None and max(image.size) > self.max_side:
+            return True
+        if self.grayscale and image.mode != 'L':
+            return True
+        return False
+
+    def _encode(self, image: Image.Image) -> bytes:
+        """
+        Resizes, converts and encodes an image to the target format.
+
+        :param Image image: image to encode
+        :return: The encoded image bytes
+        :rtype: bytes
+        """
+        image = ImageOps.exif_transpose(image)
+        if self.max_side is not None and max(image.size) > self.max_side:
+            image = image.copy()
+            image.thumbnail((self.max_side, self.max_side), Image.Resampling.LANCZOS)
+        if self.grayscale:
+            image = image.convert('L')
+        elif self.image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        elif image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        buffered = BytesIO()
+        save_kwargs: Dict[str, Any] = {'format': self.image_format}
+        if self.image_format in ('JPEG', 'WEBP'):
+            save_kwargs['quality'] = self.quality
+        if self.image_format == 'PNG':
+            save_kwargs['optimize'] = True
+        image.save(buffered, **save_kwargs)
+        return buffered.getvalue()
+
+    def _report(
+        self, bytes_before: int, bytes_after: int, start: float, size_before: Any, size_after: Any
+    ) -> Dict[str, Any]:
+        """
+        Adds the before / after sizes of a processed image to the totals and returns them.
+        """
+        with self._lock:
+            self.total_bytes_before += bytes_before
+            self.total_bytes_after += bytes_after
+        return {
+            'bytes_before': bytes_before,
+            'bytes_after': bytes_after,
+            'encode_seconds': time.perf_counter() - start,
+            'size_before': size_before,
+            'size_after': size_after,
+            'format': self.image_format,
+        }
+
+    def process(self, image_bytes: bytes) -> Tuple[bytes, Dict[str, Any]]:
+        """
+        Preprocesses an encoded image. Images already matching the target size, format and mode
+        are returned unchanged.
+
+        :param bytes image_bytes: encoded image
+        :return: The preprocessed encoded image and its report: bytes_before, bytes_after, encode_seconds,
+            size_before, size_after and format
+        :rtype: tuple
+        """
+        start = time.perf_counter()
+        image = Image.open(BytesIO(image_bytes))
+        size_before = image.size
+        if not self._needs_processing(image):
+            return image_bytes, self._report(len(image_bytes), len(image_bytes), start, size_before, size_before)
+        processed = self._encode(image)
+        size_after = Image.open(BytesIO(processed)).size
+        return processed, self._report(len(image_bytes), len(processed), start, size_before, size_after)
+
+    def process_image(self, image: Image.Image) -> Tuple[bytes, Dict[str, Any]]:
+        """
+        Preprocesses an in memory PIL image, bytes_before is reported as the raw pixel size.
+
+        :param Image image: image to preprocess
+        :return: The preprocessed encoded image and its report, as returned by process
+        :rtype: tuple
+        """
+        start = time.perf_counter()
+        raw_bytes = image.width * image.height * len(image.getbands())
+        processed = self._encode(image)
+        size_after = Image.open(BytesIO(processed)).size
+        return processed, self._report(raw_bytes, len(processed), start, image.size, size_after)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the cumulative bytes before and after preprocessing.
+
+        :rtype: dict
+        """
+        ratio = self.total_bytes_after / self.total_bytes_before if self.total_bytes_before else 1.0
+        return {
+            'bytes_before': self.total_bytes_before,
+            'bytes_after': self.total_bytes_after,
+            'compression_ratio': ratio,
+        }
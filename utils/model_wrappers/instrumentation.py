@@ -0,0 +1,425 @@
+"""Per call latency, payload and token instrumentation with an in-process metrics registry and exporters."""
+
+import contextvars
+import json
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+# quantiles reported by the registry summaries and exporters
+QUANTILES = (0.5, 0.95, 0.99)
+
+# spans of a call, recorded as <prefix>_<span>_seconds
+SPANS = ('load', 'queue', 'send', 'ttfb', 'ttft', 'total')
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class InstrumentationHook:
+    """
+    Receives the finished call traces, subclasses export them to a metrics backend.
+    """
+
+    def on_call_end(self, trace: 'CallTrace') -> None:
+        """
+        Called once per call when it finishes or fails.
+
+        :param CallTrace trace: finished call trace
+        """
+        raise NotImplementedError
+
+
+class CallTrace:
+    """
+    Timings, payload size and token usage of a single model call.
+
+    Spans are seconds, either measured around a block with span or since the call start with mark,
+    values are numbers such as payload_bytes, prompt_tokens and completion_tokens.
+    """
+
+    def __init__(
+        self,
+        client: str,
+        method: str,
+        endpoint: str = '',
+        hooks: Optional[Sequence[InstrumentationHook]] = None,
+    ) -> None:
+        """
+        Initialize the CallTrace.
+
+        :param str client: name of the client making the call
+        :param str method: client method, e.g. invoke or stream
+        :param str endpoint: kind of endpoint called, e.g. openai or generic
+        :param list hooks: hooks receiving the trace when it finishes
+        """
+        self.client = client
+        self.method = method
+        self.endpoint = endpoint
+        self.hooks = list(hooks or [])
+        self.started = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+        self.values: Dict[str, float] = {}
+        self.error: Optional[str] = None
+        self.status_code: Optional[int] = None
+        self.finished = False
+
+    @property
+    def labels(self) -> Dict[str, str]:
+        """Labels of the metrics emitted for the call."""
+        return {'client': self.client, 'method': self.method, 'endpoint': self.endpoint}
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """
+        Records the duration of a block, durations of the same span add up.
+
+        :param str name: span name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[name] = self.spans.get(name, 0.0) + time.perf_counter() - start
+
+    def mark(self, name: str) -> None:
+        """
+        Records the seconds elapsed since the call start, only the first mark of a name is kept.
+
+        :param str name: span name
+        """
+        if name not in self.spans:
+            self.spans[name] = time.perf_counter() - self.started
+
+    def set(self, name: str, value: Optional[float]) -> None:
+        """
+        Records a value of the call, None values are ignored.
+
+        :param str name: value name
+        :param float value: value
+        """
+        if value is not None:
+            self.values[name] = value
+
+    def set_usage(self, usage: Optional[Dict[str, Any]]) -> None:
+        """
+        Records the token counts of an openai compatible usage field.
+
+        :param dict usage: usage field of the response
+        """
+        if not usage:
+            return
+        self.set('prompt_tokens', usage.get('prompt_tokens'))
+        self.set('completion_tokens', usage.get('completion_tokens'))
+        self.set('cached_tokens', (usage.get('prompt_tokens_details') or {}).get('cached_tokens'))
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        """
+        Records the total latency and sends the trace to the hooks, later calls are ignored.
+
+        :param Exception error: exception raised by the call if it failed
+        """
+        if self.finished:
+            return
+        self.finished = True
+        self.spans['total'] = time.perf_counter() - self.started
+        if error is not None:
+            self.error = type(error).__name__
+        for hook in self.hooks:
+            hook.on_call_end(self)
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Returns the recorded spans and values.
+
+        :rtype: dict
+        """
+        return {
+            **self.labels,
+            'spans': dict(self.spans),
+            'values': dict(self.values),
+            'error': self.error,
+            'status_code': self.status_code,
+        }
+
+
+class _NullTrace(CallTrace):
+    """
+    Trace used outside instrumented calls, records nothing. It is shared, so attribute writes such as
+    status_code are ignored once initialized.
+    """
+
+    def __init__(self) -> None:
+        super().__init__('', '')
+        object.__setattr__(self, '_initialized', True)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        if not getattr(self, '_initialized', False):
+            object.__setattr__(self, name, value)
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        yield
+
+    def mark(self, name: str) -> None:
+        pass
+
+    def set(self, name: str, value: Optional[float]) -> None:
+        pass
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        pass
+
+
+NULL_TRACE = _NullTrace()
+
+_current_trace: contextvars.ContextVar[CallTrace] = contextvars.ContextVar('call_trace', default=NULL_TRACE)
+
+
+def current_trace() -> CallTrace:
+    """
+    Returns the trace of the call being made in the current context, a trace recording nothing if none.
+
+    :rtype: CallTrace
+    """
+    return _current_trace.get()
+
+
+@contextmanager
+def use_trace(trace: CallTrace) -> Iterator[CallTrace]:
+    """
+    Makes a trace the current one inside the context. The context must not span a yield of a generator.
+
+    :param CallTrace trace: trace of the call
+    """
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    """Formats Prometheus labels, escaping backslashes, quotes and newlines of the values."""
+    if not labels:
+        return ''
+    escaped = []
+    for key, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{key}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+class MetricsRegistry:
+    """
+    In-process metrics: a summary per metric name and label set, with the count and sum of all observations
+    and quantiles computed over the last window observations, and counters.
+    """
+
+    def __init__(self, window: int = 1024) -> None:
+        """
+        Initialize the MetricsRegistry.
+
+        :param int window: number of most recent observations kept per summary for the quantiles
+        """
+        self.window = window
+        self._lock = threading.Lock()
+        self._summaries: Dict[str, Dict[Labels, List[Any]]] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+
+    @staticmethod
+    def _labels(labels: Optional[Dict[str, str]]) -> Labels:
+        return tuple(sorted((labels or {}).items()))
+
+    def observe(self, name: str, value: float, labels: Optional[Dict[str, str]] = None) -> None:
+        """
+        Records an observation of a summary metric.
+
+        :param str name: metric name
+        :param float value: observed value
+        :param dict labels: metric labels
+        """
+        key = self._labels(labels)
+        with self._lock:
+            series = self._summaries.setdefault(name, {}).get(key)
+            if series is None:
+                series = self._summaries[name][key] = [0, 0.0, deque(maxlen=self.window)]
+            series[0] += 1
+            series[1] += value
+            series[2].append(value)
+
+    def increment(self, name: str, labels: Optional[Dict[str, str]] = None, amount: float = 1) -> None:
+        """
+        Increments a counter metric.
+
+        :param str name: metric name
+        :param dict labels: metric labels
+        :param float amount: increment
+        """
+        key = self._labels(labels)
+        with self._lock:
+            counters = self._counters.setdefault(name, {})
+            counters[key] = counters.get(key, 0) + amount
+
+    @staticmethod
+    def _quantile(values: List[float], quantile: float) -> float:
+        """Returns the nearest rank quantile of sorted values, the value of rank ceil(quantile * n)."""
+        # rounded first so float products such as 0.07 * 100 = 7.000000000000001 keep their exact rank
+        return values[min(len(values) - 1, max(0, math.ceil(round(quantile * len(values), 9)) - 1))]
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Returns the current state of the metrics.
+
+        :return: summaries as {name: [{labels, count, sum, quantiles}]} and counters as {name: [{labels, value}]}
+        :rtype: dict
+        """
+        with self._lock:
+            summaries = {
+                name: [(key, count, total, sorted(values)) for key, (count, total, values) in series.items()]
+                for name, series in self._summaries.items()
+            }
+            counters = {name: list(series.items()) for name, series in self._counters.items()}
+        return {
+            'summaries': {
+                name: [
+                    {
+                        'labels': dict(key),
+                        'count': count,
+                        'sum': total,
+                        'quantiles': {str(q): self._quantile(values, q) for q in QUANTILES} if values else {},
+                    }
+                    for key, count, total, values in series
+                ]
+                for name, series in summaries.items()
+            },
+            'counters': {
+                name: [{'labels': dict(key), 'value': value} for key, value in series]
+                for name, series in counters.items()
+            },
+        }
+
+    def to_json(self) -> str:
+        """
+        Exports the metrics as JSON.
+
+        :rtype: str
+        """
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self) -> str:
+        """
+        Exports the metrics in the Prometheus text exposition format.
+
+        :rtype: str
+        """
+
+        snapshot = self.snapshot()
+        lines = []
+        for name, series in sorted(snapshot['summaries'].items()):
+            lines.append(f'# TYPE {name} summary')
+            for item in series:
+                for quantile, value in item['quantiles'].items():
+                    lines.append(f"{name}{_format_labels({**item['labels'], 'quantile': quantile})} {value}")
+                lines.append(f"{name}_sum{_format_labels(item['labels'])} {item['sum']}")
+                lines.append(f"{name}_count{_format_labels(item['labels'])} {item['count']}")
+        for name, series in sorted(snapshot['counters'].items()):
+            lines.append(f'# TYPE {name} counter')
+            for item in series:
+                lines.append(f"{name}{_format_labels(item['labels'])} {item['value']}")
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path: str, format: str = 'prometheus') -> None:
+        """
+        Writes the metrics to a file, for offline scraping or inspection.
+
+        :param str path: output file path
+        :param str format: 'prometheus' or 'json'
+        """
+        if format not in ('prometheus', 'json'):
+            raise ValueError("format should be 'prometheus' or 'json'")
+        with open(path, 'w') as f:
+            f.write(self.to_prometheus() if format == 'prometheus' else self.to_json())
+
+    def reset(self) -> None:
+        """Removes every metric."""
+        with self._lock:
+            self._summaries.clear()
+            self._counters.clear()
+
+
+class RegistryHook(InstrumentationHook):
+    """
+    Records the call traces in a MetricsRegistry as <prefix>_<span>_seconds, <prefix>_<value> summaries
+    and a <prefix>_calls_total counter labelled by status.
+    """
+
+    def __init__(self, registry: MetricsRegistry, prefix: str = 'model') -> None:
+        """
+        Initialize the RegistryHook.
+
+        :param MetricsRegistry registry: registry recording the metrics
+        :param str prefix: prefix of the metric names
+        """
+        self.registry = registry
+        self.prefix = prefix
+
+    def on_call_end(self, trace: CallTrace) -> None:
+        labels = trace.labels
+        for name, seconds in trace.spans.items():
+            self.registry.observe(f'{self.prefix}_{name}_seconds', seconds, labels)
+        for name, value in trace.values.items():
+            self.registry.observe(f'{self.prefix}_{name}', value, labels)
+        status = 'ok' if trace.error is None else 'error'
+        self.registry.increment(
+            f'{self.prefix}_calls_total', {**labels, 'status': status, 'error': trace.error or ''}
+        )
+
+
+_registries: Dict[str, MetricsRegistry] = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(name: str = 'default', **kwargs: Any) -> MetricsRegistry:
+    """
+    Returns the process wide metrics registry of a name, created with kwargs on first use.
+
+    :param str name: registry name
+    :rtype: MetricsRegistry
+    """
+    with _registries_lock:
+        registry = _registries.get(name)
+        if registry is None:
+            registry = _registries[name] = MetricsRegistry(**kwargs)
+        return registry
+
+
+def trace_chat_stream(stream: Iterable[Any], trace: CallTrace) -> Iterator[str]:
+    """
+    Yields the content deltas of an openai client chat completion stream, recording the time to first token,
+    the token usage of the final chunk and finishing the trace when the stream ends or fails.
+    The time to first byte should be marked by the caller once the stream is opened.
+
+    :param iterable stream: openai client stream of chat completion chunks
+    :param CallTrace trace: trace of the call
+    :yield: The content deltas
+    :rtype: str
+    """
+    try:
+        for chunk in stream:
+            if getattr(chunk, 'usage', None) is not None:
+                trace.set_usage(chunk.usage.model_dump())
+            if chunk.choices:
+                content = chunk.choices[0].delta.content
+                if content:
+                    trace.mark('ttft')
+                    yield content
+    except GeneratorExit:
+        trace.finish()
+        raise
+    except BaseException as e:
+        trace.finish(e)
+        raise
+    trace.finish()
@@ -1,15 +1,68 @@
 """Wrapper around Sambanova multimodal APIs."""
 
-import base64
-import json
+import asyncio
+import contextvars
 import os
-import re
-import openai
+import weakref
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import Any, Dict, Generator, Iterator, List, Optional, Union
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Sized,
+    Tuple,
+    Union,
+)
+from urllib.parse import urlsplit
 
+import httpx
 import requests
-import sseclient
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+from utils.model_wrappers.image_inputs import (
+    ImageBytes,
+    ImageInput,
+    ImagePath,
+    ImageURL,
+    detect_image_input,
+    is_url,
+    sniff_base64_mime_type,
+)
+from utils.model_wrappers.image_fetcher import ImageFetcher
+from utils.model_wrappers.image_preprocessing import ImagePreprocessor
+from utils.model_wrappers.instrumentation import CallTrace, InstrumentationHook, current_trace, use_trace
+from utils.model_wrappers.payload_encoder import Base64Field, StreamingJSONBody
+from utils.model_wrappers.pdf_inputs import PDFPage, load_pdf_pages
+from utils.model_wrappers.prompt_templates import GENERIC_CHAT_TEMPLATE, TILE_PROMPT_TEMPLATE
+from utils.model_wrappers.rate_limiter import RequestScheduler, Ticket, scheduling_context
+from utils.model_wrappers.resilience import ResiliencePolicy
+from utils.model_wrappers.response_cache import BaseResponseCache, make_cache_key
+from utils.model_wrappers.sse import (
+    StreamDecodeError,
+    StreamEventError,
+    aiter_openai_stream,
+    iter_openai_stream,
+    json_loads,
+)
+from utils.model_wrappers.tiling import ImageTile, ImageTiler, merge_tile_answers
+
+# a single image: url, path, base64 string, raw bytes or typed image input
+ImagesInput = Union[str, bytes, ImageInput]
+# rough number of prompt tokens taken by an image, used for rate limiting estimates
+IMAGE_TOKENS_ESTIMATE = 1600
+# batch inputs are either {'prompt': ..., 'images': ...} dicts or (prompt, images) pairs
+BatchInput = Union[Dict[str, Any], Tuple[Optional[str], Optional[Union[ImagesInput, List]]]]
+# progress callbacks receive (completed, total, index, result), total is None for unsized inputs
+ProgressCallback = Callable[[int, Optional[int], int, Any], None]
 
 
 class SambastudioMultimodal:
@@ -28,6 +81,14 @@ class SambastudioMultimodal:
         top_k: int = 1,
         stop: Optional[List[str]] = None,
         do_sample: bool = False,
+        max_connections: int = 100,
+        max_concurrency: int = 64,
+        cache: Optional[BaseResponseCache] = None,
+        preprocessor: Optional[ImagePreprocessor] = None,
+        resilience: Optional[ResiliencePolicy] = None,
+        scheduler: Optional[RequestScheduler] = None,
+        fetcher: Optional[ImageFetcher] = None,
+        hooks: Optional[Sequence[InstrumentationHook]] = None,
     ) -> None:
         """
         Initialize the SambastudioMultimodal.
@@ -41,6 +102,16 @@ class SambastudioMultimodal:
         :param int top_k: model top k,
         :param list stop: list of token to stop generation when stop token is found
         :param bool do_sample: whether to do sample for model generation
+        :param int max_connections: size of the keep-alive connection pool shared by sync and async calls
+        :param int max_concurrency: maximum number of in-flight async requests per event loop
+        :param BaseResponseCache cache: optional response cache used by invoke when sampling is deterministic
+        :param ImagePreprocessor preprocessor: optional downsizing / re-encoding applied to images before upload
+        :param ResiliencePolicy resilience: timeouts, retries, circuit breaker and hedging applied to every call,
+            defaults to ResiliencePolicy()
+        :param RequestScheduler scheduler: optional rate limiter shared by the clients using the same API key
+        :param ImageFetcher fetcher: downloader of the URL images, defaults to an uncached ImageFetcher
+            sharing the connection pool and resilience policy
+        :param list hooks: instrumentation hooks receiving the latency, payload and token trace of every call
         """
         self.base_url = base_url
         if self.base_url is None:
@@ -57,7 +128,24 @@ class SambastudioMultimodal:
         if stop is None:
             self.stop = []
         self.do_sample = do_sample
+        self.max_connections = max_connections
+        self.max_concurrency = max_concurrency
+        self.cache = cache
+        self.preprocessor = preprocessor
+        self.resilience = resilience if resilience is not None else ResiliencePolicy()
+        self.scheduler = scheduler
         self.http_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.http_session.mount('https://', adapter)
+        self.http_session.mount('http://', adapter)
+        self.fetcher = fetcher
+        self.hooks = list(hooks or [])
+        if self.fetcher is None:
+            # same timeouts and retries as the model API, image hosts get circuit breakers of their own
+            self.fetcher = ImageFetcher(session=self.http_session, resilience=self.resilience)
+        # async clients and semaphores are bound to the event loop they were created in,
+        # the pools of closed loops are dropped when a new pool is created
+        self._async_pools: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
 
     def image_to_base64(self, image_path: str) -> str:
         """
@@ -67,10 +155,23 @@ class SambastudioMultimodal:
         :return: The base64 encoded string representation of the image.
         rtype: str
         """
-        with open(image_path, 'rb') as image_file:
-            image_binary = image_file.read()
-            base64_image = base64.b64encode(image_binary).decode()
-            return base64_image
+        with ImagePath(image_path).load() as image:
+            return self._preprocess(image).b64
+
+    def _preprocess(self, image: ImageBytes) -> ImageBytes:
+        """
+        Applies the image preprocessor if any, the same image is returned if it is left unchanged.
+
+        :param ImageBytes image: image to preprocess
+        :return: The preprocessed image
+        :rtype: ImageBytes
+        """
+        if self.preprocessor is None:
+            return image
+        processed, _ = self.preprocessor.process(image.data)
+        if processed is image.data:
+            return image
+        return ImageBytes(processed, mime_type=self.preprocessor.mime_type)
 
     def url_to_b64(self, url: str) -> str:
         """
@@ -80,16 +181,17 @@ class SambastudioMultimodal:
         :return: The base64 encoded string representation of the image.
         :rtype: str
         """
-        response = requests.get(url)
-        try:
-            if response.status_code == 200:
-                image_binary = response.content
-                base64_image = base64.b64encode(image_binary).decode()
-                return base64_image
-            else:
-                raise ValueError(f'Unable to retrieve image from URL status code {response.status_code}')
-        except Exception as e:
-            raise ValueError(f"Can't encode image to b64 from provided url: {e}")
+        return self._url_to_image(url).b64
+
+    def _url_to_image(self, url: str) -> ImageBytes:
+        """
+        Downloads an image from a URL.
+
+        :param str url: The URL of the image.
+        :return: The downloaded image
+        :rtype: ImageBytes
+        """
+        return self._preprocess(self.fetcher.fetch(url))  # type: ignore
 
     def _is_base64_encoded(self, image: str) -> bool:
         """
@@ -104,24 +206,8 @@ class SambastudioMultimodal:
         if len(image) % 4 != 0:
             return False
 
-        try:
-            # Decode the base64 string
-            base64_bytes = base64.b64decode(image, validate=True)
-
-            # Check if it starts with common image file headers
-            if base64_bytes.startswith(b'\xff\xd8\xff'):  # JPEG
-                return True
-            elif base64_bytes.startswith(b'\x89PNG\r\n\x1a\n'):  # PNG
-                return True
-            elif base64_bytes.startswith(b'GIF87a') or base64_bytes.startswith(b'GIF89a'):  # GIF
-                return True
-            elif base64_bytes.startswith(b'BM'):  # BMP
-                return True
-            else:
-                return False
-        except Exception as e:
-            # print(f"Exception: {e}")
-            return False
+        # only the leading characters are decoded to check the image file header
+        return sniff_base64_mime_type(image) is not None
 
     def _is_file_path(self, image: str) -> bool:
         """
@@ -141,9 +227,7 @@ class SambastudioMultimodal:
         :return: True if the string is an url, False otherwise.
         :rtype: bool
         """
-        regex = re.compile(r'^(https?://.*\.(?:png|jpg|jpeg|gif|bmp|webp|svg))$', re.IGNORECASE)
-
-        return re.match(regex, image) is not None
+        return is_url(image)
 
     def _process_generic_api_response(self, response: Dict) -> str:
         """
@@ -179,54 +263,130 @@ class SambastudioMultimodal:
             )
         return generation
 
-    def _process_openai_api_response_stream(self, response: requests.Response) -> Generator[Dict, None, None]:
+    def _usage_recorder(self, usage: Dict[str, Any]) -> Callable[[Dict[str, Any]], None]:
+        """
+        Returns the callback recording the token usage of a streamed response in the current call trace
+        and in a dict, for the scheduler.
+
+        :param dict usage: receives the usage field of the final event
+        :rtype: callable
+        """
+        trace = current_trace()
+
+        def record(values: Dict[str, Any]) -> None:
+            trace.set_usage(values)
+            usage.update(values)
+
+        return record
+
+    def _process_openai_api_response_stream(
+        self, response: requests.Response, usage: Dict[str, Any]
+    ) -> Generator[str, None, None]:
         """
-        Processes the generic API response and yields the resulting string.
+        Processes the openai compatible API streamed response and yields the resulting strings.
 
-        :param response: The API response iterator
+        :param response: The streamed API response
+        :param dict usage: receives the token usage sent in the final event
         :yield: The response text
         :rtype: str
         """
-        client = sseclient.SSEClient(response)
-        for event in client.events():
-            chunk = {
-                'event': event.event,
-                'data': event.data,
-                'status_code': response.status_code,
-            }
-            if chunk['event'] == 'error_event' or chunk['status_code'] != 200:
-                raise RuntimeError(
-                    f"Sambanova /complete call failed with status code " f"{chunk['status_code']}." f"{chunk}."
-                )
-            try:
-                # check if the response is a final event
-                # in that case event data response is '[DONE]'
-                if chunk['data'] != '[DONE]':
-                    if isinstance(chunk['data'], str):
-                        data = json.loads(chunk['data'])
-                    else:
-                        raise RuntimeError(
-                            f"Sambanova /complete call failed with status code " f"{chunk['status_code']}." f"{chunk}."
-                        )
-                    if data.get('error'):
-                        raise RuntimeError(
-                            f"Sambanova /complete call failed with status code " f"{chunk['status_code']}." f"{chunk}."
-                        )
-                    if len(data['choices']) > 0:
-                        yield data['choices'][0]['delta'].get('content', '')
-            except Exception:
-                raise Exception(f'Error getting content chunk raw streamed response: {chunk}')
+        yield from iter_openai_stream(response.iter_content(chunk_size=None), on_usage=self._usage_recorder(usage))
 
-    def _call_generic_api(self, prompt: str, image_b64: str) -> Dict:
+    async def _aprocess_openai_api_response_stream(
+        self, response: httpx.Response, usage: Dict[str, Any]
+    ) -> AsyncIterator[str]:
         """
-        Calls the Sambastudio multimodal generic endpoint to generate a response.
+        Processes the openai compatible API streamed response and yields the resulting strings.
+
+        :param httpx.Response response: The streamed API response
+        :param dict usage: receives the token usage sent in the final event
+        :yield: The response text
+        :rtype: str
+        """
+        async for content in aiter_openai_stream(response.aiter_bytes(), on_usage=self._usage_recorder(usage)):
+            yield content
+
+    def _process_generic_api_stream_line(self, line: str) -> Optional[str]:
+        """
+        Processes a single line of the generic API streamed response.
+
+        Lines are json objects, optionally prefixed with 'data:' when served as server sent events,
+        holding the token either in result.responses[0] (v1 API) or result.items[0].value (v2 API).
+
+        :param str line: The response line
+        :return: The streamed token, None when the line carries no token
+        :rtype: str
+        """
+        line = line.strip()
+        if line.startswith('data:'):
+            line = line[5:].strip()
+        if not line or line.startswith((':', 'event:', 'id:', 'retry:')) or line == '[DONE]':
+            return None
+        try:
+            data = json_loads(line)
+        except ValueError as e:
+            raise StreamDecodeError(f'Error getting content chunk raw streamed response: {line}') from e
+        if not isinstance(data, dict):
+            raise StreamDecodeError(f'Error getting content chunk raw streamed response: {line}')
+        if data.get('error'):
+            raise StreamEventError(f'Sambastudio multimodal generic stream call failed. Details: {line}')
+        try:
+            result = data['result']
+            if 'responses' in result:
+                token = result['responses'][0].get('stream_token', '')
+            else:
+                token = result['items'][0]['value'].get('stream_token', '')
+        except (KeyError, IndexError, TypeError) as e:
+            raise StreamDecodeError(f'Error getting content chunk raw streamed response: {line}') from e
+        return token
+
+    def _process_generic_api_response_stream(self, response: requests.Response) -> Generator[str, None, None]:
+        """
+        Processes the generic API streamed response and yields the resulting strings. Lines are split
+        on the raw bytes and decoded as UTF-8, whatever charset the Content-Type header declares or omits.
+
+        :param response: The streamed API response
+        :yield: The response text
+        :rtype: str
+        """
+        for line in response.iter_lines():
+            token = self._process_generic_api_stream_line(line.decode('utf-8'))
+            if token:
+                yield token
+
+    def _generic_stream_url(self) -> str:
+        """
+        Returns the streaming URL of the generic endpoint.
+
+        :return: The streaming URL
+        :rtype: str
+        """
+        if 'generic/stream' in self.base_url:  # type: ignore
+            return self.base_url  # type: ignore
+        return self.base_url.replace('generic/', 'generic/stream/', 1)  # type: ignore
+
+    def _format_generic_prompt(self, prompt: Optional[str]) -> str:
+        """
+        Formats the prompt with the chat template of the generic endpoint.
+
         :param str prompt: Prompt for the model to generate a response
-        :param str image: Image to be used with the model
-        :return: The request json response
+        :return: The formatted prompt
+        :rtype: str
+        """
+        return GENERIC_CHAT_TEMPLATE.format(prompt=prompt)
+
+    def _build_generic_payload(self, prompt: str, image: ImageBytes) -> Dict[str, Any]:
+        """
+        Builds the request body for the Sambastudio multimodal generic endpoint,
+        the image is base64 encoded while the body is sent.
+
+        :param str prompt: Prompt for the model to generate a response
+        :param ImageBytes image: image to be used with the model
+        :return: The request body
         :rtype: Dict
         """
         data = {
-            'instances': [{'prompt': prompt, 'image_content': f'{image_b64}'}],
+            'instances': [{'prompt': prompt, 'image_content': Base64Field(image, data_uri=False)}],
             'params': {
                 'do_sample': {'type': 'bool', 'value': str(self.do_sample)},
                 'max_tokens_to_generate': {'type': 'int', 'value': str(self.max_tokens_to_generate)},
@@ -236,25 +396,18 @@ class SambastudioMultimodal:
                 'top_p': {'type': 'float', 'value': str(self.top_p)},
             },
         }
-        headers = {'Content-Type': 'application/json', 'key': self.api_key}
-        response = requests.post(self.base_url, headers=headers, data=json.dumps(data))
-        if response.status_code != 200:
-            raise RuntimeError(
-                f'Sambastudio multimodal API call failed with status code {response.status_code}',
-                f'Details: {response.text}',
-            )
-        else:
-            return response.json()
+        return data
 
-    def _call_openai_api(self, prompt: str, images: List) -> Dict:
+    def _build_openai_payload(self, prompt: str, images: List, stream: bool = False) -> Dict[str, Any]:
         """
-        Calls the Sambastudio multimodal openai compatible endpoint to generate a response.
+        Builds the request body for the Sambastudio multimodal openai compatible endpoint.
+
         :param str prompt: Prompt for the model to generate a response
         :param list images: Images to be used with the model
-        :return: The request json response
+        :param bool stream: whether to request a streamed response
+        :return: The request body
         :rtype: Dict
         """
-
         data: Dict[str, Any] = {
             'messages': [
                 {
@@ -268,21 +421,118 @@ class SambastudioMultimodal:
             'temperature': self.temperature,
             'max_tokens': self.max_tokens_to_generate,
             'top_p': self.top_p,
-            'stream': False,
+            'stream': stream,
         }
+        if stream:
+            # the final event then carries the token usage
+            data['stream_options'] = {'include_usage': True}
         if self.stop and len(self.stop) > 1:
             data['stop'] = self.stop
         for image in images:
-            if not self._is_url(image):
-                image = f'data:image/jpeg;base64,{image}'
-            else:
-                # temporal conversion until URL is supported directly by API
-                image = f'data:image/jpeg;base64,{self.url_to_b64(image)}'
+            data['messages'][0]['content'].append({'type': 'image_url', 'image_url': {'url': Base64Field(image)}})
+        return data
+
+    def _traced_body(self, data: Dict[str, Any]) -> StreamingJSONBody:
+        """
+        Returns the streamed request body of a payload, recording its size and the time it is fully sent
+        in the current call trace.
 
-            data['messages'][0]['content'].append({'type': 'image_url', 'image_url': {'url': image}})
+        :param dict data: request payload
+        :rtype: StreamingJSONBody
+        """
+        trace = current_trace()
+        body = StreamingJSONBody(data, on_sent=lambda: trace.mark('send'))
+        trace.set('payload_bytes', len(body))
+        return body
 
-        headers = {'Authorization': f'Bearer {self.api_key}', 'Content-Type': 'application/json'}
-        response = requests.post(self.base_url, headers=headers, data=json.dumps(data))
+    def _trace_response(self, status_code: int) -> None:
+        """
+        Records the time to first byte and status code of a response in the current call trace,
+        for non streamed calls the first byte time includes the download of the response json.
+
+        :param int status_code: response status code
+        """
+        trace = current_trace()
+        trace.mark('ttfb')
+        trace.status_code = status_code
+
+    def _generic_headers(self) -> Dict[str, str]:
+        """Returns the request headers of the generic endpoint."""
+        return {'Content-Type': 'application/json', 'key': self.api_key}
+
+    def _openai_headers(self) -> Dict[str, str]:
+        """Returns the request headers of the openai compatible endpoint."""
+        return {'Authorization': f'Bearer {self.api_key}', 'Content-Type': 'application/json'}
+
+    def _call_generic_api(self, prompt: str, image: ImageBytes) -> Dict:
+        """
+        Calls the Sambastudio multimodal generic endpoint to generate a response.
+        :param str prompt: Prompt for the model to generate a response
+        :param ImageBytes image: Image to be used with the model
+        :return: The request json response
+        :rtype: Dict
+        """
+        data = self._build_generic_payload(prompt, image)
+        body = self._traced_body(data)
+        response = self.resilience.call(
+            lambda: self.http_session.post(
+                self.base_url, headers=self._generic_headers(), data=body, timeout=self.resilience.requests_timeout
+            )
+        )
+        self._trace_response(response.status_code)
+        if response.status_code != 200:
+            raise RuntimeError(
+                f'Sambastudio multimodal API call failed with status code {response.status_code}',
+                f'Details: {response.text}',
+            )
+        else:
+            return response.json()
+
+    def _call_generic_api_stream(self, prompt: str, image: ImageBytes) -> requests.Response:
+        """
+        Calls the Sambastudio multimodal generic endpoint to stream a response.
+
+        :param str prompt: Prompt for the model to stream a response
+        :param ImageBytes image: Image to be used with the model
+        :return: The streamed response
+        :rtype: requests.Response
+        """
+        data = self._build_generic_payload(prompt, image)
+        body = self._traced_body(data)
+        response = self.resilience.call(
+            lambda: self.http_session.post(
+                self._generic_stream_url(),
+                headers=self._generic_headers(),
+                data=body,
+                stream=True,
+                timeout=self.resilience.requests_timeout,
+            ),
+            hedge=False,
+        )
+        self._trace_response(response.status_code)
+        if response.status_code != 200:
+            raise RuntimeError(
+                f'Sambastudio multimodal API call failed with status code {response.status_code}',
+                f'Details: {response.text}',
+            )
+        return response
+
+    def _call_openai_api(self, prompt: str, images: List) -> Dict:
+        """
+        Calls the Sambastudio multimodal openai compatible endpoint to generate a response.
+        :param str prompt: Prompt for the model to generate a response
+        :param list images: Images to be used with the model
+        :return: The request json response
+        :rtype: Dict
+        """
+        data = self._build_openai_payload(prompt, images, stream=False)
+        body = self._traced_body(data)
+        response = self.resilience.call(
+            lambda: self.http_session.post(
+                self.base_url, headers=self._openai_headers(), data=body, timeout=self.resilience.requests_timeout
+            )
+        )
+        self._trace_response(response.status_code)
         if response.status_code != 200:
             raise RuntimeError(
                 f'Sambastudio multimodal API call failed with status code {response.status_code}.',
@@ -299,34 +549,19 @@ class SambastudioMultimodal:
         :return: The request json response
         :rtype: Dict
         """
-
-        data: Dict[str, Any] = {
-            'messages': [
-                {
-                    'role': 'user',
-                    'content': [
-                        {'type': 'text', 'text': f'{prompt}'},
-                    ],
-                }
-            ],
-            'model': self.model,
-            'temperature': self.temperature,
-            'max_tokens': self.max_tokens_to_generate,
-            'top_p': self.top_p,
-            'stream': True,
-        }
-        if self.stop and len(self.stop) > 1:
-            data['stop'] = self.stop
-        for image in images:
-            if not self._is_url(image):
-                image = f'data:image/jpeg;base64,{image}'
-            else:
-                # temporal conversion until URL is supported directly by API
-                image = f'data:image/jpeg;base64,{self.url_to_b64(image)}'
-            data['messages'][0]['content'].append({'type': 'image_url', 'image_url': {'url': image}})
-
-        headers = {'Authorization': f'Bearer {self.api_key}', 'Content-Type': 'application/json'}
-        response = requests.post(self.base_url, headers=headers, data=json.dumps(data), stream=True)
+        data = self._build_openai_payload(prompt, images, stream=True)
+        body = self._traced_body(data)
+        response = self.resilience.call(
+            lambda: self.http_session.post(
+                self.base_url,
+                headers=self._openai_headers(),
+                data=body,
+                stream=True,
+                timeout=self.resilience.requests_timeout,
+            ),
+            hedge=False,
+        )
+        self._trace_response(response.status_code)
         if response.status_code != 200:
             raise RuntimeError(
                 f'Sambastudio multimodal API call failed with status code {response.status_code}.',
@@ -335,96 +570,782 @@ class SambastudioMultimodal:
         else:
             return response
 
-    def _load_images(self, images: Optional[Union[str, List]] = None) -> List[Any]:
+    def _get_async_pool(self) -> Tuple[httpx.AsyncClient, asyncio.Semaphore]:
+        """
+        Returns the pooled async client and the in-flight requests semaphore of the running event loop.
+
+        :return: The async client and semaphore
+        :rtype: Tuple[httpx.AsyncClient, asyncio.Semaphore]
+        """
+        loop = asyncio.get_running_loop()
+        pool = self._async_pools.get(loop)
+        if pool is None:
+            # the clients and semaphores reference their loop, which is never garbage collected while in the pools
+            for closed in [other for other in self._async_pools if other.is_closed()]:
+                del self._async_pools[closed]
+            limits = httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+            )
+            client = httpx.AsyncClient(limits=limits, timeout=self.resilience.httpx_timeout)
+            pool = (client, asyncio.Semaphore(self.max_concurrency))
+            self._async_pools[loop] = pool
+        return pool
+
+    async def _asend_stream(
+        self, client: httpx.AsyncClient, url: str, headers: Dict[str, str], body: StreamingJSONBody
+    ) -> httpx.Response:
+        """
+        Asynchronously sends a streamed request, the caller is responsible for closing the response.
+
+        :param httpx.AsyncClient client: pooled async client
+        :param str url: request URL
+        :param dict headers: request headers
+        :param StreamingJSONBody body: request json body
+        :return: The streamed response
+        :rtype: httpx.Response
+        """
+        headers = {**headers, **body.headers()}
+        response = await self.resilience.acall(
+            lambda: client.send(client.build_request('POST', url, headers=headers, content=body.aiter()), stream=True),
+            hedge=False,
+        )
+        self._trace_response(response.status_code)
+        if response.status_code != 200:
+            await response.aread()
+            await response.aclose()
+            raise RuntimeError(
+                f'Sambastudio multimodal API call failed with status code {response.status_code}.',
+                f'Details: {response.text}',
+            )
+        return response
+
+    async def _acall_generic_api(self, prompt: str, image: ImageBytes) -> Dict:
+        """
+        Asynchronously calls the Sambastudio multimodal generic endpoint to generate a response.
+
+        :param str prompt: Prompt for the model to generate a response
+        :param ImageBytes image: Image to be used with the model
+        :return: The request json response
+        :rtype: Dict
+        """
+        body = self._traced_body(self._build_generic_payload(prompt, image))
+        headers = {**self._generic_headers(), **body.headers()}
+        client, semaphore = self._get_async_pool()
+        async with semaphore:
+            response = await self.resilience.acall(
+                lambda: client.post(self.base_url, headers=headers, content=body.aiter())
+            )
+        self._trace_response(response.status_code)
+        if response.status_code != 200:
+            raise RuntimeError(
+                f'Sambastudio multimodal API call failed with status code {response.status_code}',
+                f'Details: {response.text}',
+            )
+        return response.json()
+
+    async def _acall_openai_api(self, prompt: str, images: List) -> Dict:
+        """
+        Asynchronously calls the Sambastudio multimodal openai compatible endpoint to generate a response.
+
+        :param str prompt: Prompt for the model to generate a response
+        :param list images: Images to be used with the model
+        :return: The request json response
+        :rtype: Dict
+        """
+        data = await asyncio.to_thread(self._build_openai_payload, prompt, images, False)
+        body = self._traced_body(data)
+        headers = {**self._openai_headers(), **body.headers()}
+        client, semaphore = self._get_async_pool()
+        async with semaphore:
+            response = await self.resilience.acall(
+                lambda: client.post(self.base_url, headers=headers, content=body.aiter())
+            )
+        self._trace_response(response.status_code)
+        if response.status_code != 200:
+            raise RuntimeError(
+                f'Sambastudio multimodal API call failed with status code {response.status_code}.',
+                f'Details: {response.text}',
+            )
+        return response.json()
+
+    def _load_images(
+        self, images: Optional[Union[ImagesInput, List]] = None, opened: Optional[List[ImageBytes]] = None
+    ) -> List[Any]:
         """
-        Loads the images into base64 format or url.
+        Loads the images into in memory images, URL images are downloaded and PDF pages rasterized concurrently.
 
-        :param Union[str, List] images: Image or images to be used with the model url, absolute path or base64 image
-        :return: List of base64 encoded / URL images
+        :param images: Image or images to be used with the model url, absolute path, base64 image,
+            raw bytes or typed image inputs such as PDF pages
+        :param list opened: receives the memory mapped images opened by the wrapper, which the caller closes
+            once the request is sent
+        :return: List of ImageBytes images
         """
+        with current_trace().span('load'):
+            return self._load_image_inputs(images, opened if opened is not None else [])
+
+    def _load_image_inputs(self, images: Optional[Union[ImagesInput, List]], opened: List[ImageBytes]) -> List[Any]:
+        """Loads the images, see _load_images."""
         if images is None:
             images = []
-        if isinstance(images, str):
+        if not isinstance(images, list):
             images = [images]
-        images_list = []
-        for image in images:
-            if self._is_base64_encoded(image):
-                image = image
-                images_list.append(image)
-            elif self._is_file_path(image):
-                images_list.append(self.image_to_base64(image))
-            elif self._is_url(image):
-                images_list.append(image)
+        image_inputs = [detect_image_input(image) for image in images]
+        urls = [image_input.url for image_input in image_inputs if isinstance(image_input, ImageURL)]
+        downloads = iter(self.fetcher.fetch_many(urls) if urls else [])  # type: ignore
+        pdf_pages = [image_input for image_input in image_inputs if isinstance(image_input, PDFPage)]
+        renderings = iter(load_pdf_pages(pdf_pages) if pdf_pages else [])
+        images_list: List[ImageBytes] = []
+        for image_input in image_inputs:
+            if isinstance(image_input, (ImageURL, ImagePath)):
+                # files and cached downloads are memory mapped, the mapping is released as soon as it is not sent
+                image = next(downloads) if isinstance(image_input, ImageURL) else image_input.load()
+                try:
+                    processed = self._preprocess(image)  # type: ignore
+                except BaseException:
+                    image.close()  # type: ignore
+                    raise
+                if processed is image:
+                    opened.append(image)  # type: ignore
+                else:
+                    image.close()  # type: ignore
+                images_list.append(processed)
+            elif isinstance(image_input, PDFPage):
+                images_list.append(self._preprocess(next(renderings)))
+            elif isinstance(image_input, ImageTile):
+                images_list.append(self._preprocess(image_input.load()))
             else:
-                raise ValueError('images should be provided as an url, a path or as a base64 encoded image')
+                images_list.append(self._preprocess(image_input))  # type: ignore
         return images_list
 
-    def invoke(self, prompt: Optional[str] = None, images: Optional[Union[str, List]] = None) -> str:
+    def _check_generic_images(self, images_list: List[Any]) -> ImageBytes:
         """
-        Calls the Sambastudio multimodal endpoint to generate a response.
+        Validates the images for the generic endpoint and returns the one to send.
+
+        :param list images_list: loaded images
+        :return: The image to send
+        :rtype: ImageBytes
+        """
+        if len(images_list) > 1:
+            raise ValueError('only one image can be provided for generic endpoint')
+        return images_list[0]
+
+    def _cache_key(self, prompt: Optional[str], images_list: List[Any]) -> Optional[str]:
+        """
+        Builds the response cache key of a request, None when the response should not be cached.
+        Responses are only cached when sampling is deterministic (do_sample disabled).
 
         :param str prompt: Prompt for the model to generate a response
-        :param str, list images: Image or images to be used with the model url, absolute path or base64 image
-        :return: The generated response
+        :param list images_list: loaded ImageBytes images
+        :return: The cache key
         :rtype: str
         """
-        images_list = self._load_images(images)
-        # Call the appropriate API based on the host URL
-        if self.base_url is not None and 'v1/chat/completions' in self.base_url:
-            response = self._call_openai_api(prompt, images_list)  # type: ignore
-            generation = self._process_openai_api_response(response)
-        elif self.base_url is not None and 'generic' in self.base_url:
-            if len(images_list) > 1:
-                raise ValueError('only one image can be provided for generic endpoint')
-            if self._is_url(images_list[0]):
-                # temporal conversion until URL is supported directly by API
-                image = f'data:image/jpeg;base64,{self.url_to_b64(images_list[0])}'
-                # raise ValueError(
-                #   'image should be provided as a path or as a base64 encoded image for generic endpoint'
-                # )
-            else:
-                image = images_list[0]
-            formatted_prompt = f"""A chat between a curious human and an artificial intelligence assistant.
-            The assistant gives helpful, detailed, and polite answers to the humans question.\
-            USER: <image>
-            {prompt}
-            ASSISTANT:"""
-            response = self._call_generic_api(formatted_prompt, image)
-            generation = self._process_generic_api_response(response)
+        if self.cache is None or self.do_sample:
+            return None
+        image_digests = [image.digest for image in images_list]
+        params = {
+            'base_url': self.base_url,
+            'model': self.model,
+            'temperature': self.temperature,
+            'max_tokens_to_generate': self.max_tokens_to_generate,
+            'top_p': self.top_p,
+            'top_k': self.top_k,
+            'stop': self.stop,
+        }
+        return make_cache_key(image_digests, prompt, params)
+
+    def _estimate_tokens(self, prompt: Optional[str], images_list: List[Any]) -> int:
+        """
+        Estimates the tokens of a call for rate limiting: prompt characters / 4, a fixed amount per image
+        and the maximum number of generated tokens.
+
+        :param str prompt: Prompt for the model to generate a response
+        :param list images_list: loaded images
+        :return: The estimated number of tokens
+        :rtype: int
+        """
+        return len(prompt or '') // 4 + IMAGE_TOKENS_ESTIMATE * len(images_list) + self.max_tokens_to_generate
+
+    def _acquire_slot(self, prompt: Optional[str], images_list: List[Any]) -> Optional[Ticket]:
+        """
+        Waits for the scheduler to allow the call, if a scheduler is set.
+
+        :return: The granted ticket
+        :rtype: Ticket
+        """
+        if self.scheduler is None:
+            return None
+        with current_trace().span('queue'):
+            return self.scheduler.acquire(self._estimate_tokens(prompt, images_list))
+
+    async def _aacquire_slot(self, prompt: Optional[str], images_list: List[Any]) -> Optional[Ticket]:
+        """
+        Asynchronously waits for the scheduler to allow the call, if a scheduler is set.
+
+        :return: The granted ticket
+        :rtype: Ticket
+        """
+        if self.scheduler is None:
+            return None
+        with current_trace().span('queue'):
+            return await self.scheduler.aacquire(self._estimate_tokens(prompt, images_list))
+
+    def _settle_slot(
+        self,
+        ticket: Optional[Ticket],
+        prompt: Optional[str],
+        images_list: List[Any],
+        usage: Dict[str, Any],
+        generation: Optional[str],
+    ) -> None:
+        """
+        Corrects the scheduler token bucket once a call finished, failed or was interrupted, with the usage
+        reported by the endpoint, or when it sent none (generic endpoint, interrupted streams) with the
+        estimated prompt tokens and the generated characters / 4.
+
+        :param Ticket ticket: granted ticket, None without a scheduler
+        :param str prompt: Prompt sent to the model
+        :param list images_list: loaded images
+        :param dict usage: usage field of the response, empty if none was received
+        :param str generation: generated text, None if the call failed before any
+        """
+        if ticket is None:
+            return
+        if usage.get('total_tokens') is not None:
+            tokens = usage['total_tokens']
+        elif usage.get('prompt_tokens') is not None:
+            tokens = usage['prompt_tokens'] + (usage.get('completion_tokens') or 0)
         else:
-            raise ValueError(
-                f'Unsupported host URL: {self.base_url}', 'only Generic and open AI compatible APIs supported'
+            tokens = (
+                self._estimate_tokens(prompt, images_list) - self.max_tokens_to_generate + len(generation or '') // 4
             )
+        self.scheduler.settle(ticket, tokens)  # type: ignore
+
+    def _response_usage(self, response: Dict) -> Dict[str, Any]:
+        """
+        Returns the usage field of an openai compatible response, recorded in the current call trace.
+
+        :param dict response: The API response
+        :rtype: dict
+        """
+        usage = (response.get('usage') if isinstance(response, dict) else None) or {}
+        current_trace().set_usage(usage)
+        return usage
+
+    def _new_trace(self, method: str) -> CallTrace:
+        """
+        Returns a new trace for a call of the wrapper, sent to the instrumentation hooks when finished.
+
+        :param str method: wrapper method called
+        :rtype: CallTrace
+        """
+        endpoint = 'openai' if self.base_url is not None and 'v1/chat/completions' in self.base_url else 'generic'
+        return CallTrace('lvlm', method, endpoint, self.hooks)
+
+    def invoke(
+        self,
+        prompt: Optional[str] = None,
+        images: Optional[Union[ImagesInput, List]] = None,
+        bypass_cache: bool = False,
+    ) -> str:
+        """
+        Calls the Sambastudio multimodal endpoint to generate a response.
+
+        :param str prompt: Prompt for the model to generate a response
+        :param str, list images: Image or images to be used with the model url, absolute path, base64 image or bytes
+        :param bool bypass_cache: skip the response cache lookup and store for this call
+        :return: The generated response
+        :rtype: str
+        """
+        trace = self._new_trace('invoke')
+        try:
+            with use_trace(trace):
+                generation = self._invoke(prompt, images, bypass_cache)
+        except BaseException as e:
+            trace.finish(e)
+            raise
+        trace.finish()
         return generation
 
-    def stream(self, prompt: Optional[str] = None, images: Optional[Union[str, List]] = None) -> Iterator:
+    def stream(
+        self,
+        prompt: Optional[str] = None,
+        images: Optional[Union[ImagesInput, List]] = None,
+        bypass_cache: bool = False,
+    ) -> Iterator:
         """
         Calls the Sambastudio multimodal endpoint to generate a response.
 
+        A cached response is yielded as a single chunk, a streamed response is cached once fully consumed.
+
         :param str prompt: Prompt for the model to generate a response
-        :param str, list images: Image or images to be used with the model url, absolute path or base64 image
+        :param str, list images: Image or images to be used with the model url, absolute path, base64 image or bytes
+        :param bool bypass_cache: skip the response cache lookup and store for this call
         :return: The generated response
         :rtype: str
         """
-        images_list = self._load_images(images)
-        # Call the appropriate API based on the host URL
-        if self.base_url is not None and 'v1/chat/completions' in self.base_url:
-            response = self._call_openai_api_stream(prompt, images_list)  # type: ignore
-            for chunk in self._process_openai_api_response_stream(response):
+        trace = self._new_trace('stream')
+        chunks = self._stream(prompt, images, bypass_cache)
+        try:
+            while True:
+                # the trace is only current while the inner generator runs, never across this yield
+                with use_trace(trace):
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                trace.mark('ttft')
                 yield chunk
-        elif self.base_url is not None and 'generic' in self.base_url:
-            if len(images_list) > 1:
-                raise ValueError('only one image can be provided for generic endpoint')
-            if self._is_url(images_list[0]):
-                raise ValueError('image should be provided as a path or as a base64 encoded image for generic endpoint')
-
-            formatted_prompt = f"""A chat between a curious human and an artificial intelligence assistant.
-            The assistant gives helpful, detailed, and polite answers to the humans question.\
-            USER: <image>
-            {prompt}
-            ASSISTANT:"""
-            raise NotImplementedError('Streaming method not implemented for multimodal generic endpoints')
-        else:
-            raise ValueError(
-                f'Unsupported host URL: {self.base_url}', 'only Generic and open AI compatible APIs supported'
-            )
\ No newline at end of file
+        except GeneratorExit:
+            chunks.close()
+            trace.finish()
+            raise
+        except BaseException as e:
+            trace.finish(e)
+            raise
+        trace.finish()
+
+    async def ainvoke(
+        self,
+        prompt: Optional[str] = None,
+        images: Optional[Union[ImagesInput, List]] = None,
+        bypass_cache: bool = False,
+    ) -> str:
+        """
+        Asynchronously calls the Sambastudio multimodal endpoint to generate a response.
+
+        :param str prompt: Prompt for the model to generate a response
+        :param str, list images: Image or images to be used with the model url, absolute path, base64 image or bytes
+        :param bool bypass_cache: skip the response cache lookup and store for this call
+        :return: The generated response
+        :rtype: str
+        """
+        trace = self._new_trace('ainvoke')
+        try:
+            with use_trace(trace):
+                generation = await self._ainvoke(prompt, images, bypass_cache)
+        except BaseException as e:
+            trace.finish(e)
+            raise
+        trace.finish()
+        return generation
+
+    async def astream(
+        self, prompt: Optional[str] = None, images: Optional[Union[ImagesInput, List]] = None
+    ) -> AsyncIterator[str]:
+        """
+        Asynchronously calls the Sambastudio multimodal endpoint and streams the response.
+
+        The in-flight slot is held until the stream is fully consumed or closed.
+
+        :param str prompt: Prompt for the model to generate a response
+        :param str, list images: Image or images to be used with the model url, absolute path, base64 image or bytes
+        :yield: The generated response chunks
+        :rtype: str
+        """
+        trace = self._new_trace('astream')
+        chunks = self._astream(prompt, images)
+        try:
+            while True:
+                with use_trace(trace):
+                    try:
+                        chunk = await chunks.__anext__()
+                    except StopAsyncIteration:
+                        break
+                trace.mark('ttft')
+                yield chunk
+        except GeneratorExit:
+            await chunks.aclose()
+            trace.finish()
+            raise
+        except BaseException as e:
+            trace.finish(e)
+            raise
+        trace.finish()
+
+    def _invoke(
+        self,
+        prompt: Optional[str] = None,
+        images: Optional[Union[ImagesInput, List]] = None,
+        bypass_cache: bool = False,
+    ) -> str:
+        """Implementation of invoke, records into the current call trace."""
+        opened: List[ImageBytes] = []
+        try:
+            images_list = self._load_images(images, opened)
+            cache_key = None if bypass_cache else self._cache_key(prompt, images_list)
+            if cache_key is not None:
+                cached = self.cache.get(cache_key)  # type: ignore
+                if cached is not None:
+                    current_trace().endpoint = 'cache'
+                    return cached
+            ticket = self._acquire_slot(prompt, images_list)
+            usage: Dict[str, Any] = {}
+            generation = None
+            try:
+                # Call the appropriate API based on the host URL
+                if self.base_url is not None and 'v1/chat/completions' in self.base_url:
+                    response = self._call_openai_api(prompt, images_list)  # type: ignore
+                    usage = self._response_usage(response)
+                    generation = self._process_openai_api_response(response)
+                elif self.base_url is not None and 'generic' in self.base_url:
+                    image = self._check_generic_images(images_list)
+                    formatted_prompt = self._format_generic_prompt(prompt)
+                    response = self._call_generic_api(formatted_prompt, image)
+                    generation = self._process_generic_api_response(response)
+                else:
+                    raise ValueError(
+                        f'Unsupported host URL: {self.base_url}', 'only Generic and open AI compatible APIs supported'
+                    )
+            finally:
+                self._settle_slot(ticket, prompt, images_list, usage, generation)
+            if cache_key is not None:
+                self.cache.set(cache_key, generation)  # type: ignore
+            return generation
+        finally:
+            for image in opened:
+                image.close()
+
+    def _stream(
+        self,
+        prompt: Optional[str] = None,
+        images: Optional[Union[ImagesInput, List]] = None,
+        bypass_cache: bool = False,
+    ) -> Iterator:
+        """Implementation of stream, records into the current call trace."""
+        opened: List[ImageBytes] = []
+        try:
+            images_list = self._load_images(images, opened)
+            cache_key = None if bypass_cache else self._cache_key(prompt, images_list)
+            if cache_key is not None:
+                cached = self.cache.get(cache_key)  # type: ignore
+                if cached is not None:
+                    current_trace().endpoint = 'cache'
+                    yield cached
+                    return
+            ticket = self._acquire_slot(prompt, images_list)
+            usage: Dict[str, Any] = {}
+            chunks: List[str] = []
+            try:
+                # Call the appropriate API based on the host URL
+                if self.base_url is not None and 'v1/chat/completions' in self.base_url:
+                    response = self._call_openai_api_stream(prompt, images_list)  # type: ignore
+                    for chunk in self._process_openai_api_response_stream(response, usage):
+                        chunks.append(chunk)
+                        yield chunk
+                elif self.base_url is not None and 'generic' in self.base_url:
+                    image = self._check_generic_images(images_list)
+                    formatted_prompt = self._format_generic_prompt(prompt)
+                    response = self._call_generic_api_stream(formatted_prompt, image)
+                    for chunk in self._process_generic_api_response_stream(response):
+                        chunks.append(chunk)
+                        yield chunk
+                else:
+                    raise ValueError(
+                        f'Unsupported host URL: {self.base_url}', 'only Generic and open AI compatible APIs supported'
+                    )
+            finally:
+                # interrupted streams included, the tokens generated so far are settled
+                self._settle_slot(ticket, prompt, images_list, usage, ''.join(chunks))
+            if cache_key is not None:
+                self.cache.set(cache_key, ''.join(chunks))  # type: ignore
+        finally:
+            for image in opened:
+                image.close()
+
+    async def _ainvoke(
+        self,
+        prompt: Optional[str] = None,
+        images: Optional[Union[ImagesInput, List]] = None,
+        bypass_cache: bool = False,
+    ) -> str:
+        """Implementation of ainvoke, records into the current call trace."""
+        opened: List[ImageBytes] = []
+        try:
+            images_list = await asyncio.to_thread(self._load_images, images, opened)
+            cache_key = None if bypass_cache else await asyncio.to_thread(self._cache_key, prompt, images_list)
+            if cache_key is not None:
+                cached = await asyncio.to_thread(self.cache.get, cache_key)  # type: ignore
+                if cached is not None:
+                    current_trace().endpoint = 'cache'
+                    return cached
+            ticket = await self._aacquire_slot(prompt, images_list)
+            usage: Dict[str, Any] = {}
+            generation = None
+            try:
+                if self.base_url is not None and 'v1/chat/completions' in self.base_url:
+                    response = await self._acall_openai_api(prompt, images_list)  # type: ignore
+                    usage = self._response_usage(response)
+                    generation = self._process_openai_api_response(response)
+                elif self.base_url is not None and 'generic' in self.base_url:
+                    image = self._check_generic_images(images_list)
+                    formatted_prompt = self._format_generic_prompt(prompt)
+                    response = await self._acall_generic_api(formatted_prompt, image)
+                    generation = self._process_generic_api_response(response)
+                else:
+                    raise ValueError(
+                        f'Unsupported host URL: {self.base_url}', 'only Generic and open AI compatible APIs supported'
+                    )
+            finally:
+                self._settle_slot(ticket, prompt, images_list, usage, generation)
+            if cache_key is not None:
+                await asyncio.to_thread(self.cache.set, cache_key, generation)  # type: ignore
+            return generation
+        finally:
+            for image in opened:
+                image.close()
+
+    async def _astream(
+        self, prompt: Optional[str] = None, images: Optional[Union[ImagesInput, List]] = None
+    ) -> AsyncIterator[str]:
+        """Implementation of astream, records into the current call trace."""
+        opened: List[ImageBytes] = []
+        try:
+            images_list = await asyncio.to_thread(self._load_images, images, opened)
+            ticket = await self._aacquire_slot(prompt, images_list)
+            usage: Dict[str, Any] = {}
+            chunks: List[str] = []
+            try:
+                if self.base_url is not None and 'v1/chat/completions' in self.base_url:
+                    data = await asyncio.to_thread(
+                        self._build_openai_payload, prompt, images_list, True  # type: ignore
+                    )
+                    client, semaphore = self._get_async_pool()
+                    async with semaphore:
+                        response = await self._asend_stream(
+                            client, self.base_url, self._openai_headers(), self._traced_body(data)  # type: ignore
+                        )
+                        try:
+                            async for chunk in self._aprocess_openai_api_response_stream(response, usage):
+                                chunks.append(chunk)
+                                yield chunk
+                        finally:
+                            await response.aclose()
+                elif self.base_url is not None and 'generic' in self.base_url:
+                    image = self._check_generic_images(images_list)
+                    data = self._build_generic_payload(self._format_generic_prompt(prompt), image)
+                    client, semaphore = self._get_async_pool()
+                    async with semaphore:
+                        response = await self._asend_stream(
+                            client, self._generic_stream_url(), self._generic_headers(), self._traced_body(data)
+                        )
+                        try:
+                            async for line in response.aiter_lines():
+                                token = self._process_generic_api_stream_line(line)
+                                if token:
+                                    chunks.append(token)
+                                    yield token
+                        finally:
+                            await response.aclose()
+                else:
+                    raise ValueError(
+                        f'Unsupported host URL: {self.base_url}', 'only Generic and open AI compatible APIs supported'
+                    )
+            finally:
+                self._settle_slot(ticket, prompt, images_list, usage, ''.join(chunks))
+        finally:
+            for image in opened:
+                image.close()
+
+    def _unpack_batch_input(self, item: BatchInput) -> Tuple[Optional[str], Optional[Union[ImagesInput, List]]]:
+        """
+        Unpacks a batch input into its prompt and images.
+
+        :param item: dict with 'prompt' and 'images' keys or a (prompt, images) pair
+        :return: The prompt and images
+        :rtype: Tuple
+        """
+        if isinstance(item, dict):
+            return item.get('prompt'), item.get('images')
+        prompt, images = item
+        return prompt, images
+
+    def batch(
+        self,
+        inputs: Iterable[BatchInput],
+        max_concurrency: int = 8,
+        return_exceptions: bool = False,
+        on_progress: Optional[ProgressCallback] = None,
+        priority: str = 'batch',
+    ) -> List[Any]:
+        """
+        Calls the Sambastudio multimodal endpoint for many inputs using a thread pool.
+
+        Inputs are consumed lazily and at most 2 * max_concurrency calls are queued at any time,
+        so arbitrarily long iterables can be processed without materializing them.
+        Results are returned in input order.
+
+        :param iterable inputs: dicts with 'prompt' and 'images' keys or (prompt, images) pairs
+        :param int max_concurrency: maximum number of concurrent calls
+        :param bool return_exceptions: return the raised exceptions in place of failed results instead of raising
+        :param callable on_progress: called with (completed, total, index, result) as each call finishes
+        :param str priority: scheduler lane of the calls, 'interactive' when a user waits for the results
+        :return: The generated responses
+        :rtype: list
+        """
+        if max_concurrency < 1:
+            raise ValueError('max_concurrency should be greater than 0')
+        total = len(inputs) if isinstance(inputs, Sized) else None
+        iterator = enumerate(inputs)
+        results: Dict[int, Any] = {}
+        pending: Dict[Future, int] = {}
+        context = contextvars.copy_context()
+
+        def invoke_batch_item(prompt: Optional[str], images: Optional[Union[ImagesInput, List]]) -> str:
+            # worker threads run in a copy of the caller context, in the requested priority lane
+            with scheduling_context(priority=priority):
+                return self.invoke(prompt, images)
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+
+            def fill() -> None:
+                for index, item in iterator:
+                    prompt, images = self._unpack_batch_input(item)
+                    pending[executor.submit(context.copy().run, invoke_batch_item, prompt, images)] = index
+                    if len(pending) >= 2 * max_concurrency:
+                        break
+
+            try:
+                fill()
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        index = pending.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            if not return_exceptions:
+                                raise
+                            result = e
+                        results[index] = result
+                        if on_progress is not None:
+                            on_progress(len(results), total, index, result)
+                    fill()
+            except BaseException:
+                # a failed call, a failing callback or input iterable, or an interrupt: queued calls never start
+                for queued in pending:
+                    queued.cancel()
+                raise
+        return [results[index] for index in range(len(results))]
+
+    async def abatch(
+        self,
+        inputs: Iterable[BatchInput],
+        max_concurrency: Optional[int] = None,
+        return_exceptions: bool = False,
+        on_progress: Optional[ProgressCallback] = None,
+        priority: str = 'batch',
+    ) -> List[Any]:
+        """
+        Asynchronously calls the Sambastudio multimodal endpoint for many inputs.
+
+        A fixed set of workers pulls inputs lazily, so at most max_concurrency calls are in flight
+        and no more than that are pending. Results are returned in input order.
+
+        :param iterable inputs: dicts with 'prompt' and 'images' keys or (prompt, images) pairs
+        :param int max_concurrency: maximum number of concurrent calls, defaults to the wrapper max_concurrency
+        :param bool return_exceptions: return the raised exceptions in place of failed results instead of raising
+        :param callable on_progress: called with (completed, total, index, result) as each call finishes
+        :param str priority: scheduler lane of the calls, 'interactive' when a user waits for the results
+        :return: The generated responses
+        :rtype: list
+        """
+        if max_concurrency is None:
+            max_concurrency = self.max_concurrency
+        if max_concurrency < 1:
+            raise ValueError('max_concurrency should be greater than 0')
+        total = len(inputs) if isinstance(inputs, Sized) else None
+        iterator = enumerate(inputs)
+        results: Dict[int, Any] = {}
+
+        async def worker() -> None:
+            with scheduling_context(priority=priority):
+                for index, item in iterator:
+                    prompt, images = self._unpack_batch_input(item)
+                    try:
+                        result = await self.ainvoke(prompt=prompt, images=images)
+                    except Exception as e:
+                        if not return_exceptions:
+                            raise
+                        result = e
+                    results[index] = result
+                    if on_progress is not None:
+                        on_progress(len(results), total, index, result)
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(max_concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            for task in workers:
+                task.cancel()
+            raise
+        return [results[index] for index in range(len(results))]
+
+    def invoke_tiled(
+        self,
+        prompt: str,
+        image: Image.Image,
+        tiler: Optional[ImageTiler] = None,
+        max_concurrency: int = 8,
+        on_progress: Optional[ProgressCallback] = None,
+        priority: str = 'batch',
+    ) -> Dict[str, Any]:
+        """
+        Asks a question about every tile of a large image at native resolution and merges the answers.
+
+        Near uniform tiles are skipped, the other tiles are cropped, encoded and queried concurrently through
+        batch, so the wall time stays close to a single request while the tiles fit in max_concurrency.
+        Failed tiles are reported in place of their answer.
+
+        :param str prompt: question asked about each tile
+        :param Image image: full resolution image
+        :param ImageTiler tiler: tiling of the image, defaults to ImageTiler()
+        :param int max_concurrency: maximum number of concurrent tile requests
+        :param callable on_progress: called with (completed, total, index, result) as each tile finishes
+        :param str priority: scheduler lane of the calls, 'interactive' when a user waits for the results
+        :return: The merged 'report', the analyzed 'tiles' with their 'answers' and the 'skipped' tiles
+        :rtype: dict
+        """
+        if tiler is None:
+            tiler = ImageTiler()
+        tiles, skipped = tiler.split(image)
+        inputs = [
+            (TILE_PROMPT_TEMPLATE.format(label=tile.label, width=image.width, height=image.height, prompt=prompt), tile)
+            for tile in tiles
+        ]
+        answers = self.batch(
+            inputs,
+            max_concurrency=max_concurrency,
+            return_exceptions=True,
+            on_progress=on_progress,
+            priority=priority,
+        )
+        return {
+            'report': merge_tile_answers(tiles, answers, image.size, len(skipped), tiler),
+            'tiles': tiles,
+            'answers': answers,
+            'skipped': skipped,
+        }
+
+    def warmup(self, timeout: float = 5.0) -> bool:
+        """
+        Opens a pooled connection to the API host, so the DNS lookup and TLS handshake are not paid by the
+        first call. Any answer counts, the request is not authenticated.
+
+        :param float timeout: seconds before giving up
+        :return: Whether the host answered
+        :rtype: bool
+        """
+        url = urlsplit(self.base_url)
+        try:
+            self.http_session.head(f'{url.scheme}://{url.netloc}/', timeout=timeout, allow_redirects=False).close()
+        except requests.RequestException:
+            return False
+        return True
+
+    async def aclose(self) -> None:
+        """
+        Closes the pooled async client of the running event loop.
+        """
+        pool = self._async_pools.pop(asyncio.get_running_loop(), None)
+        if pool is not None:
+            await pool[0].aclose()
@@ -0,0 +1,148 @@
+"""Streaming JSON request bodies embedding base64 images without materializing the whole payload."""
+
+import json
+from typing import Any, AsyncIterator, Callable, Iterator, List, Optional, Union
+
+from utils.model_wrappers.image_inputs import ImageBytes
+
+# raw image bytes base64 encoded per body chunk, a multiple of 3 so chunks concatenate without padding
+CHUNK_SIZE = 48 * 1024
+
+
+class Base64Field:
+    """
+    Placeholder of an image inside a request payload, serialized as a JSON string holding
+    the image data URI or its bare base64 encoding.
+    """
+
+    def __init__(self, image: ImageBytes, data_uri: bool = True) -> None:
+        """
+        Initialize the Base64Field.
+
+        :param ImageBytes image: image to embed
+        :param bool data_uri: serialize as a data URI, the bare base64 encoding otherwise
+        """
+        self.image = image
+        self.prefix = f'"data:{image.mime_type};base64,'.encode() if data_uri else b'"'
+
+    def __len__(self) -> int:
+        return len(self.prefix) + self.image.b64_length + 1
+
+    def iter_chunks(self, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        """
+        Yields the serialized field.
+
+        :param int chunk_size: raw image bytes encoded per chunk
+        :yield: The JSON string chunks
+        :rtype: bytes
+        """
+        yield self.prefix
+        yield from self.image.iter_b64(chunk_size)
+        yield b'"'
+
+
+class _AsyncBody:
+    """
+    Async iterable view of a StreamingJSONBody, every iteration restarts the body so retried requests resend it.
+    """
+
+    def __init__(self, body: 'StreamingJSONBody') -> None:
+        self.body = body
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for chunk in self.body:
+            yield chunk
+
+
+class StreamingJSONBody:
+    """
+    JSON request body generated chunk by chunk, the Base64Field values of the payload are base64 encoded
+    while the body is sent so the peak memory of a request is close to one copy of its images.
+
+    The serialization matches json.dumps with the images replaced by their data URIs. The body length is
+    known up front, so it is sent with a Content-Length header instead of chunked transfer encoding,
+    and it can be iterated several times, for retries and hedged requests.
+    """
+
+    def __init__(
+        self, payload: Any, chunk_size: int = CHUNK_SIZE, on_sent: Optional[Callable[[], None]] = None
+    ) -> None:
+        """
+        Initialize the StreamingJSONBody.
+
+        :param payload: JSON serializable payload which may contain Base64Field values
+        :param int chunk_size: raw image bytes encoded per chunk
+        :param callable on_sent: called each time the last chunk of the body has been handed to the transport
+        """
+        self.chunk_size = chunk_size
+        self.on_sent = on_sent
+        self.parts: List[Union[bytes, Base64Field]] = []
+        self._pending: List[str] = []
+        self._serialize(payload)
+        self._flush()
+        self.length = sum(len(part) for part in self.parts)
+
+    def _flush(self) -> None:
+        """Merges the pending JSON text into a single static part."""
+        if self._pending:
+            self.parts.append(''.join(self._pending).encode())
+            self._pending = []
+
+    def _serialize(self, value: Any) -> None:
+        """Appends the parts of a JSON value, using the json.dumps default separators."""
+        if isinstance(value, Base64Field):
+            self._flush()
+            self.parts.append(value)
+        elif isinstance(value, dict):
+            self._pending.append('{')
+            for index, (key, item) in enumerate(value.items()):
+                if index:
+                    self._pending.append(', ')
+                self._pending.append(json.dumps(str(key)) + ': ')
+                self._serialize(item)
+            self._pending.append('}')
+        elif isinstance(value, (list, tuple)):
+            self._pending.append('[')
+            for index, item in enumerate(value):
+                if index:
+                    self._pending.append(', ')
+                self._serialize(item)
+            self._pending.append(']')
+        else:
+            self._pending.append(json.dumps(value))
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self) -> Iterator[bytes]:
+        for part in self.parts:
+            if isinstance(part, Base64Field):
+                yield from part.iter_chunks(self.chunk_size)
+            else:
+                yield part
+        if self.on_sent is not None:
+            self.on_sent()
+
+    def aiter(self) -> _AsyncBody:
+        """
+        Returns an async iterable over the body, to be sent with an httpx.AsyncClient.
+
+        :rtype: AsyncIterable[bytes]
+        """
+        return _AsyncBody(self)
+
+    def headers(self) -> dict:
+        """
+        Returns the Content-Length header of the body, required by httpx to avoid chunked transfer encoding.
+
+        :rtype: dict
+        """
+        return {'Content-Length': str(self.length)}
+
+    def to_bytes(self) -> bytes:
+        """
+        Returns the whole body.
+
+        :rtype: bytes
+        """
+        return b''.join(self)
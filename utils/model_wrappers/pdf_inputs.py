@@ -0,0 +1,246 @@
+"""Lazy PDF inputs: pages are only rasterized when picked, in a process pool, and the text layer is used as context."""
+
+import io
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from pdf2image import convert_from_path
+from PyPDF2 import PdfReader
+
+from utils.model_wrappers.image_inputs import ImageBytes, ImageInput
+
+# resolution of the page thumbnails
+THUMBNAIL_DPI = 36
+
+# characters of page text kept per page in the prompt context
+MAX_PAGE_TEXT_CHARS = 4000
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def get_render_pool(max_workers: Optional[int] = None) -> ProcessPoolExecutor:
+    """
+    Returns the process wide page rendering pool, created on first use. Workers are spawned rather than forked
+    since the callers are usually multithreaded servers.
+
+    :param int max_workers: number of worker processes, defaults to the number of CPUs
+    :rtype: ProcessPoolExecutor
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def render_pdf_page(path: str, page: int, dpi: int, quality: int = 90) -> bytes:
+    """
+    Rasterizes a single PDF page to JPEG, runs in the rendering pool workers.
+
+    :param str path: path of the PDF file
+    :param int page: page number, starting at 1
+    :param int dpi: rendering resolution
+    :param int quality: JPEG quality
+    :return: The JPEG encoded page
+    :rtype: bytes
+    """
+    images = convert_from_path(path, dpi=dpi, first_page=page, last_page=page)
+    if not images:
+        raise ValueError(f'page {page} of {path} could not be rendered')
+    buffer = io.BytesIO()
+    images[0].convert('RGB').save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+class PDFDocument:
+    """
+    PDF file opened without rasterizing it, the page count and text layer come from PyPDF2 and pages are
+    rendered on demand. Rendered pages are kept in a small LRU cache.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        executor: Optional[Executor] = None,
+        max_cached_pages: int = 32,
+    ) -> None:
+        """
+        Initialize the PDFDocument.
+
+        :param str path: path of the PDF file
+        :param Executor executor: pool rendering the pages, defaults to the process wide rendering pool
+        :param int max_cached_pages: number of rendered pages kept in memory
+        """
+        self.path = str(path)
+        self.executor = executor
+        self.max_cached_pages = max_cached_pages
+        self._reader = PdfReader(self.path)
+        self._lock = threading.Lock()
+        self._texts: Dict[int, str] = {}
+        self._pages: 'OrderedDict[Tuple[int, int], bytes]' = OrderedDict()
+
+    @property
+    def page_count(self) -> int:
+        """Number of pages, read from the PDF page tree."""
+        return len(self._reader.pages)
+
+    def _check_page(self, page: int) -> None:
+        if not 1 <= page <= self.page_count:
+            raise ValueError(f'page should be between 1 and {self.page_count}, got {page}')
+
+    def text(self, page: int) -> str:
+        """
+        Returns the text layer of a page, empty for scanned pages.
+
+        :param int page: page number, starting at 1
+        :rtype: str
+        """
+        self._check_page(page)
+        with self._lock:
+            if page not in self._texts:
+                self._texts[page] = (self._reader.pages[page - 1].extract_text() or '').strip()
+            return self._texts[page]
+
+    def context(self, pages: Sequence[int], max_chars: int = MAX_PAGE_TEXT_CHARS) -> str:
+        """
+        Returns the text of pages as prompt context, truncated to max_chars per page.
+
+        :param list pages: page numbers, starting at 1
+        :param int max_chars: characters kept per page
+        :rtype: str
+        """
+        parts = []
+        for page in pages:
+            text = self.text(page)
+            if text:
+                parts.append(f'[page {page}]\n{text[:max_chars]}')
+        return '\n\n'.join(parts)
+
+    def _cached(self, key: Tuple[int, int]) -> Optional[bytes]:
+        with self._lock:
+            data = self._pages.get(key)
+            if data is not None:
+                self._pages.move_to_end(key)
+            return data
+
+    def _store(self, key: Tuple[int, int], data: bytes) -> None:
+        with self._lock:
+            self._pages[key] = data
+            while len(self._pages) > self.max_cached_pages:
+                self._pages.popitem(last=False)
+
+    def render(self, page: int, dpi: int = 150) -> ImageBytes:
+        """
+        Rasterizes a page.
+
+        :param int page: page number, starting at 1
+        :param int dpi: rendering resolution
+        :rtype: ImageBytes
+        """
+        return next(self.iter_render([page], dpi))[1]
+
+    def iter_render(self, pages: Sequence[int], dpi: int = 150) -> Iterator[Tuple[int, ImageBytes]]:
+        """
+        Rasterizes pages concurrently and yields them as they finish, cached pages first.
+
+        :param list pages: page numbers, starting at 1
+        :param int dpi: rendering resolution
+        :yield: The page numbers and rendered pages
+        :rtype: tuple
+        """
+        pending = []
+        for page in dict.fromkeys(pages):
+            self._check_page(page)
+            data = self._cached((page, dpi))
+            if data is not None:
+                yield page, ImageBytes(data, mime_type='image/jpeg')
+            else:
+                pending.append(page)
+        if not pending:
+            return
+        executor = self.executor if self.executor is not None else get_render_pool()
+        futures = {executor.submit(render_pdf_page, self.path, page, dpi): page for page in pending}
+        try:
+            for future in as_completed(futures):
+                page = futures[future]
+                data = future.result()
+                self._store((page, dpi), data)
+                yield page, ImageBytes(data, mime_type='image/jpeg')
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def iter_thumbnails(self, pages: Sequence[int]) -> Iterator[Tuple[int, ImageBytes]]:
+        """
+        Yields low resolution renderings of pages as they finish.
+
+        :param list pages: page numbers, starting at 1
+        :yield: The page numbers and thumbnails
+        :rtype: tuple
+        """
+        return self.iter_render(pages, THUMBNAIL_DPI)
+
+    def page(self, page: int, dpi: int = 150) -> 'PDFPage':
+        """
+        Returns a lazy image input of a page, rasterized when the wrapper loads it.
+
+        :param int page: page number, starting at 1
+        :param int dpi: rendering resolution
+        :rtype: PDFPage
+        """
+        self._check_page(page)
+        return PDFPage(self, page, dpi)
+
+
+class PDFPage(ImageInput):
+    """
+    Page of a PDFDocument used as an image input, rasterized on load.
+    """
+
+    def __init__(self, document: PDFDocument, page: int, dpi: int = 150) -> None:
+        """
+        Initialize the PDFPage.
+
+        :param PDFDocument document: document of the page
+        :param int page: page number, starting at 1
+        :param int dpi: rendering resolution
+        """
+        self.document = document
+        self.page = page
+        self.dpi = dpi
+
+    def load(self) -> ImageBytes:
+        """
+        Rasterizes the page.
+
+        :rtype: ImageBytes
+        """
+        return self.document.render(self.page, self.dpi)
+
+    @property
+    def text(self) -> str:
+        """Text layer of the page."""
+        return self.document.text(self.page)
+
+
+def load_pdf_pages(pages: List[PDFPage]) -> List[ImageBytes]:
+    """
+    Rasterizes PDF pages concurrently, grouped by document and resolution, in input order.
+
+    :param list pages: pages to rasterize
+    :rtype: list
+    """
+    rendered: Dict[Tuple[int, int, int], ImageBytes] = {}
+    groups: Dict[Tuple[int, int], Tuple[PDFDocument, List[int]]] = {}
+    for pdf_page in pages:
+        group = groups.setdefault((id(pdf_page.document), pdf_page.dpi), (pdf_page.document, []))
+        group[1].append(pdf_page.page)
+    for (document_id, dpi), (document, page_numbers) in groups.items():
+        for page, image in document.iter_render(page_numbers, dpi):
+            rendered[(document_id, dpi, page)] = image
+    return [rendered[(id(pdf_page.document), pdf_page.dpi, pdf_page.page)] for pdf_page in pages]
@@ -0,0 +1,136 @@
+"""Precompiled, whitespace normalized prompt templates and prompt token estimates."""
+
+import re
+from string import Formatter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+_SPACES_REGEX = re.compile(r'[ \t]+')
+_BLANK_LINES_REGEX = re.compile(r'\n{3,}')
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimates the tokens of a text as characters / 4, the same heuristic the rate limiter uses.
+
+    :param str text: text to estimate
+    :rtype: int
+    """
+    return len(text) // 4 + 1
+
+
+def count_prompt_tokens(messages: Iterable[Dict[str, str]]) -> int:
+    """
+    Estimates the prompt tokens of chat messages, with 4 tokens of chat template overhead per message.
+
+    :param list messages: openai compatible messages
+    :rtype: int
+    """
+    return sum(estimate_tokens(message['content']) + 4 for message in messages)
+
+
+def normalize_whitespace(text: str) -> str:
+    """
+    Strips every line, collapses runs of spaces and tabs and keeps at most one blank line in a row,
+    so indented triple quoted strings produce the same compact prompt.
+
+    :param str text: text to normalize
+    :rtype: str
+    """
+    lines = (_SPACES_REGEX.sub(' ', line).strip() for line in text.strip().splitlines())
+    return _BLANK_LINES_REGEX.sub('\n\n', '\n'.join(lines))
+
+
+class PromptTemplate:
+    """
+    Prompt template with str.format fields, normalized and split into literal and field parts once,
+    formatting only joins the parts. Field values are inserted as given.
+    """
+
+    def __init__(self, template: str, normalize: bool = True) -> None:
+        """
+        Initialize the PromptTemplate.
+
+        :param str template: template with {field} placeholders
+        :param bool normalize: whether to normalize the whitespace of the template
+        """
+        self.template = normalize_whitespace(template) if normalize else template
+        self._parts: List[Tuple[str, Optional[str]]] = []
+        for literal, field, format_spec, conversion in Formatter().parse(self.template):
+            if format_spec or conversion:
+                raise ValueError('prompt template fields do not support format specs or conversions')
+            if field is not None and not field.isidentifier():
+                raise ValueError(f'prompt template fields should be named, got {{{field}}}')
+            self._parts.append((literal, field))
+        self.fields = {field for _, field in self._parts if field is not None}
+        # the template text before the first field, identical for every formatted prompt
+        self.prefix = self._parts[0][0] if self._parts else ''
+        self.static_tokens = estimate_tokens(''.join(literal for literal, _ in self._parts))
+
+    def format(self, **values: Optional[str]) -> str:
+        """
+        Formats the template.
+
+        :param values: values of the template fields, None is formatted as an empty string
+        :return: The formatted prompt
+        :rtype: str
+        """
+        missing = self.fields - values.keys()
+        if missing:
+            raise ValueError(f'missing prompt template fields: {sorted(missing)}')
+        chunks = []
+        for literal, field in self._parts:
+            chunks.append(literal)
+            if field is not None:
+                value = values[field]
+                chunks.append('' if value is None else str(value))
+        return ''.join(chunks)
+
+    def token_count(self, **values: Optional[str]) -> int:
+        """
+        Estimates the tokens of the formatted prompt without formatting it.
+
+        :param values: values of the template fields
+        :rtype: int
+        """
+        return self.static_tokens + sum(len(str(values.get(field) or '')) // 4 for field in self.fields)
+
+
+# chat template of the Sambastudio multimodal generic endpoint
+GENERIC_CHAT_TEMPLATE = PromptTemplate(
+    """
+    A chat between a curious human and an artificial intelligence assistant.
+    The assistant gives helpful, detailed, and polite answers to the humans question.
+    USER: <image>
+    {prompt}
+    ASSISTANT:
+    """
+)
+
+# question about PDF pages, with the text layer of the pages as context
+PDF_CONTEXT_TEMPLATE = PromptTemplate(
+    """
+    Text extracted from the document pages:
+    {context}
+
+    {prompt}
+    """
+)
+
+# question about micrographs, with the measurements of the local analysis as grounded context
+MICROSTRUCTURE_CONTEXT_TEMPLATE = PromptTemplate(
+    """
+    Measurements computed from the image(s), use them for any quantitative statement:
+    {measurements}
+
+    {prompt}
+    """
+)
+
+# question about one tile of a large image, the answers of the tiles are merged into a single report
+TILE_PROMPT_TEMPLATE = PromptTemplate(
+    """
+    This image is the tile {label} of a {width}x{height} pixels micrograph, shown at full resolution.
+    Answer only from what is visible in this tile, reply briefly when it shows nothing relevant.
+    {prompt}
+    """
+)
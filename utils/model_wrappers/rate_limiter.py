@@ -0,0 +1,316 @@
+"""Process wide client side rate limiting and fair scheduling of Sambanova API calls."""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Iterator, Optional, Tuple
+
+# priority lanes, served in this order
+LANES = ('interactive', 'batch')
+
+# (session_id, priority) of the calls issued in the current context
+_scheduling_context: ContextVar[Tuple[str, str]] = ContextVar(
+    'sambanova_scheduling_context', default=('default', 'interactive')
+)
+
+_schedulers: Dict[str, 'RequestScheduler'] = {}
+_schedulers_lock = threading.Lock()
+
+
+@contextmanager
+def scheduling_context(session_id: Optional[str] = None, priority: Optional[str] = None) -> Iterator[None]:
+    """
+    Sets the session and priority lane used by the calls issued inside the context.
+
+    :param str session_id: id of the session issuing the calls, calls are fair queued per session
+    :param str priority: 'interactive' or 'batch'
+    """
+    if priority is not None and priority not in LANES:
+        raise ValueError(f'priority should be one of {LANES}')
+    current_session_id, current_priority = _scheduling_context.get()
+    token = _scheduling_context.set((session_id or current_session_id, priority or current_priority))
+    try:
+        yield
+    finally:
+        _scheduling_context.reset(token)
+
+
+def get_scheduler(name: str = 'sambanova', **kwargs: Any) -> 'RequestScheduler':
+    """
+    Returns the process wide scheduler registered under a name, creating it on first use.
+    Every client sharing an API key should share the same scheduler.
+
+    :param str name: scheduler name
+    :param kwargs: RequestScheduler arguments, only used when the scheduler is created
+    :return: The scheduler
+    :rtype: RequestScheduler
+    """
+    with _schedulers_lock:
+        scheduler = _schedulers.get(name)
+        if scheduler is None:
+            scheduler = RequestScheduler(**kwargs)
+            _schedulers[name] = scheduler
+        return scheduler
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at a fixed rate.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        """
+        Initialize the TokenBucket.
+
+        :param float rate: tokens added per second
+        :param float capacity: maximum number of tokens, allowed burst
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """
+        Returns the seconds to wait until amount tokens are available.
+
+        :param float amount: requested tokens, capped to the bucket capacity
+        :param float now: monotonic time
+        :rtype: float
+        """
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+    def credit(self, amount: float) -> None:
+        """
+        Returns tokens to the bucket, a negative amount puts the bucket in debt.
+        """
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class Ticket:
+    """
+    Queued or granted call.
+    """
+
+    __slots__ = ('session_id', 'priority', 'tokens', 'enqueued_at', 'granted_at')
+
+    def __init__(self, session_id: str, priority: str, tokens: float) -> None:
+        self.session_id = session_id
+        self.priority = priority
+        self.tokens = tokens
+        self.enqueued_at = time.monotonic()
+        self.granted_at: Optional[float] = None
+
+    @property
+    def queue_delay(self) -> Optional[float]:
+        """Seconds spent waiting in the queue."""
+        if self.granted_at is None:
+            return None
+        return self.granted_at - self.enqueued_at
+
+
+class RequestScheduler:
+    """
+    Limits requests per second and estimated tokens per minute. Waiting calls are served by priority lane,
+    interactive before batch, and round robin across sessions inside a lane, so saturation turns into
+    queueing delay instead of provider rate limit errors.
+    """
+
+    def __init__(
+        self,
+        requests_per_second: float = 5.0,
+        tokens_per_minute: Optional[float] = None,
+        burst: Optional[float] = None,
+    ) -> None:
+        """
+        Initialize the RequestScheduler.
+
+        :param float requests_per_second: sustained request rate
+        :param float tokens_per_minute: sustained estimated token rate, None for no token limit
+        :param float burst: maximum request burst, defaults to requests_per_second
+        """
+        self.requests = TokenBucket(requests_per_second, burst if burst is not None else max(1.0, requests_per_second))
+        self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute) if tokens_per_minute else None
+        self._condition = threading.Condition()
+        self._lanes: Dict[str, 'OrderedDict[str, Deque[Ticket]]'] = {lane: OrderedDict() for lane in LANES}
+        self._granted = {lane: 0 for lane in LANES}
+        self._total_delay = {lane: 0.0 for lane in LANES}
+        self._max_delay = {lane: 0.0 for lane in LANES}
+
+    def _enqueue(self, ticket: Ticket) -> None:
+        self._lanes[ticket.priority].setdefault(ticket.session_id, deque()).append(ticket)
+
+    def _remove(self, ticket: Ticket) -> None:
+        sessions = self._lanes[ticket.priority]
+        queue = sessions.get(ticket.session_id)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del sessions[ticket.session_id]
+
+    def _head(self) -> Optional[Ticket]:
+        """
+        Returns the next ticket to serve: first non empty lane, least recently served session.
+        """
+        for lane in LANES:
+            sessions = self._lanes[lane]
+            if sessions:
+                return next(iter(sessions.values()))[0]
+        return None
+
+    def _try_grant(self, ticket: Ticket) -> Optional[float]:
+        """
+        Grants the ticket if it is the head of the queue and the limits allow it. Must hold the lock.
+
+        :return: 0 if granted, the seconds to wait if the ticket is the head, None otherwise
+        """
+        if self._head() is not ticket:
+            return None
+        now = time.monotonic()
+        wait = self.requests.wait_time(1, now)
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(ticket.tokens, now))
+        if wait > 0:
+            return wait
+        self.requests.consume(1)
+        if self.tokens is not None:
+            self.tokens.consume(ticket.tokens)
+        sessions = self._lanes[ticket.priority]
+        queue = sessions.pop(ticket.session_id)
+        queue.popleft()
+        if queue:
+            # the session goes to the back of the round robin
+            sessions[ticket.session_id] = queue
+        ticket.granted_at = now
+        delay = now - ticket.enqueued_at
+        self._granted[ticket.priority] += 1
+        self._total_delay[ticket.priority] += delay
+        self._max_delay[ticket.priority] = max(self._max_delay[ticket.priority], delay)
+        self._condition.notify_all()
+        return 0.0
+
+    def _new_ticket(self, tokens: float, session_id: Optional[str], priority: Optional[str]) -> Ticket:
+        context_session_id, context_priority = _scheduling_context.get()
+        priority = priority or context_priority
+        if priority not in LANES:
+            raise ValueError(f'priority should be one of {LANES}')
+        return Ticket(session_id or context_session_id, priority, tokens)
+
+    def acquire(
+        self,
+        tokens: float = 0,
+        session_id: Optional[str] = None,
+        priority: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> Ticket:
+        """
+        Blocks until the call is allowed.
+
+        :param float tokens: estimated tokens of the call
+        :param str session_id: session issuing the call, defaults to the scheduling context session
+        :param str priority: 'interactive' or 'batch', defaults to the scheduling context priority
+        :param float timeout: maximum seconds to wait, raises TimeoutError when exceeded
+        :return: The granted ticket
+        :rtype: Ticket
+        """
+        ticket = self._new_ticket(tokens, session_id, priority)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            self._enqueue(ticket)
+            try:
+                while True:
+                    wait = self._try_grant(ticket)
+                    if wait == 0:
+                        return ticket
+                    # non head tickets are woken up when the head is granted
+                    wait = 1.0 if wait is None else wait
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise TimeoutError('Timed out waiting for a Sambanova API rate limit slot')
+                        wait = min(wait, remaining)
+                    self._condition.wait(wait)
+            except BaseException:
+                self._remove(ticket)
+                self._condition.notify_all()
+                raise
+
+    async def aacquire(
+        self,
+        tokens: float = 0,
+        session_id: Optional[str] = None,
+        priority: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> Ticket:
+        """
+        Waits asynchronously until the call is allowed.
+
+        :param float tokens: estimated tokens of the call
+        :param str session_id: session issuing the call, defaults to the scheduling context session
+        :param str priority: 'interactive' or 'batch', defaults to the scheduling context priority
+        :param float timeout: maximum seconds to wait, raises TimeoutError when exceeded
+        :return: The granted ticket
+        :rtype: Ticket
+        """
+        ticket = self._new_ticket(tokens, session_id, priority)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            self._enqueue(ticket)
+        try:
+            while True:
+                with self._condition:
+                    wait = self._try_grant(ticket)
+                if wait == 0:
+                    return ticket
+                wait = 0.01 if wait is None else min(wait, 0.05)
+                if deadline is not None and time.monotonic() + wait > deadline:
+                    raise TimeoutError('Timed out waiting for a Sambanova API rate limit slot')
+                await asyncio.sleep(wait)
+        except BaseException:
+            with self._condition:
+                self._remove(ticket)
+                self._condition.notify_all()
+            raise
+
+    def settle(self, ticket: Ticket, actual_tokens: Optional[float]) -> None:
+        """
+        Corrects the token bucket with the actual token usage of a granted call.
+
+        :param Ticket ticket: granted ticket
+        :param float actual_tokens: tokens reported by the API usage field
+        """
+        if self.tokens is None or actual_tokens is None:
+            return
+        with self._condition:
+            self.tokens.credit(ticket.tokens - actual_tokens)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the queue depth and queueing delay metrics per lane.
+
+        :rtype: dict
+        """
+        with self._condition:
+            return {
+                lane: {
+                    'queued': sum(len(queue) for queue in self._lanes[lane].values()),
+                    'granted': self._granted[lane],
+                    'mean_queue_delay': self._total_delay[lane] / self._granted[lane] if self._granted[lane] else 0.0,
+                    'max_queue_delay': self._max_delay[lane],
+                }
+                for lane in LANES
+            }
@@ -0,0 +1,378 @@
+"""Timeouts, retries, circuit breaking and request hedging for the Sambanova HTTP clients."""
+
+import asyncio
+import email.utils
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Deque, Optional, Tuple
+
+import httpx
+import requests
+
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+RETRYABLE_EXCEPTIONS = (requests.ConnectionError, requests.Timeout, httpx.TransportError)
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    Raised when a call is rejected because the circuit breaker is open.
+    """
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter, honoring Retry-After headers.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 20.0,
+        max_retry_after: float = 60.0,
+        retry_status_codes: Tuple[int, ...] = RETRYABLE_STATUS_CODES,
+    ) -> None:
+        """
+        Initialize the RetryPolicy.
+
+        :param int max_retries: maximum number of retries after the first attempt
+        :param float backoff_base: backoff of the first retry in seconds, doubled on each retry
+        :param float backoff_max: maximum backoff in seconds
+        :param float max_retry_after: maximum honored Retry-After delay in seconds
+        :param tuple retry_status_codes: response status codes that are retried
+        """
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_retry_after = max_retry_after
+        self.retry_status_codes = retry_status_codes
+
+    def _parse_retry_after(self, retry_after: Optional[str]) -> Optional[float]:
+        """
+        Parses a Retry-After header given in seconds or as an HTTP date.
+
+        :param str retry_after: header value
+        :return: The delay in seconds, None if missing or invalid
+        :rtype: float
+        """
+        if not retry_after:
+            return None
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            retry_at = email.utils.parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, retry_at.timestamp() - time.time())
+
+    def delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """
+        Returns the delay before the next attempt.
+
+        :param int attempt: number of the failed attempt, starting at 0
+        :param str retry_after: Retry-After header of the failed response if any
+        :return: The delay in seconds
+        :rtype: float
+        """
+        backoff = random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+        server_delay = self._parse_retry_after(retry_after)
+        if server_delay is not None:
+            return min(server_delay, self.max_retry_after) + backoff * 0.1
+        return backoff
+
+
+class CircuitBreaker:
+    """
+    Rejects calls for reset_timeout seconds after failure_threshold consecutive failures,
+    then lets a single trial call through before closing again.
+    """
+
+    def __init__(
+        self, failure_threshold: int = 5, reset_timeout: float = 30.0, name: str = 'Sambastudio multimodal API'
+    ) -> None:
+        """
+        Initialize the CircuitBreaker.
+
+        :param int failure_threshold: consecutive failures opening the circuit
+        :param float reset_timeout: seconds the circuit stays open before a trial call
+        :param str name: name of the guarded service, used in the error messages
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """closed, open or half-open."""
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def before_call(self) -> bool:
+        """
+        Raises CircuitOpenError if the call should be rejected.
+
+        :return: Whether the call is the half-open trial, which must end with record_success, record_failure
+            or release
+        :rtype: bool
+        """
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return False
+            if state == 'half-open' and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+        raise CircuitOpenError(
+            f'{self.name} circuit open after {self.failures} consecutive failures, '
+            f'retrying in {self.reset_timeout} seconds'
+        )
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_flight or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def release(self) -> None:
+        """
+        Ends the half-open trial without an outcome, e.g. when it was cancelled or failed with an error
+        unrelated to the server health, so the next call can be the trial.
+        """
+        with self._lock:
+            self._trial_in_flight = False
+
+
+class HedgingPolicy:
+    """
+    Sends a duplicate request when the first one is slower than a latency percentile
+    of the recent successful requests, the first response wins.
+    """
+
+    def __init__(self, percentile: float = 95.0, min_samples: int = 20, window: int = 200) -> None:
+        """
+        Initialize the HedgingPolicy.
+
+        :param float percentile: latency percentile after which a duplicate request is sent
+        :param int min_samples: number of recorded latencies required before hedging
+        :param int window: number of recent latencies kept
+        """
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self.hedged_requests = 0
+
+    def record(self, latency: float) -> None:
+        self._latencies.append(latency)
+
+    def threshold(self) -> Optional[float]:
+        """
+        Returns the hedging delay in seconds, None while not enough latencies are recorded.
+
+        :rtype: float
+        """
+        if len(self._latencies) < self.min_samples:
+            return None
+        latencies = sorted(self._latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+        return latencies[index]
+
+
+class ResiliencePolicy:
+    """
+    Combines connect / read timeouts, retries, a circuit breaker and optional hedging
+    around the HTTP calls of the Sambanova clients.
+    """
+
+    def __init__(
+        self,
+        connect_timeout: float = 10.0,
+        read_timeout: float = 120.0,
+        retry: Optional[RetryPolicy] = None,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        hedging: Optional[HedgingPolicy] = None,
+    ) -> None:
+        """
+        Initialize the ResiliencePolicy.
+
+        :param float connect_timeout: seconds to establish a connection
+        :param float read_timeout: maximum seconds between two received bytes
+        :param RetryPolicy retry: retry policy, defaults to RetryPolicy()
+        :param CircuitBreaker circuit_breaker: circuit breaker, defaults to CircuitBreaker()
+        :param HedgingPolicy hedging: optional hedging policy, hedging is disabled if None
+        """
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.circuit_breaker = circuit_breaker if circuit_breaker is not None else CircuitBreaker()
+        self.hedging = hedging
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def requests_timeout(self) -> Tuple[float, float]:
+        """(connect, read) timeout tuple for requests."""
+        return (self.connect_timeout, self.read_timeout)
+
+    @property
+    def httpx_timeout(self) -> httpx.Timeout:
+        """Timeout for httpx clients."""
+        return httpx.Timeout(self.read_timeout, connect=self.connect_timeout, pool=None)
+
+    def _hedging_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(thread_name_prefix='hedged-request')
+        return self._executor
+
+    def _send_hedged(self, send: Callable[[], requests.Response]) -> requests.Response:
+        """
+        Sends a request, duplicating it if it is slower than the hedging threshold.
+        """
+        delay = self.hedging.threshold() if self.hedging is not None else None
+        if delay is None:
+            return send()
+        executor = self._hedging_executor()
+        first = executor.submit(send)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        self.hedging.hedged_requests += 1  # type: ignore
+        futures = [first, executor.submit(send)]
+        done, pending = wait(futures, return_when=FIRST_COMPLETED)
+        winner: Future = done.pop()
+        if winner.exception() is not None and pending:
+            winner = pending.pop()
+            return winner.result()
+
+        def close_loser(future: Future) -> None:
+            if future.exception() is None:
+                future.result().close()
+
+        for future in futures:
+            if future is not winner:
+                future.add_done_callback(close_loser)
+        return winner.result()
+
+    async def _asend_hedged(self, send: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+        """
+        Asynchronously sends a request, duplicating it if it is slower than the hedging threshold.
+        """
+        delay = self.hedging.threshold() if self.hedging is not None else None
+        if delay is None:
+            return await send()
+        first = asyncio.ensure_future(send())
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+        self.hedging.hedged_requests += 1  # type: ignore
+        second = asyncio.ensure_future(send())
+        done, pending = await asyncio.wait({first, second}, return_when=asyncio.FIRST_COMPLETED)
+        winner = done.pop()
+        if winner.exception() is not None and pending:
+            return await pending.pop()
+        for task in pending:
+            task.cancel()
+        for task in done:
+            if task.exception() is None:
+                await task.result().aclose()
+        return winner.result()
+
+    def _is_retryable_response(self, response: Any) -> bool:
+        return response.status_code in self.retry.retry_status_codes
+
+    def call(self, send: Callable[[], requests.Response], hedge: bool = True) -> requests.Response:
+        """
+        Sends a request with retries, circuit breaking and optional hedging.
+        The last response is returned if every attempt returned a retryable status code.
+
+        :param callable send: function sending the request
+        :param bool hedge: allow hedged duplicates, should be disabled for streamed responses
+        :return: The response
+        :rtype: requests.Response
+        """
+        attempt = 0
+        while True:
+            trial = self.circuit_breaker.before_call()
+            start = time.perf_counter()
+            try:
+                response = self._send_hedged(send) if hedge else send()
+            except RETRYABLE_EXCEPTIONS:
+                self.circuit_breaker.record_failure()
+                if attempt >= self.retry.max_retries:
+                    raise
+                delay = self.retry.delay(attempt)
+            except BaseException:
+                # neither a success nor a transport failure, a trial left in flight would keep the circuit open
+                if trial:
+                    self.circuit_breaker.release()
+                raise
+            else:
+                if not self._is_retryable_response(response):
+                    self.circuit_breaker.record_success()
+                    if self.hedging is not None and hedge:
+                        self.hedging.record(time.perf_counter() - start)
+                    return response
+                self.circuit_breaker.record_failure()
+                if attempt >= self.retry.max_retries:
+                    return response
+                delay = self.retry.delay(attempt, response.headers.get('Retry-After'))
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    async def acall(self, send: Callable[[], Awaitable[httpx.Response]], hedge: bool = True) -> httpx.Response:
+        """
+        Asynchronously sends a request with retries, circuit breaking and optional hedging.
+        The last response is returned if every attempt returned a retryable status code.
+
+        :param callable send: function returning the request coroutine
+        :param bool hedge: allow hedged duplicates, should be disabled for streamed responses
+        :return: The response
+        :rtype: httpx.Response
+        """
+        attempt = 0
+        while True:
+            trial = self.circuit_breaker.before_call()
+            start = time.perf_counter()
+            try:
+                response = await (self._asend_hedged(send) if hedge else send())
+            except RETRYABLE_EXCEPTIONS:
+                self.circuit_breaker.record_failure()
+                if attempt >= self.retry.max_retries:
+                    raise
+                delay = self.retry.delay(attempt)
+            except BaseException:
+                # cancelled calls included, see call
+                if trial:
+                    self.circuit_breaker.release()
+                raise
+            else:
+                if not self._is_retryable_response(response):
+                    self.circuit_breaker.record_success()
+                    if self.hedging is not None and hedge:
+                        self.hedging.record(time.perf_counter() - start)
+                    return response
+                self.circuit_breaker.record_failure()
+                if attempt >= self.retry.max_retries:
+                    return response
+                delay = self.retry.delay(attempt, response.headers.get('Retry-After'))
+                await response.aclose()
+            await asyncio.sleep(delay)
+            attempt += 1
@@ -0,0 +1,195 @@
+"""Response caches for the Sambanova multimodal wrapper."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+def make_cache_key(image_digests: list, prompt: Optional[str], params: Dict[str, Any]) -> str:
+    """
+    Builds a content addressed cache key.
+
+    :param list image_digests: sha256 hex digests of the decoded image bytes (or of the image URLs)
+    :param str prompt: prompt sent to the model
+    :param dict params: model name, endpoint and sampling params
+    :return: The cache key
+    :rtype: str
+    """
+    payload = json.dumps({'images': image_digests, 'prompt': prompt, 'params': params}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class BaseResponseCache:
+    """
+    Base class of the response caches, keeps hit / miss counters.
+    Subclasses implement _get and _set.
+    """
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def _set(self, key: str, value: str) -> None:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        """
+        Removes every entry of the cache.
+        """
+        raise NotImplementedError
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Returns the cached response for a key, None on miss.
+
+        :param str key: cache key
+        :return: The cached response
+        :rtype: str
+        """
+        with self._lock:
+            value = self._get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        """
+        Stores a response in the cache.
+
+        :param str key: cache key
+        :param str value: response to store
+        """
+        with self._lock:
+            self._set(key, value)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the cache hit / miss counters.
+
+        :return: hits, misses and hit_rate
+        :rtype: dict
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+class InMemoryLRUCache(BaseResponseCache):
+    """
+    In memory least recently used response cache with size and TTL eviction.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None) -> None:
+        """
+        Initialize the InMemoryLRUCache.
+
+        :param int max_size: maximum number of cached responses
+        :param float ttl: seconds after which an entry expires, None to never expire
+        """
+        super().__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: 'OrderedDict[str, Tuple[float, str]]' = OrderedDict()
+
+    def _get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        created_at, value = entry
+        if self.ttl is not None and time.time() - created_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _set(self, key: str, value: str) -> None:
+        self._entries[key] = (time.time(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteResponseCache(BaseResponseCache):
+    """
+    On disk response cache backed by SQLite, survives process restarts.
+    """
+
+    def __init__(
+        self, path: str = '.cache/responses.sqlite', max_size: Optional[int] = 100_000, ttl: Optional[float] = None
+    ) -> None:
+        """
+        Initialize the SQLiteResponseCache.
+
+        :param str path: path of the SQLite database file
+        :param int max_size: maximum number of cached responses, None for unbounded
+        :param float ttl: seconds after which an entry expires, None to never expire
+        """
+        super().__init__()
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses '
+            '(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+
+    def _get(self, key: str) -> Optional[str]:
+        row = self._connection.execute('SELECT value, created_at FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        value, created_at = row
+        now = time.time()
+        if self.ttl is not None and now - created_at > self.ttl:
+            self._connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+            return None
+        self._connection.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+        return value
+
+    def _set(self, key: str, value: str) -> None:
+        now = time.time()
+        self._connection.execute(
+            'INSERT OR REPLACE INTO responses (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)',
+            (key, value, now, now),
+        )
+        if self.ttl is not None:
+            self._connection.execute('DELETE FROM responses WHERE created_at < ?', (now - self.ttl,))
+        if self.max_size is not None:
+            self._connection.execute(
+                'DELETE FROM responses WHERE key IN '
+                '(SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_size,),
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connection.execute('DELETE FROM responses')
+
+    def close(self) -> None:
+        """
+        Closes the database connection.
+        """
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,205 @@
+"""Incremental server sent events decoding for the Sambanova streaming APIs."""
+
+import json
+import time
+from typing import Any, AsyncIterable, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# raw (event, data) pair, event is None for the default 'message' event
+SSEEvent = Tuple[Optional[bytes], bytes]
+
+_DONE = object()
+
+
+class StreamError(RuntimeError):
+    """
+    Base error of a streamed response, the original exception if any is kept as __cause__.
+    """
+
+
+class StreamEventError(StreamError):
+    """
+    The server reported an error inside the stream.
+    """
+
+
+class StreamDecodeError(StreamError):
+    """
+    A stream event could not be decoded.
+    """
+
+
+class SSEDecoder:
+    """
+    Incremental server sent events decoder working on raw response bytes.
+    Events are returned as (event, data) byte tuples, no per event objects are built.
+    """
+
+    __slots__ = ('_buffer', '_event', '_data')
+
+    def __init__(self) -> None:
+        self._buffer = b''
+        self._event: Optional[bytes] = None
+        self._data: List[bytes] = []
+
+    def _process_line(self, line: bytes, events: List[SSEEvent]) -> None:
+        if line.endswith(b'\r'):
+            line = line[:-1]
+        if not line:
+            if self._data:
+                data = self._data[0] if len(self._data) == 1 else b'\n'.join(self._data)
+                events.append((self._event, data))
+            self._event = None
+            self._data = []
+            return
+        if line[0] == 58:  # ':' comment line
+            return
+        field, _, value = line.partition(b':')
+        if value[:1] == b' ':
+            value = value[1:]
+        if field == b'data':
+            self._data.append(value)
+        elif field == b'event':
+            self._event = value
+
+    def feed(self, chunk: bytes) -> List[SSEEvent]:
+        """
+        Feeds raw bytes and returns the events completed by them.
+
+        :param bytes chunk: raw response bytes
+        :return: The completed events
+        :rtype: list
+        """
+        lines = (self._buffer + chunk).split(b'\n')
+        self._buffer = lines.pop()
+        events: List[SSEEvent] = []
+        for line in lines:
+            self._process_line(line, events)
+        return events
+
+    def flush(self) -> List[SSEEvent]:
+        """
+        Returns the pending event at the end of the stream, if the stream did not end with a blank line.
+
+        :return: The pending events
+        :rtype: list
+        """
+        events: List[SSEEvent] = []
+        if self._buffer:
+            self._process_line(self._buffer, events)
+            self._buffer = b''
+        self._process_line(b'', events)
+        return events
+
+
+UsageCallback = Callable[[Dict[str, Any]], None]
+
+
+def _openai_event_content(event: SSEEvent, on_usage: Optional[UsageCallback] = None) -> object:
+    """
+    Returns the content delta of an openai compatible stream event, _DONE for the final event.
+
+    :param tuple event: raw (event, data) pair
+    :param callable on_usage: called with the usage field of the event carrying it
+    :return: The content, None when the event carries no content
+    """
+    event_type, data = event
+    if event_type == b'error_event':
+        raise StreamEventError(f'Sambanova stream returned an error event: {data[:500]!r}')
+    if data == b'[DONE]':
+        return _DONE
+    try:
+        payload = json_loads(data)
+    except ValueError as e:
+        raise StreamDecodeError(f'Error getting content chunk raw streamed response: {data[:500]!r}') from e
+    if not isinstance(payload, dict):
+        raise StreamDecodeError(f'Error getting content chunk raw streamed response: {data[:500]!r}')
+    if payload.get('error'):
+        raise StreamEventError(f'Sambanova stream returned an error: {payload["error"]}')
+    if on_usage is not None and payload.get('usage'):
+        on_usage(payload['usage'])
+    choices = payload.get('choices')
+    if not choices:
+        return None
+    try:
+        return choices[0]['delta'].get('content')
+    except (KeyError, IndexError, TypeError, AttributeError) as e:
+        raise StreamDecodeError(f'Error getting content chunk raw streamed response: {data[:500]!r}') from e
+
+
+def iter_openai_stream(byte_chunks: Iterable[bytes], on_usage: Optional[UsageCallback] = None) -> Iterator[str]:
+    """
+    Yields the content deltas of an openai compatible streamed response.
+
+    :param iterable byte_chunks: raw response bytes as received
+    :param callable on_usage: called with the token usage sent in the final events
+    :yield: The content deltas
+    """
+    decoder = SSEDecoder()
+    for chunk in byte_chunks:
+        for event in decoder.feed(chunk):
+            content = _openai_event_content(event, on_usage)
+            if content is _DONE:
+                return
+            if content:
+                yield content  # type: ignore
+    for event in decoder.flush():
+        content = _openai_event_content(event, on_usage)
+        if content is _DONE:
+            return
+        if content:
+            yield content  # type: ignore
+
+
+async def aiter_openai_stream(
+    byte_chunks: AsyncIterable[bytes], on_usage: Optional[UsageCallback] = None
+) -> AsyncIterator[str]:
+    """
+    Asynchronously yields the content deltas of an openai compatible streamed response.
+
+    :param iterable byte_chunks: raw response bytes as received
+    :param callable on_usage: called with the token usage sent in the final events
+    :yield: The content deltas
+    """
+    decoder = SSEDecoder()
+    async for chunk in byte_chunks:
+        for event in decoder.feed(chunk):
+            content = _openai_event_content(event, on_usage)
+            if content is _DONE:
+                return
+            if content:
+                yield content  # type: ignore
+    for event in decoder.flush():
+        content = _openai_event_content(event, on_usage)
+        if content is _DONE:
+            return
+        if content:
+            yield content  # type: ignore
+
+
+def coalesce(chunks: Iterable[str], flush_interval: float = 0.05) -> Iterator[str]:
+    """
+    Joins streamed tokens into larger chunks emitted at most every flush_interval seconds,
+    which reduces redraws of UI consumers. The first token is emitted immediately.
+
+    :param iterable chunks: streamed tokens
+    :param float flush_interval: minimum number of seconds between two emitted chunks
+    :yield: The coalesced chunks
+    """
+    parts: List[str] = []
+    last_flush = float('-inf')
+    for chunk in chunks:
+        parts.append(chunk)
+        now = time.perf_counter()
+        if now - last_flush >= flush_interval:
+            yield ''.join(parts)
+            parts = []
+            last_flush = now
+    if parts:
+        yield ''.join(parts)
@@ -0,0 +1,94 @@
+"""Latency metrics of streamed model responses."""
+
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+
+class StreamMetrics:
+    """
+    Wraps a stream of text chunks and records time to first token and tokens per second.
+    Each non empty chunk is counted as one token, which matches the token per event
+    streaming of the Sambanova endpoints.
+    """
+
+    def __init__(self, chunks: Iterable[str]) -> None:
+        """
+        Initialize the StreamMetrics.
+
+        :param iterable chunks: stream of text chunks
+        """
+        self._chunks = chunks
+        self._parts: List[str] = []
+        self.start_time: Optional[float] = None
+        self.first_token_time: Optional[float] = None
+        self.end_time: Optional[float] = None
+        self.tokens = 0
+
+    def __iter__(self) -> Iterator[str]:
+        self.start_time = time.perf_counter()
+        for chunk in self._chunks:
+            if not chunk:
+                continue
+            if self.first_token_time is None:
+                self.first_token_time = time.perf_counter()
+            self.tokens += 1
+            self._parts.append(chunk)
+            yield chunk
+        self.end_time = time.perf_counter()
+
+    @property
+    def text(self) -> str:
+        """Text streamed so far."""
+        return ''.join(self._parts)
+
+    @property
+    def time_to_first_token(self) -> Optional[float]:
+        """Seconds between the start of the iteration and the first non empty chunk."""
+        if self.start_time is None or self.first_token_time is None:
+            return None
+        return self.first_token_time - self.start_time
+
+    @property
+    def total_seconds(self) -> Optional[float]:
+        """Seconds between the start and the end of the iteration."""
+        if self.start_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        """Generation rate after the first token."""
+        if self.first_token_time is None or self.end_time is None:
+            return None
+        generation_seconds = self.end_time - self.first_token_time
+        if self.tokens < 2 or generation_seconds <= 0:
+            return None
+        return (self.tokens - 1) / generation_seconds
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Returns the recorded metrics.
+
+        :rtype: dict
+        """
+        return {
+            'time_to_first_token': self.time_to_first_token,
+            'total_seconds': self.total_seconds,
+            'tokens': self.tokens,
+            'tokens_per_second': self.tokens_per_second,
+        }
+
+    def caption(self) -> str:
+        """
+        Returns a short human readable description of the metrics.
+
+        :rtype: str
+        """
+        parts = []
+        if self.time_to_first_token is not None:
+            parts.append(f'first token in {self.time_to_first_token:.2f} s')
+        if self.total_seconds is not None:
+            parts.append(f'total {self.total_seconds:.2f} s')
+        if self.tokens_per_second is not None:
+            parts.append(f'{self.tokens_per_second:.1f} tokens/s')
+        return ' · '.join(parts)
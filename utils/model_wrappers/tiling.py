@@ -0,0 +1,207 @@
+"""Overlapping native resolution tiles of large images, uniform tiles are skipped before any request."""
+
+from io import BytesIO
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+from utils.model_wrappers.image_inputs import ImageBytes, ImageInput
+
+# pixels are subsampled by this step when measuring the tiles contrast
+CONTRAST_STEP = 4
+
+
+class ImageTile(ImageInput):
+    """
+    Region of a larger image used as an image input, cropped and encoded when the wrapper loads it,
+    so the tiles of a request batch are encoded concurrently in the batch workers.
+    """
+
+    def __init__(
+        self,
+        image: Image.Image,
+        box: Tuple[int, int, int, int],
+        row: int,
+        column: int,
+        image_format: str = 'JPEG',
+        quality: int = 90,
+    ) -> None:
+        """
+        Initialize the ImageTile.
+
+        :param Image image: full image, must not be mutated while tiles are loaded
+        :param tuple box: (left, top, right, bottom) of the tile in image pixels
+        :param int row: tile row, starting at 1
+        :param int column: tile column, starting at 1
+        :param str image_format: tile encoding format, JPEG or PNG
+        :param int quality: JPEG quality
+        """
+        self.image = image
+        self.box = box
+        self.row = row
+        self.column = column
+        self.image_format = image_format
+        self.quality = quality
+
+    @property
+    def label(self) -> str:
+        """Tile position and coordinates, e.g. r1c2 (x 896-1920, y 0-1024)."""
+        left, top, right, bottom = self.box
+        return f'r{self.row}c{self.column} (x {left}-{right}, y {top}-{bottom})'
+
+    def load(self) -> ImageBytes:
+        """
+        Crops and encodes the tile.
+
+        :rtype: ImageBytes
+        """
+        tile = self.image.crop(self.box)
+        if tile.mode not in ('RGB', 'L'):
+            tile = tile.convert('RGB')
+        buffer = BytesIO()
+        if self.image_format == 'PNG':
+            tile.save(buffer, format='PNG')
+            return ImageBytes(buffer.getvalue(), mime_type='image/png')
+        tile.save(buffer, format='JPEG', quality=self.quality)
+        return ImageBytes(buffer.getvalue(), mime_type='image/jpeg')
+
+
+def _tile_starts(length: int, tile_size: int, overlap: int) -> List[int]:
+    """Start offsets of overlapping tiles covering a side, the last tile is aligned with the end."""
+    if length <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    starts = list(range(0, length - tile_size, stride))
+    starts.append(length - tile_size)
+    return starts
+
+
+class ImageTiler:
+    """
+    Splits images into overlapping tiles at native resolution and drops the near uniform ones
+    (background, empty mounting resin, saturated areas), which carry nothing worth a request.
+    """
+
+    def __init__(
+        self,
+        tile_size: int = 1024,
+        overlap: int = 128,
+        min_contrast: float = 6.0,
+        image_format: str = 'JPEG',
+        quality: int = 90,
+    ) -> None:
+        """
+        Initialize the ImageTiler.
+
+        :param int tile_size: side of the square tiles in pixels, keep it under the preprocessor max_side
+            so tiles are not downscaled again
+        :param int overlap: pixels shared by neighbouring tiles, features on tile edges are seen whole at least once
+        :param float min_contrast: standard deviation of the gray levels (0-255) under which a tile is uniform
+        :param str image_format: tile encoding format, JPEG or PNG
+        :param int quality: JPEG quality
+        """
+        if not 0 <= overlap < tile_size:
+            raise ValueError('overlap should be between 0 and tile_size')
+        image_format = image_format.upper()
+        if image_format not in ('JPEG', 'PNG'):
+            raise ValueError(f'Unsupported tile format: {image_format}, only JPEG and PNG are supported')
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.min_contrast = min_contrast
+        self.image_format = image_format
+        self.quality = quality
+
+    def grid(self, width: int, height: int) -> List[Tuple[int, int, Tuple[int, int, int, int]]]:
+        """
+        Returns the tiles covering an image.
+
+        :param int width: image width
+        :param int height: image height
+        :return: (row, column, box) of every tile, in row order
+        :rtype: list
+        """
+        return [
+            (row, column, (left, top, min(left + self.tile_size, width), min(top + self.tile_size, height)))
+            for row, top in enumerate(_tile_starts(height, self.tile_size, self.overlap), start=1)
+            for column, left in enumerate(_tile_starts(width, self.tile_size, self.overlap), start=1)
+        ]
+
+    def contrasts(self, image: Image.Image, boxes: Sequence[Tuple[int, int, int, int]]) -> np.ndarray:
+        """
+        Returns the gray level standard deviation of image regions, computed for every region at once
+        from summed area tables of a subsampled grayscale image.
+
+        :param Image image: image
+        :param list boxes: (left, top, right, bottom) regions
+        :rtype: ndarray
+        """
+        gray = np.asarray(image.convert('L'), dtype=np.float64)[::CONTRAST_STEP, ::CONTRAST_STEP]
+        sums = np.zeros((gray.shape[0] + 1, gray.shape[1] + 1))
+        squares = np.zeros_like(sums)
+        sums[1:, 1:] = gray.cumsum(0).cumsum(1)
+        squares[1:, 1:] = (gray**2).cumsum(0).cumsum(1)
+        # region bounds in subsampled pixels, every region keeps at least one pixel
+        left, top, right, bottom = np.asarray(boxes, dtype=np.int64).reshape(-1, 4).T
+        left, top = left // CONTRAST_STEP, top // CONTRAST_STEP
+        right = np.clip(-(-right // CONTRAST_STEP), left + 1, gray.shape[1])
+        bottom = np.clip(-(-bottom // CONTRAST_STEP), top + 1, gray.shape[0])
+
+        def region_sums(table: np.ndarray) -> np.ndarray:
+            return table[bottom, right] - table[top, right] - table[bottom, left] + table[top, left]
+
+        counts = (right - left) * (bottom - top)
+        means = region_sums(sums) / counts
+        variances = region_sums(squares) / counts - means**2
+        return np.sqrt(np.maximum(variances, 0))
+
+    def split(self, image: Image.Image) -> Tuple[List[ImageTile], List[ImageTile]]:
+        """
+        Splits an image into tiles.
+
+        :param Image image: image to split
+        :return: The tiles worth analyzing and the skipped uniform tiles
+        :rtype: tuple
+        """
+        grid = self.grid(image.width, image.height)
+        contrasts = self.contrasts(image, [box for _, _, box in grid])
+        kept: List[ImageTile] = []
+        skipped: List[ImageTile] = []
+        for (row, column, box), contrast in zip(grid, contrasts):
+            tile = ImageTile(image, box, row, column, self.image_format, self.quality)
+            (kept if contrast >= self.min_contrast else skipped).append(tile)
+        return kept, skipped
+
+
+def merge_tile_answers(
+    tiles: Sequence[ImageTile],
+    answers: Sequence[Any],
+    size: Tuple[int, int],
+    skipped: int = 0,
+    tiler: Optional[ImageTiler] = None,
+) -> str:
+    """
+    Merges the answers about the tiles of an image into a single report. Tiles with the same answer,
+    typically nothing relevant, are listed together.
+
+    :param list tiles: analyzed tiles
+    :param list answers: answer or raised exception of each tile
+    :param tuple size: (width, height) of the image
+    :param int skipped: number of uniform tiles left out
+    :param ImageTiler tiler: tiler used to split the image, described in the report header
+    :return: The markdown report
+    :rtype: str
+    """
+    header = f'Tiled analysis of a {size[0]}x{size[1]} image: {len(tiles)} tile(s) analyzed'
+    if tiler is not None:
+        header += f' ({tiler.tile_size} px, {tiler.overlap} px overlap)'
+    if skipped:
+        header += f', {skipped} uniform tile(s) skipped'
+    groups: Dict[str, List[str]] = {}
+    for tile, answer in zip(tiles, answers):
+        text = f'failed: {answer}' if isinstance(answer, Exception) else str(answer).strip()
+        groups.setdefault(text, []).append(tile.label)
+    sections = [header]
+    for text, labels in groups.items():
+        sections.append(f'**Tile {", ".join(labels)}:** {text}')
+    return '\n\n'.join(sections)
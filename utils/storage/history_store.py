@@ -0,0 +1,231 @@
+"""Conversation history with a bounded in-memory window per session and a SQLite backing store."""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from utils.model_wrappers.prompt_templates import estimate_tokens
+
+
+class HistoryStore:
+    """
+    Stores the turns of each session conversation. Every turn is written to SQLite and only the
+    last window turns of the max_sessions most recently used conversations are kept in memory,
+    older turns are read back from SQLite by page.
+    """
+
+    def __init__(
+        self,
+        path: str = '.cache/history.sqlite',
+        window: int = 20,
+        max_sessions: int = 256,
+        max_age: Optional[float] = 30 * 24 * 3600,
+    ) -> None:
+        """
+        Initialize the HistoryStore.
+
+        :param str path: path of the SQLite database
+        :param int window: number of most recent turns kept in memory per conversation
+        :param int max_sessions: number of conversations kept in memory
+        :param float max_age: seconds after which turns are removed from SQLite, None to keep them
+        """
+        self.path = path
+        self.window = window
+        self.max_sessions = max_sessions
+        self.max_age = max_age
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._windows: 'OrderedDict[Tuple[str, str], Tuple[int, Deque[Dict[str, Any]]]]' = OrderedDict()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS turns (session_id TEXT NOT NULL, conversation TEXT NOT NULL, '
+            'turn INTEGER NOT NULL, query TEXT NOT NULL, response TEXT NOT NULL, metrics TEXT, '
+            'created_at REAL NOT NULL, PRIMARY KEY (session_id, conversation, turn))'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS turns_created_at ON turns (created_at)')
+        if max_age is not None:
+            self._connection.execute('DELETE FROM turns WHERE created_at < ?', (time.time() - max_age,))
+
+    @staticmethod
+    def _row_to_turn(row: Tuple) -> Dict[str, Any]:
+        turn, query, response, metrics, created_at = row
+        return {
+            'turn': turn,
+            'query': query,
+            'response': response,
+            'metrics': json.loads(metrics) if metrics else None,
+            'created_at': created_at,
+        }
+
+    def _load_window(self, key: Tuple[str, str]) -> Tuple[int, Deque[Dict[str, Any]]]:
+        """
+        Returns the turn count and in-memory window of a conversation, loading it from SQLite if needed.
+        Must be called with the lock held.
+        """
+        if key in self._windows:
+            self._windows.move_to_end(key)
+            return self._windows[key]
+        # the next turn number, not the row count: expired turns leave the oldest numbers unused
+        count = self._connection.execute(
+            'SELECT COALESCE(MAX(turn) + 1, 0) FROM turns WHERE session_id = ? AND conversation = ?', key
+        ).fetchone()[0]
+        rows = self._connection.execute(
+            'SELECT turn, query, response, metrics, created_at FROM turns WHERE session_id = ? AND conversation = ? '
+            'ORDER BY turn DESC LIMIT ?',
+            (*key, self.window),
+        ).fetchall()
+        window: Deque[Dict[str, Any]] = deque((self._row_to_turn(row) for row in reversed(rows)), maxlen=self.window)
+        self._windows[key] = (count, window)
+        while len(self._windows) > self.max_sessions:
+            self._windows.popitem(last=False)
+        return self._windows[key]
+
+    def append(
+        self,
+        session_id: str,
+        query: str,
+        response: str,
+        metrics: Optional[Dict[str, Any]] = None,
+        conversation: str = 'default',
+    ) -> int:
+        """
+        Appends a turn to a conversation.
+
+        :param str session_id: id of the user session
+        :param str query: user query
+        :param str response: model response
+        :param dict metrics: optional metrics of the response
+        :param str conversation: name of the conversation within the session
+        :return: The turn number, starting at 0
+        :rtype: int
+        """
+        key = (session_id, conversation)
+        now = time.time()
+        with self._lock:
+            count, window = self._load_window(key)
+            self._connection.execute(
+                'INSERT INTO turns (session_id, conversation, turn, query, response, metrics, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (*key, count, query, response, json.dumps(metrics) if metrics is not None else None, now),
+            )
+            window.append({'turn': count, 'query': query, 'response': response, 'metrics': metrics, 'created_at': now})
+            self._windows[key] = (count + 1, window)
+        return count
+
+    def count(self, session_id: str, conversation: str = 'default') -> int:
+        """
+        Returns the number of turns of a conversation, expired turns included.
+
+        :param str session_id: id of the user session
+        :param str conversation: name of the conversation within the session
+        :rtype: int
+        """
+        with self._lock:
+            return self._load_window((session_id, conversation))[0]
+
+    def recent(self, session_id: str, conversation: str = 'default') -> List[Dict[str, Any]]:
+        """
+        Returns the in-memory window of most recent turns, oldest first.
+
+        :param str session_id: id of the user session
+        :param str conversation: name of the conversation within the session
+        :rtype: list
+        """
+        with self._lock:
+            return list(self._load_window((session_id, conversation))[1])
+
+    def page(self, session_id: str, start: int, end: int, conversation: str = 'default') -> List[Dict[str, Any]]:
+        """
+        Returns the turns start <= turn < end of a conversation, oldest first, read from SQLite.
+
+        :param str session_id: id of the user session
+        :param int start: first turn
+        :param int end: turn after the last one
+        :param str conversation: name of the conversation within the session
+        :rtype: list
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT turn, query, response, metrics, created_at FROM turns WHERE session_id = ? '
+                'AND conversation = ? AND turn >= ? AND turn < ? ORDER BY turn',
+                (session_id, conversation, start, end),
+            ).fetchall()
+        return [self._row_to_turn(row) for row in rows]
+
+    def build_messages(
+        self,
+        session_id: str,
+        query: str,
+        system_prompt: Optional[str] = None,
+        max_tokens: int = 4096,
+        conversation: str = 'default',
+        estimate: Callable[[str], int] = estimate_tokens,
+        align: int = 1,
+    ) -> List[Dict[str, str]]:
+        """
+        Builds the chat messages of a new query, with as many of the in-memory recent turns as fit in the
+        token budget. The system prompt and the query are always included.
+
+        The messages of consecutive calls share the longest possible prefix, system prompt first and turns
+        oldest first, so provider side prefix caching can reuse it. With align > 1 the first included turn
+        is rounded up to a multiple of align, the prefix then only changes once every align turns instead
+        of on every turn once the budget is full.
+
+        :param str session_id: id of the user session
+        :param str query: new user query
+        :param str system_prompt: optional system prompt
+        :param int max_tokens: token budget of the messages
+        :param str conversation: name of the conversation within the session
+        :param callable estimate: token estimate of a text
+        :param int align: granularity of the first included turn
+        :return: The openai compatible messages
+        :rtype: list
+        """
+        budget = max_tokens - estimate(query) - (estimate(system_prompt) if system_prompt else 0)
+        included: List[Dict[str, Any]] = []
+        for turn in reversed(self.recent(session_id, conversation)):
+            cost = estimate(turn['query']) + estimate(turn['response'])
+            if cost > budget:
+                break
+            budget -= cost
+            included.append(turn)
+        messages = [{'role': 'system', 'content': system_prompt}] if system_prompt else []
+        if included:
+            first_turn = -(-included[-1]['turn'] // align) * align
+            for turn in reversed(included):
+                if turn['turn'] >= first_turn:
+                    messages.append({'role': 'user', 'content': turn['query']})
+                    messages.append({'role': 'assistant', 'content': turn['response']})
+        return messages + [{'role': 'user', 'content': query}]
+
+    def clear(self, session_id: str, conversation: str = 'default') -> None:
+        """
+        Removes the turns of a conversation.
+
+        :param str session_id: id of the user session
+        :param str conversation: name of the conversation within the session
+        """
+        with self._lock:
+            self._connection.execute(
+                'DELETE FROM turns WHERE session_id = ? AND conversation = ?', (session_id, conversation)
+            )
+            self._windows.pop((session_id, conversation), None)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the number of conversations and turns held in memory.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'conversations': len(self._windows),
+                'turns_in_memory': sum(len(window) for _, window in self._windows.values()),
+            }
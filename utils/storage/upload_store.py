@@ -0,0 +1,190 @@
+"""Content addressed, size bounded store for uploaded images."""
+
+import hashlib
+import mimetypes
+import mmap
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Union
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+
+class UploadStore:
+    """
+    Stores uploads once per content digest as <digest><ext> files with their metadata in SQLite.
+    Least recently used blobs are evicted when the store exceeds max_bytes, and blobs not accessed
+    for max_age seconds are removed.
+    """
+
+    def __init__(
+        self,
+        root: str = '.cache/uploads',
+        max_bytes: Optional[int] = 512 * 1024 * 1024,
+        max_age: Optional[float] = 7 * 24 * 3600,
+    ) -> None:
+        """
+        Initialize the UploadStore.
+
+        :param str root: directory of the stored files and index
+        :param int max_bytes: maximum total size of the stored files, None for unbounded
+        :param float max_age: seconds after the last access after which a file is removed, None to keep files
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            os.path.join(root, 'index.sqlite'), check_same_thread=False, isolation_level=None
+        )
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, filename TEXT NOT NULL, name TEXT, '
+            'mime_type TEXT, size INTEGER NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS blobs_accessed_at ON blobs (accessed_at)')
+
+    def _path(self, filename: str) -> str:
+        return os.path.join(self.root, filename)
+
+    def put(
+        self,
+        data: BytesLike,
+        name: Optional[str] = None,
+        mime_type: Optional[str] = None,
+        digest: Optional[str] = None,
+    ) -> str:
+        """
+        Stores content if it is not already stored. Older files are evicted to make room, never the stored one.
+
+        :param bytes data: content to store
+        :param str name: original file name
+        :param str mime_type: MIME type, guessed from the name if not provided
+        :param str digest: sha256 hex digest of the content if already known
+        :return: The content digest
+        :rtype: str
+        :raises ValueError: if the content is larger than max_bytes
+        """
+        if self.max_bytes is not None and len(data) > self.max_bytes:
+            raise ValueError(f'{name or "content"} is {len(data)} bytes, larger than the {self.max_bytes} bytes store')
+        if digest is None:
+            digest = hashlib.sha256(data).hexdigest()
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute('SELECT filename FROM blobs WHERE digest = ?', (digest,)).fetchone()
+            if row is not None and os.path.exists(self._path(row[0])):
+                self._connection.execute('UPDATE blobs SET accessed_at = ? WHERE digest = ?', (now, digest))
+                return digest
+            if mime_type is None and name:
+                mime_type = mimetypes.guess_type(name)[0]
+            extension = (mimetypes.guess_extension(mime_type) if mime_type else None) or ''
+            filename = f'{digest}{extension}'
+            temporary_path = self._path(f'.{filename}.{threading.get_ident()}.tmp')
+            with open(temporary_path, 'wb') as f:
+                f.write(data)
+            os.replace(temporary_path, self._path(filename))
+            self._connection.execute(
+                'INSERT OR REPLACE INTO blobs (digest, filename, name, mime_type, size, created_at, accessed_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (digest, filename, name, mime_type, len(data), now, now),
+            )
+            self._evict(now, keep=digest)
+        return digest
+
+    def path(self, digest: str) -> Optional[str]:
+        """
+        Returns the path of a stored file and marks it as accessed.
+
+        :param str digest: content digest
+        :return: The file path, None if not stored
+        :rtype: str
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT filename FROM blobs WHERE digest = ?', (digest,)).fetchone()
+            if row is None:
+                return None
+            self._connection.execute('UPDATE blobs SET accessed_at = ? WHERE digest = ?', (time.time(), digest))
+        return self._path(row[0])
+
+    def open(self, digest: str) -> Optional[mmap.mmap]:
+        """
+        Memory maps a stored file read only, the content is paged in lazily without being copied.
+
+        :param str digest: content digest
+        :return: The memory mapped content, None if not stored
+        :rtype: mmap.mmap
+        """
+        path = self.path(digest)
+        if path is None or not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def metadata(self, digest: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns the metadata of a stored file.
+
+        :param str digest: content digest
+        :rtype: dict
+        """
+        with self._lock:
+            cursor = self._connection.execute('SELECT * FROM blobs WHERE digest = ?', (digest,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([column[0] for column in cursor.description], row))
+
+    def _delete(self, rows: List[Any]) -> None:
+        for digest, filename in rows:
+            try:
+                os.remove(self._path(filename))
+            except FileNotFoundError:
+                pass
+            self._connection.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+
+    def _evict(self, now: float, keep: Optional[str] = None) -> None:
+        """
+        Removes expired files then least recently used files until the store fits in max_bytes. Must hold the lock.
+
+        :param float now: current time
+        :param str keep: digest of a file never evicted, the one being stored
+        """
+        if self.max_age is not None:
+            expired = self._connection.execute(
+                'SELECT digest, filename FROM blobs WHERE accessed_at < ?', (now - self.max_age,)
+            ).fetchall()
+            self._delete(expired)
+        if self.max_bytes is not None:
+            total = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+            if total > self.max_bytes:
+                evicted = []
+                for digest, filename, size in self._connection.execute(
+                    'SELECT digest, filename, size FROM blobs ORDER BY accessed_at'
+                ).fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    if digest == keep:
+                        continue
+                    evicted.append((digest, filename))
+                    total -= size
+                self._delete(evicted)
+
+    def evict(self) -> None:
+        """
+        Applies the age and size limits.
+        """
+        with self._lock:
+            self._evict(time.time())
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the number of stored files and their total size.
+
+        :rtype: dict
+        """
+        with self._lock:
+            count, total = self._connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs').fetchone()
+        return {'files': count, 'bytes': total}
@@ -0,0 +1,75 @@
+"""Paged rendering of a conversation history, bounded whatever the length of the session."""
+
+from typing import Any, Dict, List, Tuple
+
+import streamlit as st
+
+from utils.storage.history_store import HistoryStore
+
+
+def _render_turns(turns: List[Dict[str, Any]], query_label: str, response_label: str) -> None:
+    for turn in turns:
+        st.write(f"**{query_label} {turn['turn'] + 1}:** {turn['query']}")
+        st.write(f"**{response_label} {turn['turn'] + 1}:** {turn['response']}")
+
+
+def page_bounds(older: int, page_size: int, page: int) -> Tuple[int, int]:
+    """
+    Returns the turns start <= turn < end of a page of the older turns. The last page holds the page_size
+    turns right before the recent ones and the first page the remainder, so every page but the first is full.
+
+    :param int older: number of turns before the recent ones
+    :param int page_size: number of turns per page
+    :param int page: page number, from 1 to page_count(older, page_size)
+    :rtype: tuple
+    """
+    end = older - (page_count(older, page_size) - page) * page_size
+    return max(0, end - page_size), end
+
+
+def page_count(older: int, page_size: int) -> int:
+    """
+    Returns the number of pages of the older turns.
+
+    :param int older: number of turns before the recent ones
+    :param int page_size: number of turns per page
+    :rtype: int
+    """
+    return max(0, (older + page_size - 1) // page_size)
+
+
+def render_history(
+    store: HistoryStore,
+    session_id: str,
+    conversation: str = 'default',
+    title: str = 'Previous Queries and Responses',
+    page_size: int = 5,
+    query_label: str = 'Query',
+    response_label: str = 'Response',
+) -> None:
+    """
+    Renders the last page_size turns of a conversation from the in-memory window, older turns are
+    read from the store one page at a time inside an expander.
+
+    :param HistoryStore store: history store
+    :param str session_id: id of the user session
+    :param str conversation: name of the conversation within the session
+    :param str title: section title
+    :param int page_size: number of turns per page
+    :param str query_label: label of the queries
+    :param str response_label: label of the responses
+    """
+    count = store.count(session_id, conversation)
+    if not count:
+        return
+    st.write(f'### {title}')
+    older = count - page_size
+    if older > 0:
+        with st.expander(f'{older} older {query_label.lower()}(s)'):
+            pages = page_count(older, page_size)
+            page = st.number_input(
+                'Page', min_value=1, max_value=pages, value=pages, key=f'_history_page_{conversation}'
+            )
+            start, end = page_bounds(older, page_size, page)
+            _render_turns(store.page(session_id, start, end, conversation), query_label, response_label)
+    _render_turns(store.recent(session_id, conversation)[-page_size:], query_label, response_label)
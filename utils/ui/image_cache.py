@@ -0,0 +1,222 @@
+"""Caches of decoded images, previews and crop boxes that survive Streamlit reruns."""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from typing import Optional, Tuple
+
+import streamlit as st
+from PIL import Image
+from streamlit_cropper import st_cropper
+
+# longest side of the previews, matches the width st_cropper resizes images to
+PREVIEW_MAX_SIDE = 700
+
+# decoded full resolution images kept in memory by the process, across every session
+DECODED_MAX_BYTES = 1024 * 1024 * 1024
+
+# crop box as (left, top, width, height) in preview pixels
+Box = Tuple[int, int, int, int]
+
+
+def content_digest(data: bytes) -> str:
+    """
+    Returns the sha256 hex digest of some content.
+
+    :param bytes data: content to hash
+    :rtype: str
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def image_nbytes(image: Image.Image) -> int:
+    """
+    Returns the memory size of the pixels of a decoded image.
+
+    :param Image image: decoded image
+    :rtype: int
+    """
+    return image.width * image.height * len(image.getbands())
+
+
+class DecodedImageCache:
+    """
+    Least recently used decoded images, bounded by the size of their pixels rather than their count
+    since a single large micrograph weighs as much as hundreds of small images.
+    """
+
+    def __init__(self, max_bytes: int = DECODED_MAX_BYTES) -> None:
+        """
+        Initialize the DecodedImageCache.
+
+        :param int max_bytes: maximum total size of the decoded pixels, the last image is kept even if larger
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._images: 'OrderedDict[str, Image.Image]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._images)
+
+    def get(self, digest: str, data: bytes) -> Image.Image:
+        """
+        Returns the decoded image of a content digest, decoding it on a miss. Images must not be mutated.
+
+        :param str digest: content digest of the encoded image
+        :param bytes data: encoded image
+        :rtype: Image
+        """
+        with self._lock:
+            image = self._images.get(digest)
+            if image is not None:
+                self._images.move_to_end(digest)
+                return image
+        image = Image.open(BytesIO(data))
+        image.load()
+        with self._lock:
+            if digest not in self._images:
+                self._images[digest] = image
+                self.nbytes += image_nbytes(image)
+            while self.nbytes > self.max_bytes and len(self._images) > 1:
+                _, evicted = self._images.popitem(last=False)
+                self.nbytes -= image_nbytes(evicted)
+            return self._images.get(digest, image)
+
+
+@st.cache_resource(show_spinner=False)
+def _decoded_images() -> DecodedImageCache:
+    """
+    Returns the process wide cache of decoded images, shared by every session.
+    """
+    return DecodedImageCache()
+
+
+@st.cache_resource(max_entries=256, show_spinner=False)
+def _preview(digest: str, _image: Image.Image) -> Tuple[Image.Image, bytes]:
+    """
+    Builds the downscaled preview of an image and its JPEG encoding.
+    """
+    preview = _image.copy()
+    preview.thumbnail((PREVIEW_MAX_SIDE, PREVIEW_MAX_SIDE))
+    if preview.mode not in ('RGB', 'L'):
+        preview = preview.convert('RGB')
+    buffered = BytesIO()
+    preview.save(buffered, format='JPEG', quality=85)
+    return preview, buffered.getvalue()
+
+
+def _crop(box: Box, image: Image.Image, preview_image: Image.Image) -> Tuple[Image.Image, bytes]:
+    """
+    Crops the full resolution image with a box given in preview pixels, returns the crop
+    and the JPEG encoding of the matching preview crop.
+    """
+    scale_x = image.width / preview_image.width
+    scale_y = image.height / preview_image.height
+    left, top, width, height = box
+    cropped = image.crop(
+        (
+            int(left * scale_x),
+            int(top * scale_y),
+            min(image.width, int((left + width) * scale_x)),
+            min(image.height, int((top + height) * scale_y)),
+        )
+    )
+    preview_crop = preview_image.crop((left, top, left + width, top + height))
+    buffered = BytesIO()
+    preview_crop.save(buffered, format='JPEG', quality=85)
+    return cropped, buffered.getvalue()
+
+
+class CachedImage:
+    """
+    Decoded image with its preview, identified by its content digest.
+    """
+
+    def __init__(self, digest: str, data: bytes, name: str) -> None:
+        """
+        Initialize the CachedImage.
+
+        :param str digest: sha256 hex digest of the encoded image
+        :param bytes data: encoded image
+        :param str name: display name
+        """
+        self.digest = digest
+        self.name = name
+        self.image = _decoded_images().get(digest, data)
+        self.preview, self.preview_bytes = _preview(digest, self.image)
+
+    def crop(self, box: Box) -> Tuple[Image.Image, bytes]:
+        """
+        Returns the full resolution crop of a preview box and the encoded preview of the crop.
+
+        :param tuple box: (left, top, width, height) in preview pixels
+        :rtype: tuple
+        """
+        return _crop(box, self.image, self.preview)
+
+
+def load_uploaded_image(uploaded_file) -> CachedImage:
+    """
+    Returns the cached image of a Streamlit uploaded file. The content digest is computed
+    once per upload and remembered in the session state, so reruns do not rehash the file.
+
+    :param uploaded_file: Streamlit UploadedFile
+    :rtype: CachedImage
+    """
+    digests = st.session_state.setdefault('_upload_digests', {})
+    data = uploaded_file.getbuffer()
+    digest = digests.get(uploaded_file.file_id)
+    if digest is None:
+        digest = content_digest(data)
+        digests[uploaded_file.file_id] = digest
+    return CachedImage(digest, data, uploaded_file.name)
+
+
+def load_image_bytes(data: bytes, name: str, digest: Optional[str] = None) -> CachedImage:
+    """
+    Returns the cached image of some encoded image bytes.
+
+    :param bytes data: encoded image
+    :param str name: display name
+    :param str digest: content digest if already known
+    :rtype: CachedImage
+    """
+    return CachedImage(digest or content_digest(data), data, name)
+
+
+def crop_selector(cached: CachedImage, box_color: str = 'blue') -> Tuple[Image.Image, bytes]:
+    """
+    Renders a cropper over the image preview. The last crop box and its crop are kept in the session state
+    and the cropper is keyed by the image digest, so reruns keep the selection and only recompute the crop
+    when the box changes. Only the latest crop of each image is kept, the cropper updates on every drag.
+
+    :param CachedImage cached: image to crop
+    :param str box_color: color of the crop box
+    :return: The full resolution crop and the encoded preview of the crop
+    :rtype: tuple
+    """
+    box_key = f'_crop_box_{cached.digest}'
+    last_box: Optional[Box] = st.session_state.get(box_key)
+    default_coords = None
+    if last_box is not None:
+        left, top, width, height = last_box
+        default_coords = (left, left + width, top, top + height)
+    rect = st_cropper(
+        cached.preview,
+        realtime_update=True,
+        default_coords=default_coords,
+        box_color=box_color,
+        aspect_ratio=None,
+        return_type='box',
+        key=f'_cropper_{cached.digest}',
+        should_resize_image=False,
+    )
+    box = (int(rect['left']), int(rect['top']), max(1, int(rect['width'])), max(1, int(rect['height'])))
+    st.session_state[box_key] = box
+    crop_key = f'_crop_{cached.digest}'
+    last_crop = st.session_state.get(crop_key)
+    if last_crop is None or last_crop[0] != box:
+        last_crop = st.session_state[crop_key] = (box, *cached.crop(box))
+    return last_crop[1], last_crop[2]
@@ -0,0 +1,51 @@
+"""Streamlit debug panel of the in-process latency, payload and token metrics."""
+
+from typing import Any, Dict, List
+
+import streamlit as st
+
+from utils.model_wrappers.instrumentation import SPANS, MetricsRegistry
+
+
+def _metric_order(name: str) -> int:
+    """Sorts the span metrics in call order, then the other metrics."""
+    for index, span in enumerate(SPANS):
+        if name.endswith(f'_{span}_seconds'):
+            return index
+    return len(SPANS)
+
+
+def render_metrics_panel(registry: MetricsRegistry, title: str = 'Debug metrics') -> None:
+    """
+    Renders p50 / p95 of every metric of the registry in a collapsed sidebar expander,
+    with downloads of the Prometheus text and JSON exports.
+
+    :param MetricsRegistry registry: registry to display
+    :param str title: expander title
+    """
+    with st.sidebar.expander(title, expanded=False):
+        snapshot = registry.snapshot()
+        rows: List[Dict[str, Any]] = []
+        for name in sorted(snapshot['summaries'], key=lambda name: (_metric_order(name), name)):
+            for item in snapshot['summaries'][name]:
+                labels = item['labels']
+                rows.append({
+                    'metric': name,
+                    'call': f"{labels.get('client', '')}.{labels.get('method', '')} {labels.get('endpoint', '')}",
+                    'count': item['count'],
+                    'p50': item['quantiles'].get('0.5'),
+                    'p95': item['quantiles'].get('0.95'),
+                })
+        if not rows:
+            st.caption('No model calls recorded yet.')
+            return
+        st.dataframe(rows, hide_index=True)
+        errors = sum(
+            item['value']
+            for item in snapshot['counters'].get('model_calls_total', [])
+            if item['labels'].get('status') == 'error'
+        )
+        if errors:
+            st.caption(f'{errors:.0f} failed call(s)')
+        st.download_button('Prometheus metrics', registry.to_prometheus(), file_name='metrics.prom')
+        st.download_button('JSON metrics', registry.to_json(), file_name='metrics.json')
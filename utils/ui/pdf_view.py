@@ -0,0 +1,103 @@
+"""PDF page picking and streamed page rendering for the ImageAnalyzer page."""
+
+from typing import List, Sequence, Tuple
+
+import streamlit as st
+
+from utils.model_wrappers.pdf_inputs import PDFDocument
+from utils.storage.upload_store import UploadStore
+from utils.ui.image_cache import CachedImage, content_digest, load_image_bytes
+
+# rendering resolutions offered to the user
+DPI_OPTIONS = (72, 100, 150, 200, 300)
+
+# thumbnails shown per preview page, in rows of THUMBNAIL_COLUMNS
+THUMBNAILS_PER_PAGE = 8
+THUMBNAIL_COLUMNS = 4
+
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def open_pdf(path: str) -> PDFDocument:
+    """
+    Opens a PDF once per stored file, its rendered pages and texts are shared by the sessions.
+
+    :param str path: path of the PDF file
+    :rtype: PDFDocument
+    """
+    return PDFDocument(path)
+
+
+def open_uploaded_pdf(uploaded_file, store: UploadStore) -> PDFDocument:
+    """
+    Stores an uploaded PDF and opens it, the content digest is computed once per upload.
+
+    :param uploaded_file: Streamlit UploadedFile
+    :param UploadStore store: store keeping the uploaded files
+    :rtype: PDFDocument
+    """
+    digests = st.session_state.setdefault('_upload_digests', {})
+    data = uploaded_file.getbuffer()
+    digest = digests.get(uploaded_file.file_id)
+    if digest is None:
+        digest = content_digest(data)
+        digests[uploaded_file.file_id] = digest
+    store.put(data, name=uploaded_file.name, mime_type='application/pdf', digest=digest)
+    return open_pdf(store.path(digest))
+
+
+def pdf_page_picker(document: PDFDocument, name: str) -> Tuple[List[int], int]:
+    """
+    Renders a thumbnail browser of the document and lets the user pick pages and a resolution.
+    Only the thumbnails of the browsed preview page are rendered, each one is shown as soon as it is ready.
+
+    :param PDFDocument document: document to browse
+    :param str name: display name of the document
+    :return: The picked page numbers and resolution
+    :rtype: tuple
+    """
+    page_count = document.page_count
+    st.write(f"**{name}** ({page_count} pages)")
+    previews = (page_count + THUMBNAILS_PER_PAGE - 1) // THUMBNAILS_PER_PAGE
+    preview = 1
+    if previews > 1:
+        preview = st.number_input(
+            'Thumbnails page', min_value=1, max_value=previews, value=1, key=f'_pdf_preview_{document.path}'
+        )
+    first = (preview - 1) * THUMBNAILS_PER_PAGE + 1
+    pages = list(range(first, min(first + THUMBNAILS_PER_PAGE, page_count + 1)))
+    columns = st.columns(THUMBNAIL_COLUMNS)
+    placeholders = {page: columns[index % THUMBNAIL_COLUMNS].empty() for index, page in enumerate(pages)}
+    for page, placeholder in placeholders.items():
+        placeholder.caption(f'page {page}...')
+    try:
+        for page, thumbnail in document.iter_thumbnails(pages):
+            placeholders[page].image(bytes(thumbnail.data), caption=f'page {page}')
+    except Exception as e:
+        st.warning(f'Page thumbnails are unavailable: {e}')
+    picked = st.multiselect(
+        'Pages to analyze', list(range(1, page_count + 1)), default=[1], key=f'_pdf_pages_{document.path}'
+    )
+    dpi = st.select_slider('Resolution (DPI)', DPI_OPTIONS, value=150, key=f'_pdf_dpi_{document.path}')
+    return sorted(picked), dpi
+
+
+def render_pdf_pages(document: PDFDocument, pages: Sequence[int], dpi: int, name: str) -> List[CachedImage]:
+    """
+    Rasterizes the picked pages in the rendering pool, showing each preview as soon as its page is ready.
+
+    :param PDFDocument document: document of the pages
+    :param list pages: page numbers
+    :param int dpi: rendering resolution
+    :param str name: display name of the document
+    :return: The rendered pages in page order
+    :rtype: list
+    """
+    placeholders = {page: st.empty() for page in pages}
+    for page, placeholder in placeholders.items():
+        placeholder.caption(f'Rendering page {page} at {dpi} DPI...')
+    rendered = {}
+    for page, image in document.iter_render(pages, dpi):
+        cached_image = load_image_bytes(bytes(image.data), f'{name} p{page}')
+        rendered[page] = cached_image
+        placeholders[page].image(cached_image.preview_bytes, caption=f'{name}, page {page}', use_column_width=True)
+    return [rendered[page] for page in pages]